@@ -0,0 +1,284 @@
+import asyncio
+import math
+import os
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from threading import BoundedSemaphore, Lock
+from typing import Callable, Deque, Dict, List, Optional
+
+import metrics
+from fastapi import HTTPException
+from logger import init_logger
+
+logger = init_logger(__name__)
+
+# Every endpoint class gets a lane with its own concurrency quota and wait
+# queue. Lanes are listed by priority: a lane does not start new requests
+# while a lane above it has requests waiting. Each lane is configured by
+# ADMIT_<LANE>_CONCURRENCY, ADMIT_<LANE>_QUEUE (waiting requests before
+# 503), ADMIT_<LANE>_QUEUE_PER_KEY (waiting requests of one API key
+# before 429) and ADMIT_<LANE>_TIMEOUT (seconds in the queue before 503).
+LANES = {
+    # /lint, /lint/stream, /lint/diff
+    "interactive": dict(concurrency=32,
+                        queue=128,
+                        queue_per_key=32,
+                        timeout=10.0),
+    # /lint/batch, /rag, /delete-rag
+    "batch": dict(concurrency=4, queue=32, queue_per_key=8, timeout=60.0),
+    # /dev, /cover: clone the repo and start an agent thread
+    "jobs": dict(concurrency=2, queue=8, queue_per_key=2, timeout=60.0),
+}
+# agent threads started by /dev and /cover which may run at the same time
+ADMIT_MAX_RUNNING_JOBS = int(os.getenv("ADMIT_MAX_RUNNING_JOBS", "4"))
+# Retry-After sent when every job slot is taken
+ADMIT_JOB_RETRY_AFTER = int(os.getenv("ADMIT_JOB_RETRY_AFTER", "60"))
+
+
+def _lane_env(lane: str, name: str, default):
+    value = os.getenv(f"ADMIT_{lane.upper()}_{name.upper()}")
+    return type(default)(value) if value else default
+
+
+def overloaded(status_code: int, detail: str,
+               retry_after: float) -> HTTPException:
+    logger.warning(f"shed {status_code}: {detail}")
+    return HTTPException(
+        status_code=status_code,
+        detail=detail,
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))})
+
+
+class Lane(object):
+    """
+    the waiting requests are queued per API key and served round robin,
+    so one client can not starve the others
+    """
+
+    def __init__(self, name: str, concurrency: int, queue: int,
+                 queue_per_key: int, timeout: float):
+        self.name = name
+        self.concurrency = concurrency
+        self.max_queue = queue
+        self.max_queue_per_key = queue_per_key
+        self.timeout = timeout
+        self.running = 0
+        self.waiting = 0
+        self._queues: Dict[str, Deque[asyncio.Future]] = OrderedDict()
+        # rolling time a request holds its slot, for Retry-After
+        self.service_time = 1.0
+        self.admitted = metrics.counter(f"admission.{name}.admitted")
+        self.shed = metrics.counter(f"admission.{name}.shed")
+        self.queue_wait = metrics.histogram(
+            f"admission.{name}.queue_wait",
+            [0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60])
+
+    def retry_after(self) -> float:
+        return (self.waiting + 1) * self.service_time / self.concurrency
+
+    def enqueue(self, key: str) -> asyncio.Future:
+        queue = self._queues.setdefault(key, deque())
+        waiter = asyncio.get_running_loop().create_future()
+        queue.append(waiter)
+        self.waiting += 1
+        return waiter
+
+    def dequeue(self, key: str, waiter: asyncio.Future):
+        queue = self._queues.get(key)
+        if queue is None or waiter not in queue:
+            return
+        queue.remove(waiter)
+        self.waiting -= 1
+        if not queue:
+            del self._queues[key]
+
+    def queued(self, key: str) -> int:
+        return len(self._queues.get(key, ()))
+
+    def next_waiter(self) -> Optional[asyncio.Future]:
+        """
+        the oldest waiter of the next API key, round robin
+        """
+        while self._queues:
+            key, queue = self._queues.popitem(last=False)
+            waiter = queue.popleft()
+            self.waiting -= 1
+            if queue:
+                self._queues[key] = queue
+            if not waiter.done():
+                return waiter
+        return None
+
+
+class Ticket(object):
+
+    def __init__(self, controller: "AdmissionController", lane: Lane):
+        self._controller = controller
+        self.lane = lane
+        self.start = time.monotonic()
+        self._released = False
+
+    def release(self):
+        # called from the event loop only, could be called more than once
+        if self._released:
+            return
+        self._released = True
+        self._controller.release(self)
+
+    async def arelease(self):
+        """
+        for starlette background tasks, they run sync functions in a thread
+        """
+        self.release()
+
+
+class AdmissionController(object):
+    """
+    admits the requests of each lane up to its concurrency, queues the
+    rest and sheds load with 429/503 and Retry-After when the queue is
+    too deep. runs on the event loop, no locking needed.
+    """
+
+    def __init__(self, lanes: List[Lane]):
+        # by priority, highest first
+        self.lanes = lanes
+        self._by_name = {lane.name: lane for lane in lanes}
+
+    def _blocked(self, lane: Lane) -> bool:
+        if lane.running >= lane.concurrency:
+            return True
+        for higher in self.lanes:
+            if higher is lane:
+                return False
+            if higher.waiting:
+                return True
+        return False
+
+    def _dispatch(self):
+        for lane in self.lanes:
+            while lane.waiting and not self._blocked(lane):
+                waiter = lane.next_waiter()
+                if waiter is None:
+                    break
+                lane.running += 1
+                waiter.set_result(None)
+
+    async def acquire(self, lane_name: str, key: str) -> Ticket:
+        lane = self._by_name[lane_name]
+        if not lane.waiting and not self._blocked(lane):
+            lane.running += 1
+            lane.admitted.inc()
+            lane.queue_wait.observe(0)
+            return Ticket(self, lane)
+        if lane.waiting >= lane.max_queue:
+            lane.shed.inc()
+            raise overloaded(503, f"server busy, {lane.name} queue is full",
+                             lane.retry_after())
+        if lane.queued(key) >= lane.max_queue_per_key:
+            lane.shed.inc()
+            raise overloaded(429, f"too many {lane.name} requests queued",
+                             lane.retry_after())
+
+        start = time.monotonic()
+        waiter = lane.enqueue(key)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), lane.timeout)
+        except asyncio.TimeoutError:
+            lane.dequeue(key, waiter)
+            if not waiter.done():
+                waiter.cancel()
+                #lower lanes may go on now
+                self._dispatch()
+                lane.shed.inc()
+                raise overloaded(
+                    503, f"server busy, timed out in {lane.name} queue",
+                    lane.retry_after())
+        except BaseException:
+            #client went away, give the slot back if it was just granted
+            lane.dequeue(key, waiter)
+            if waiter.done() and not waiter.cancelled():
+                self.release(Ticket(self, lane))
+            else:
+                waiter.cancel()
+                self._dispatch()
+            raise
+        lane.admitted.inc()
+        lane.queue_wait.observe(time.monotonic() - start)
+        return Ticket(self, lane)
+
+    def release(self, ticket: Ticket):
+        lane = ticket.lane
+        lane.running -= 1
+        lane.service_time = (0.8 * lane.service_time + 0.2 *
+                             (time.monotonic() - ticket.start))
+        self._dispatch()
+
+    @asynccontextmanager
+    async def admit(self, lane_name: str, key: str):
+        ticket = await self.acquire(lane_name, key)
+        try:
+            yield ticket
+        finally:
+            ticket.release()
+
+
+class JobSlot(object):
+
+    def __init__(self, slots: BoundedSemaphore):
+        self._slots = slots
+        self._lock = Lock()
+        self._released = False
+
+    def release(self):
+        """
+        called when the agent thread exits, or when it could not start.
+        safe to call more than once and from any thread
+        """
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        self._slots.release()
+
+
+class JobSlots(object):
+    """
+    caps the agent threads of /dev and /cover, they keep running long
+    after the request returned the task id
+    """
+
+    def __init__(self, limit: int):
+        self._slots = BoundedSemaphore(limit)
+        self.shed = metrics.counter("admission.jobs.running_full")
+
+    def acquire(self) -> JobSlot:
+        if not self._slots.acquire(blocking=False):
+            self.shed.inc()
+            raise overloaded(503, "too many running tasks",
+                             ADMIT_JOB_RETRY_AFTER)
+        return JobSlot(self._slots)
+
+
+def run_then(target: Callable, on_exit: Optional[Callable]) -> Callable:
+    """
+    thread target which calls on_exit once target returned or failed
+    """
+
+    def run():
+        try:
+            target()
+        finally:
+            if on_exit is not None:
+                on_exit()
+
+    return run
+
+
+admission = AdmissionController([
+    Lane(name, **{
+        k: _lane_env(name, k, v)
+        for k, v in config.items()
+    }) for name, config in LANES.items()
+])
+job_slots = JobSlots(ADMIT_MAX_RUNNING_JOBS)
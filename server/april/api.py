@@ -1,36 +1,78 @@
+import asyncio
 import json
 import os
+import tempfile
 from contextlib import asynccontextmanager
-from typing import List, Optional
-
+from threading import Lock
+from typing import Callable, Dict, List, Optional
+
+import chunker
+import executor
+import ingest
+import llm_client
+import metrics
+import unidiff
 import uvicorn
+from admission import admission, job_slots
 from cover import gen_cover_history_data, handle_cover, handle_cover_task
 from fastapi import Depends, FastAPI, HTTPException, Request, status
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse, Response, StreamingResponse
-from index import QueryLint, suppported_topics
+from index import QueryLint, suppported_topics, templates, topic_catalog
 from issue import gen_history_data, handle_prompt, handle_task
+from lint_cache import lint_cache
 from logger import init_logger
-from pydantic import BaseModel
+from prompt_budget import PromptTooLarge, plan_prompt
+from pydantic import BaseModel, Field
 from rag import RagDocument
+from ratelimit import backend_limiter
+from router import Attempt, Route, model_router
+from singleflight import SingleFlight
+from starlette.background import BackgroundTask
 
 logger = init_logger(__name__)
 
 
 def veriy_header(request: Request):
-    if request.headers.get("Authorization") != os.getenv("API_KEY"):
+    #API_KEYS=key1,key2... gives each client its own key, requests are
+    #queued fairly between the keys
+    keys = [key for key in os.getenv("API_KEYS", "").split(",") if key]
+    if not keys:
+        keys = [os.getenv("API_KEY")]
+    if request.headers.get("Authorization") not in keys:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
                             detail="Incorrect API key",
                             headers={"WWW-Authenticate": "Basic"})
 
 
+def client_key(request: Request) -> str:
+    return request.headers.get("Authorization") or ""
+
+
+def lane(name: str):
+    """
+    dependency admitting the request to an admission lane, the slot is
+    held until the handler returns
+    """
+
+    async def admit(request: Request):
+        async with admission.admit(name, client_key(request)):
+            yield
+
+    return admit
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Load the ML model
     logger.info("checking environment...")
+    logger.info(f"executors: cpu={executor.CPU_WORKERS} "
+                f"io={executor.IO_WORKERS}")
     yield
     # Clean up the ML models and release the resources
     logger.info("quiting...")
+    executor.shutdown()
+    llm_client.close()
 
 
 app = FastAPI(lifespan=lifespan, logger=logger)
@@ -53,6 +95,15 @@ async def supported_topics() -> Response:
                         content={"topics": suppported_topics()})
 
 
+@app.get("/metrics", dependencies=[Depends(veriy_header)])
+async def get_metrics() -> Response:
+    """
+    runtime counters and histograms, e.g.
+    lint.calls/lint.coalesced: lint LLM calls and how many were coalesced
+    """
+    return JSONResponse(status_code=200, content=metrics.snapshot())
+
+
 class RegisterRagRequest(BaseModel):
     doc: str
     topic: str
@@ -60,14 +111,19 @@ class RegisterRagRequest(BaseModel):
 
 
 class RegisterRagResponse(BaseModel):
-    pass
+    chunks: int = 0
+    # chunks not stored, their content is already indexed in the topic
+    duplicates: List[Dict] = []
 
 
-@app.post("/rag", dependencies=[Depends(veriy_header)])
+@app.post("/rag", dependencies=[Depends(veriy_header), Depends(lane("batch"))])
 async def register_doc(request: RegisterRagRequest) -> RegisterRagResponse:
     rag = RagDocument()
-    rag.register_doc(request.doc, request.topic, request.document_name)
-    return RegisterRagResponse()
+    # splitting and embedding are CPU bound
+    report = await executor.run_cpu(rag.register_doc, request.doc,
+                                    request.topic, request.document_name)
+    topic_catalog.add(request.topic)
+    return RegisterRagResponse(**report)
 
 
 class DeleteRagRequest(BaseModel):
@@ -79,13 +135,132 @@ class DeleteRagResponse(BaseModel):
     pass
 
 
-@app.post("/delete-rag", dependencies=[Depends(veriy_header)])
+@app.post("/delete-rag",
+          dependencies=[Depends(veriy_header),
+                        Depends(lane("batch"))])
 async def delete_doc(request: DeleteRagRequest) -> DeleteRagResponse:
     rag = RagDocument()
-    rag.delete_doc(request.topic, request.document_name)
+    await executor.run_io(rag.delete_doc, request.topic, request.document_name)
+    topic_catalog.invalidate()
     return DeleteRagResponse()
 
 
+class RagDocumentInfo(BaseModel):
+    topic: str
+    document_name: str
+
+
+class RagDocsResponse(BaseModel):
+    documents: List[RagDocumentInfo]
+    # cursor of the next page, None after the last one
+    next_cursor: Optional[str] = None
+    # counted for the first page, the one without cursor
+    total_documents: Optional[int] = None
+    total_chunks: Optional[int] = None
+
+
+@app.get("/rag/docs", dependencies=[Depends(veriy_header)])
+async def list_docs(cursor: Optional[str] = None,
+                    limit: int = 20,
+                    topic: Optional[str] = None) -> RagDocsResponse:
+    """
+    one page of the RAG documents, of topic when set:
+        /rag/docs?limit=20 then /rag/docs?limit=20&cursor=<next_cursor>
+    """
+    if not 0 < limit <= 100:
+        raise HTTPException(status_code=400,
+                            detail="limit must be between 1 and 100")
+    rag = RagDocument()
+    page = await executor.run_io(rag.list_docs, topic, cursor, limit)
+    return RagDocsResponse(**page)
+
+
+class RagPreviewResponse(BaseModel):
+    content: str
+
+
+@app.get("/rag/docs/preview", dependencies=[Depends(veriy_header)])
+async def preview_doc(topic: str,
+                      document_name: str,
+                      chars: int = 500) -> RagPreviewResponse:
+    rag = RagDocument()
+    try:
+        content = await executor.run_io(rag.get_preview, topic, document_name,
+                                        chars)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"{e}")
+    return RagPreviewResponse(content=content)
+
+
+class BulkRagResponse(BaseModel):
+    job_id: str
+
+
+# bytes of an upload buffered per disk write
+UPLOAD_WRITE_BYTES = 1 << 20
+
+
+@app.post("/rag/bulk",
+          dependencies=[Depends(veriy_header),
+                        Depends(lane("batch"))])
+async def register_bulk(topic: str, request: Request) -> BulkRagResponse:
+    """
+    index every file of a repository into topic. the body is a zip or
+    tar(.gz) archive of the files:
+        curl -H "Authorization: $API_KEY" --data-binary @repo.tar.gz
+            "$HOST/rag/bulk?topic=my-repo"
+    the files are ingested in background, see /rag/bulk/{job_id}
+    """
+    slot = job_slots.acquire()
+    path = None
+    try:
+        fd, path = tempfile.mkstemp(prefix="upload-")
+        size = 0
+        with os.fdopen(fd, "wb") as f:
+            #the disk writes run on the io executor, not the event loop
+            buffer = bytearray()
+            async for data in request.stream():
+                size += len(data)
+                if size > ingest.INGEST_MAX_UPLOAD_BYTES:
+                    raise HTTPException(status_code=413,
+                                        detail="archive too large")
+                buffer += data
+                if len(buffer) >= UPLOAD_WRITE_BYTES:
+                    await executor.run_io(f.write, bytes(buffer))
+                    buffer.clear()
+            await executor.run_io(f.write, bytes(buffer))
+
+        def on_exit():
+            slot.release()
+            topic_catalog.add(topic)
+            topic_catalog.invalidate()
+
+        # the archive is removed by the job
+        job_id = ingest.start_archive_job(topic, path, on_exit)
+    except BaseException:
+        #the upload is only removed by the job once it started
+        slot.release()
+        if path is not None and os.path.exists(path):
+            os.remove(path)
+        raise
+    return BulkRagResponse(job_id=job_id)
+
+
+class BulkRagStatus(BaseModel):
+    status: str
+    report: Optional[Dict] = None
+    error: Optional[str] = None
+
+
+@app.get("/rag/bulk/{job_id}", dependencies=[Depends(veriy_header)])
+async def get_bulk_status(job_id: str) -> BulkRagStatus:
+    job = ingest.get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=400,
+                            detail=f"The job {job_id} does not exist")
+    return BulkRagStatus(status=job.status, report=job.report, error=job.error)
+
+
 class DevRequest(BaseModel):
     prompt: str
     repo: str
@@ -98,7 +273,7 @@ class DevResponse(BaseModel):
     task_id: str
 
 
-@app.post("/dev", dependencies=[Depends(veriy_header)])
+@app.post("/dev", dependencies=[Depends(veriy_header), Depends(lane("jobs"))])
 async def dev_task(request: DevRequest) -> DevResponse:
     """
     API for handle "dev" sub command
@@ -112,7 +287,15 @@ async def dev_task(request: DevRequest) -> DevResponse:
     """
     logger.debug(request)
 
-    return DevResponse(task_id=handle_prompt(request))
+    #the slot is released when the agent thread exits
+    slot = job_slots.acquire()
+    try:
+        # handle_prompt clones the repo synchronously
+        task_id = await executor.run_io(handle_prompt, request, slot.release)
+    except Exception:
+        slot.release()
+        raise
+    return DevResponse(task_id=task_id)
 
 
 class TaskStatus(BaseModel):
@@ -135,6 +318,16 @@ async def getHistory(taskId, request: Request) -> StreamingResponse:
     return StreamingResponse(gen_history_data(taskId), media_type="text/plain")
 
 
+# chunked lint: lines per chunk, lines repeated between two chunks and
+# lines of the file header (imports...) shared by every chunk
+LINT_CHUNK_LINES = int(os.getenv("LINT_CHUNK_LINES", "200"))
+LINT_CHUNK_OVERLAP = int(os.getenv("LINT_CHUNK_OVERLAP", "10"))
+LINT_CHUNK_HEADER_LINES = int(os.getenv("LINT_CHUNK_HEADER_LINES", "30"))
+# smallest chunk_lines of a request, most chunks of one file
+LINT_MIN_CHUNK_LINES = int(os.getenv("LINT_MIN_CHUNK_LINES", "20"))
+LINT_MAX_CHUNKS = int(os.getenv("LINT_MAX_CHUNKS", "16"))
+
+
 class LintRequest(BaseModel):
     topic: str
     code: str
@@ -147,6 +340,23 @@ class LintRequest(BaseModel):
     ollama:llama3
     """
     model: str
+    """
+    chunked: split big files at function/class boundaries and lint the
+    chunks in parallel. chunk_lines overrides LINT_CHUNK_LINES, the chunks
+    are made larger when there would be more than LINT_MAX_CHUNKS.
+    """
+    chunked: bool = False
+    chunk_lines: Optional[int] = Field(default=None, ge=LINT_MIN_CHUNK_LINES)
+    """
+    policy: which backends the request may be routed to
+        pinned: only the backend of the model org
+        prefer: the backend of the model org, others if it fails, default
+            for openai. the default of a local org is pinned: its code is
+            only sent to another machine with prefer or fastest
+        fastest: the fastest healthy backend, default for model "auto"
+        local: the fastest healthy backend on our own machines
+    """
+    policy: Optional[str] = None
 
 
 class LintResponse(BaseModel):
@@ -165,26 +375,108 @@ class LintResponse(BaseModel):
     ollama:llama3
     """
     model: str
+    """
+    cached is True if the result was served from the lint cache
+    """
+    cached: bool = False
+    """
+    prompt_tokens: upper bound of the prompt size, counted before sending.
+    estimated_cost: pre-flight estimate in USD, 0 if no LLM call was made.
+    """
+    prompt_tokens: Optional[int] = None
+    estimated_cost: Optional[float] = None
 
 
-@app.post("/lint", dependencies=[Depends(veriy_header)])
-async def query(req: LintRequest) -> LintResponse:
+lint_flight = SingleFlight("lint")
+cache_hits = metrics.counter("lint.cache_hits")
+
+
+async def lint_code(topic: str,
+                    code: str,
+                    model: str,
+                    on_risk: Optional[Callable[[Dict], None]] = None,
+                    policy: Optional[str] = None) -> LintResponse:
     """
-    test: curl -X POST "http://127.0.0.1:8000/lint" -H "Content-Type: application/json" -d '{"topic": "your_topic", "code": "your_code"}'
-    request: Lint
-    response: {}
+    lint one piece of code, shared by /lint, /lint/stream and /lint/batch
+    on_risk is called for every risk as soon as it is available, it could
+    be called from a worker thread.
+    policy chooses the backends model may be routed to, see router.POLICIES
     """
-    logger.debug(LintRequest)
     try:
-        model = req.model
-        ai = "openai"
-        #FIXME: QueryLint should support choosing models
-        llm_response = QueryLint(ai).query_lint(req.topic, req.code)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"{e}")
-
-    response = LintResponse(model="openai:gpt3.5", plain_risks="", risks=[])
-    if model.startswith("openai"):
+        routes = model_router.candidates(model, policy)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"{e}")
+    #fail before any network call if the code does not fit
+    plans = {}
+    too_large = None
+    for route in routes:
+        try:
+            plans[route] = plan_prompt(route.model, templates[route.backend],
+                                       code)
+        except PromptTooLarge as e:
+            too_large = e
+    routes = [route for route in routes if route in plans]
+    if not routes:
+        if too_large is not None:
+            raise HTTPException(status_code=413, detail=f"{too_large}")
+        raise HTTPException(status_code=503,
+                            detail=f"no backend available for {model}")
+
+    key = lint_cache.make_key(code, topic, f"{model}/{policy}",
+                              templates[routes[0].backend])
+    value = lint_cache.get(key, topic)
+    cached = value is not None
+    shared = False
+    if cached:
+        cache_hits.inc()
+        answer = json.loads(value)
+    else:
+
+        async def call(attempt: Attempt) -> str:
+            route = attempt.route
+            await backend_limiter(route.backend).acquire()
+            emit = None
+            if on_risk is not None:
+                #the client got a risk, failing over would repeat it
+                def emit(risk: Dict):
+                    attempt.committed = True
+                    on_risk(risk)
+
+            lint = QueryLint(route.backend, route.model)
+            try:
+                return await executor.run_io(lint.query_lint, topic, code,
+                                             emit, plans[route].docs_budget)
+            finally:
+                #rank the backends by their speed, not by our queues
+                attempt.latency = lint.latency
+
+        async def compute() -> Dict:
+            #the fastest healthy backend first, the next one if it fails
+            route, llm_response = await model_router.route(routes, call)
+            return {
+                "backend": route.backend,
+                "model": route.model,
+                "response": llm_response
+            }
+
+        try:
+            #identical requests in flight share one LLM call
+            answer, shared = await lint_flight.do(key, compute)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"{e}")
+
+    ai = answer["backend"]
+    llm_response = answer["response"]
+    plan = plans.get(Route(ai, answer["model"]), plans[routes[0]])
+    response = LintResponse(model=f"{ai}:{answer['model']}",
+                            plain_risks="",
+                            risks=[],
+                            cached=cached,
+                            prompt_tokens=plan.max_prompt_tokens,
+                            estimated_cost=0.0)
+    if not cached and not shared:
+        response.estimated_cost = plan.estimated_cost()
+    if ai == "openai":
         #llm_respnose is json-encode string returned from openai
         #response = {"risks":[{"which_part_of_code":"here", "reason":"why", "fix":"how"}, {"which_part_of_code":"here1", "reason":"why2", "fix":"how2"}]}
         response.backend = ai
@@ -195,9 +487,324 @@ async def query(req: LintRequest) -> LintResponse:
         response.backend = ai
         response.plain_risks = llm_response
         response.risks = []
+    if not cached and not shared:
+        #only cache answers which could be parsed
+        lint_cache.put(key, topic, json.dumps(answer))
+    elif on_risk is not None:
+        #nothing was streamed, replay the cached or shared risks
+        decoder = QueryLint.risk_decoder(ai)
+        for risk in decoder.feed(llm_response) + decoder.close():
+            on_risk(risk)
     return response
 
 
+def merge_results(response: LintResponse,
+                  results: List[LintResponse]) -> LintResponse:
+    """
+    merge the results of several pieces of one file into response
+    """
+    response.risks = chunker.merge_risks([r.risks for r in results])
+    response.plain_risks = "\n\n".join(r.plain_risks for r in results
+                                       if r.plain_risks)
+    response.cached = all(r.cached for r in results)
+    response.prompt_tokens = sum(r.prompt_tokens or 0 for r in results)
+    response.estimated_cost = sum(r.estimated_cost or 0.0 for r in results)
+    return response
+
+
+async def lint_chunked(topic: str,
+                       code: str,
+                       model: str,
+                       chunk_lines: Optional[int] = None,
+                       on_risk: Optional[Callable[[Dict], None]] = None,
+                       policy: Optional[str] = None) -> LintResponse:
+    """
+    split code at function/class boundaries, lint the chunks concurrently
+    and merge the results into one LintResponse
+    """
+    units = chunker.split_units(code)
+    header_lines = 0
+    if len(units) > 1:
+        header_lines = min(units[0].end_line, LINT_CHUNK_HEADER_LINES)
+    #one request makes at most LINT_MAX_CHUNKS LLM calls
+    max_lines = max(chunk_lines or LINT_CHUNK_LINES,
+                    -(-len(code.splitlines()) // LINT_MAX_CHUNKS))
+    while True:
+        chunks = chunker.split_code(code, max_lines, LINT_CHUNK_OVERLAP,
+                                    header_lines)
+        if len(chunks) <= LINT_MAX_CHUNKS:
+            break
+        max_lines *= 2
+    if len(chunks) == 1:
+        return await lint_code(topic, code, model, on_risk, policy)
+    logger.info(f"lint {len(code)} bytes in {len(chunks)} chunks")
+
+    chunk_on_risk = None
+    if on_risk is not None:
+        #overlapping chunks report the same risk, only stream it once
+        seen_lock = Lock()
+        seen = set()
+
+        def chunk_on_risk(risk: Dict):
+            key = chunker.risk_key(risk)
+            with seen_lock:
+                if key in seen:
+                    return
+                seen.add(key)
+            on_risk(risk)
+
+    results = await asyncio.gather(*[
+        lint_code(topic, chunk.text, model, chunk_on_risk, policy)
+        for chunk in chunks
+    ])
+    return merge_results(results[0].model_copy(), results)
+
+
+@app.post("/lint",
+          dependencies=[Depends(veriy_header),
+                        Depends(lane("interactive"))])
+async def query(req: LintRequest) -> LintResponse:
+    """
+    test: curl -X POST "http://127.0.0.1:8000/lint" -H "Content-Type: application/json" -d '{"topic": "your_topic", "code": "your_code"}'
+    request: Lint
+    response: {}
+    """
+    logger.debug(LintRequest)
+    if req.chunked:
+        return await lint_chunked(req.topic,
+                                  req.code,
+                                  req.model,
+                                  req.chunk_lines,
+                                  policy=req.policy)
+    return await lint_code(req.topic, req.code, req.model, policy=req.policy)
+
+
+@app.post("/lint/stream", dependencies=[Depends(veriy_header)])
+async def lint_stream(req: LintRequest, request: Request) -> StreamingResponse:
+    """
+    same as /lint, but each risk is sent as soon as it is decoded from the
+    LLM token stream. "Accept: text/event-stream" gives server sent events,
+    otherwise the events are sent as ndjson:
+        {"event": "risk", "risk": {"which_part_of_code", "reason", "fix"}}
+        ...
+        {"event": "done", "result": LintResponse}
+    or {"event": "error", "detail": "..."} if lint failed.
+    """
+    logger.debug(req)
+    #the slot is held until the stream ends
+    ticket = await admission.acquire("interactive", client_key(request))
+    sse = "text/event-stream" in request.headers.get("accept", "")
+    loop = asyncio.get_running_loop()
+    events: asyncio.Queue = asyncio.Queue()
+
+    def push(event: Dict):
+        #risks arrive from the worker thread
+        loop.call_soon_threadsafe(events.put_nowait, event)
+
+    def on_risk(risk: Dict):
+        push({"event": "risk", "risk": risk})
+
+    async def run():
+        try:
+            if req.chunked:
+                result = await lint_chunked(req.topic, req.code, req.model,
+                                            req.chunk_lines, on_risk,
+                                            req.policy)
+            else:
+                result = await lint_code(req.topic, req.code, req.model,
+                                         on_risk, req.policy)
+            push({"event": "done", "result": result.model_dump()})
+        except HTTPException as e:
+            push({"event": "error", "detail": str(e.detail)})
+        except Exception as e:
+            push({"event": "error", "detail": f"{e}"})
+
+    async def gen_events():
+        task = asyncio.create_task(run())
+        try:
+            while True:
+                event = await events.get()
+                data = json.dumps(event)
+                if sse:
+                    yield f"event: {event['event']}\ndata: {data}\n\n"
+                else:
+                    yield data + "\n"
+                if event["event"] != "risk":
+                    return
+        finally:
+            task.cancel()
+            ticket.release()
+
+    media_type = "text/event-stream" if sse else "application/x-ndjson"
+    #the background task releases the slot if the stream never started
+    return StreamingResponse(gen_events(),
+                             media_type=media_type,
+                             background=BackgroundTask(ticket.arelease))
+
+
+# lines of unchanged code linted around each changed hunk
+LINT_DIFF_CONTEXT = int(os.getenv("LINT_DIFF_CONTEXT", "10"))
+
+
+class LintDiffRequest(BaseModel):
+    topic: str
+    """
+    content of the file before the change
+    """
+    base: str
+    """
+    unified diff of the file against base, e.g. git diff -- file
+    """
+    diff: str
+    """
+    same format as LintRequest.model
+    """
+    model: str
+    context_lines: Optional[int] = None
+    """
+    same as LintRequest.policy
+    """
+    policy: Optional[str] = None
+
+
+class LintHunkResult(BaseModel):
+    """
+    lines of the new file which were linted, 1 based and inclusive
+    """
+    start_line: int
+    end_line: int
+    risks: List
+    plain_risks: str
+    cached: bool
+
+
+class LintDiffResponse(LintResponse):
+    hunks: List[LintHunkResult] = []
+
+
+@app.post("/lint/diff",
+          dependencies=[Depends(veriy_header),
+                        Depends(lane("interactive"))])
+async def lint_diff(req: LintDiffRequest) -> LintDiffResponse:
+    """
+    incremental lint: only the changed hunks, with some lines of context,
+    are sent to the LLM. hunks are cached by their content, so a small
+    fixup commit only re-lints the lines which actually changed.
+    """
+    try:
+        hunks = unidiff.parse_hunks(req.diff)
+        new_lines, changed = unidiff.apply_hunks(req.base, hunks)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"invalid diff: {e}")
+    context = LINT_DIFF_CONTEXT
+    if req.context_lines is not None:
+        context = max(req.context_lines, 0)
+    regions = unidiff.expand_regions(changed, context, len(new_lines))
+    regions = [(start, end) for start, end in regions if start < end]
+    logger.info(f"lint diff: {len(hunks)} hunks, {len(regions)} regions")
+
+    results = await asyncio.gather(*[
+        lint_code(req.topic,
+                  "\n".join(new_lines[start:end]) + "\n",
+                  req.model,
+                  policy=req.policy) for start, end in regions
+    ])
+    response = LintDiffResponse(model=req.model, plain_risks="", risks=[])
+    if results:
+        response = LintDiffResponse(**results[0].model_dump())
+    merge_results(response, results)
+    response.hunks = [
+        LintHunkResult(start_line=start + 1,
+                       end_line=end,
+                       risks=r.risks,
+                       plain_risks=r.plain_risks,
+                       cached=r.cached)
+        for (start, end), r in zip(regions, results)
+    ]
+    return response
+
+
+# upper bound of files linted at the same time by one batch request
+LINT_BATCH_CONCURRENCY = int(os.getenv("LINT_BATCH_CONCURRENCY", "8"))
+
+
+class LintFile(BaseModel):
+    path: str
+    code: str
+
+
+class LintBatchRequest(BaseModel):
+    topic: str
+    files: List[LintFile]
+    """
+    same format as LintRequest.model
+    """
+    model: str
+    """
+    optional, lower the concurrency of this batch.
+    it can not go beyond LINT_BATCH_CONCURRENCY
+    """
+    concurrency: Optional[int] = None
+    """
+    same as LintRequest.policy
+    """
+    policy: Optional[str] = None
+
+
+class LintBatchResult(BaseModel):
+    """
+    one line of the /lint/batch response, either result or error is set
+    """
+    path: str
+    result: Optional[LintResponse] = None
+    error: Optional[str] = None
+
+
+@app.post("/lint/batch", dependencies=[Depends(veriy_header)])
+async def lint_batch(req: LintBatchRequest,
+                     request: Request) -> StreamingResponse:
+    """
+    lint many files concurrently, the response is streamed as ndjson:
+    one LintBatchResult per line, in the order the files finish.
+    """
+    logger.debug(f"lint batch of {len(req.files)} files")
+    #the slot is held until the stream ends
+    ticket = await admission.acquire("batch", client_key(request))
+    concurrency = LINT_BATCH_CONCURRENCY
+    if req.concurrency:
+        concurrency = max(1, min(req.concurrency, concurrency))
+    sem = asyncio.Semaphore(concurrency)
+
+    async def lint_file(f: LintFile) -> LintBatchResult:
+        async with sem:
+            try:
+                result = await lint_code(req.topic,
+                                         f.code,
+                                         req.model,
+                                         policy=req.policy)
+                return LintBatchResult(path=f.path, result=result)
+            except HTTPException as e:
+                return LintBatchResult(path=f.path, error=str(e.detail))
+            except Exception as e:
+                return LintBatchResult(path=f.path, error=f"{e}")
+
+    async def gen_results():
+        tasks = [asyncio.create_task(lint_file(f)) for f in req.files]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                item = await next_done
+                yield item.model_dump_json() + "\n"
+        finally:
+            #client went away, stop linting the rest
+            for t in tasks:
+                t.cancel()
+            ticket.release()
+
+    return StreamingResponse(gen_results(),
+                             media_type="application/x-ndjson",
+                             background=BackgroundTask(ticket.arelease))
+
+
 class CoverRequest(BaseModel):
     repo: str
     source_file: str
@@ -210,7 +817,9 @@ class CoverResponse(BaseModel):
     task_id: str
 
 
-@app.post("/cover", dependencies=[Depends(veriy_header)])
+@app.post("/cover",
+          dependencies=[Depends(veriy_header),
+                        Depends(lane("jobs"))])
 async def cover(request: CoverRequest) -> CoverResponse:
     """
     API for handle "cover" sub command
@@ -220,7 +829,14 @@ async def cover(request: CoverRequest) -> CoverResponse:
     """
     logger.debug(request)
 
-    return CoverResponse(task_id=handle_cover(request))
+    #the slot is released when the agent thread exits
+    slot = job_slots.acquire()
+    try:
+        task_id = await executor.run_io(handle_cover, request, slot.release)
+    except Exception:
+        slot.release()
+        raise
+    return CoverResponse(task_id=task_id)
 
 
 class TaskStatus(BaseModel):
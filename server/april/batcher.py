@@ -0,0 +1,91 @@
+import queue
+import time
+from concurrent.futures import Future
+from threading import Lock, Thread
+from typing import Callable, List, Optional
+
+import metrics
+from logger import init_logger
+
+logger = init_logger(__name__)
+
+_BATCH_BUCKETS = [1, 2, 4, 8, 16, 32, 64, 128]
+_WAIT_BUCKETS = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.5, 1]
+
+
+class MicroBatcher(object):
+    """
+    gathers the items submitted by concurrent callers for up to max_wait
+    seconds, or until max_batch items arrived, and hands them to fn in one
+    call. fn takes a list of items and returns the list of their results.
+    {name}.batch_size and {name}.wait (seconds a caller waited for the
+    batch to start) are exposed on /metrics.
+    """
+
+    def __init__(self,
+                 name: str,
+                 fn: Callable[[List], List],
+                 max_batch: int = 32,
+                 max_wait: float = 0.005):
+        self.name = name
+        self.fn = fn
+        self.max_batch = max(max_batch, 1)
+        self.max_wait = max_wait
+        self._queue: queue.Queue = queue.Queue()
+        self._lock = Lock()
+        self._thread: Optional[Thread] = None
+        self.batch_size = metrics.histogram(f"{name}.batch_size",
+                                            _BATCH_BUCKETS)
+        self.wait = metrics.histogram(f"{name}.wait", _WAIT_BUCKETS)
+
+    def _start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = Thread(target=self._loop,
+                                  name=f"{self.name}-batcher",
+                                  daemon=True)
+            self._thread.start()
+
+    def submit(self, item) -> Future:
+        self._start()
+        future: Future = Future()
+        self._queue.put((item, future, time.monotonic()))
+        return future
+
+    def call(self, item):
+        """
+        block until the batch of item was processed, return its result
+        """
+        return self.submit(item).result()
+
+    def _gather(self) -> List:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._gather()
+            start = time.monotonic()
+            self.batch_size.observe(len(batch))
+            for _, _, enqueued in batch:
+                self.wait.observe(start - enqueued)
+            try:
+                results = self.fn([item for item, _, _ in batch])
+            except Exception as e:
+                logger.warning(f"{self.name}: batch of {len(batch)} "
+                               f"failed: {e!r}")
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future, _), result in zip(batch, results):
+                future.set_result(result)
@@ -0,0 +1,138 @@
+import re
+from dataclasses import dataclass
+from typing import Dict, List
+
+# Structure aware splitting of source code.
+# We don't parse the languages, a top level definition is a line without
+# indentation which starts a function/class/type in one of the languages
+# we usually lint (python, rust, go, c/c++, java, js/ts).
+_DEFINITION_RE = re.compile(
+    r"^(?!(?:from|import|return|if|else|for|while|use)\b)(?:"
+    r"(?:async\s+)?def\s|class\s|@"  # python, decorators stick to the def
+    r"|(?:pub(?:\([^)]*\))?\s+)?(?:async\s+|unsafe\s+|const\s+)*"
+    r"(?:fn|impl|struct|enum|trait|mod)\s"  # rust
+    r"|func\s|type\s"  # go
+    r"|(?:export\s+)?(?:default\s+)?(?:async\s+)?(?:function|class|interface)\s"
+    r"|(?:public|private|protected|static|final|abstract|template)\b"
+    r"|[A-Za-z_][\w:<>,\s\*&]*\s[\*&]*[A-Za-z_][\w:]*\s*\([^;]*$"  # c/c++
+    r")")
+
+
+@dataclass
+class CodeChunk:
+    # 0 based, end excluded
+    start_line: int
+    end_line: int
+    text: str
+
+
+def _is_boundary(lines: List[str], idx: int) -> bool:
+    line = lines[idx]
+    if not line or line[0].isspace():
+        return False
+    if not _DEFINITION_RE.match(line):
+        return False
+    # decorators / attributes belong to the following definition
+    if idx > 0 and (lines[idx - 1].startswith("@")
+                    or lines[idx - 1].startswith("#[")):
+        return False
+    return True
+
+
+def split_units(code: str) -> List[CodeChunk]:
+    """
+    split code into top level units, the first unit is the header
+    (imports, module docs ...) before the first definition.
+    comments right above a definition go with the definition.
+    """
+    lines = code.splitlines(keepends=True)
+    starts = [0]
+    for idx in range(len(lines)):
+        if idx == 0 or not _is_boundary(lines, idx):
+            continue
+        start = idx
+        # pull the comment block / attributes above the definition
+        while start - 1 > starts[-1] and lines[start - 1].lstrip().startswith(
+            ("#", "//", "/*", "*", "@")):
+            start -= 1
+        starts.append(start)
+    starts.append(len(lines))
+    units = []
+    for begin, end in zip(starts, starts[1:]):
+        if begin < end:
+            units.append(CodeChunk(begin, end, "".join(lines[begin:end])))
+    return units
+
+
+def split_code(code: str,
+               max_lines: int,
+               overlap_lines: int = 0,
+               header_lines: int = 0) -> List[CodeChunk]:
+    """
+    pack top level units into chunks of at most max_lines lines.
+    a unit larger than max_lines is cut at max_lines.
+    overlap_lines of the previous chunk are repeated at the beginning of
+    the next chunk; the first header_lines lines of the file (imports ...)
+    are prepended to every chunk after the first, as shared context.
+    """
+    if max_lines < 1:
+        raise ValueError(f"max_lines must be positive, got {max_lines}")
+    lines = code.splitlines(keepends=True)
+    if len(lines) <= max_lines:
+        return [CodeChunk(0, len(lines), code)]
+
+    pieces = []
+    for unit in split_units(code):
+        for begin in range(unit.start_line, unit.end_line, max_lines):
+            pieces.append((begin, min(begin + max_lines, unit.end_line)))
+
+    ranges = []
+    begin, end = pieces[0]
+    for b, e in pieces[1:]:
+        if e - begin <= max_lines:
+            end = e
+        else:
+            ranges.append((begin, end))
+            begin, end = b, e
+    ranges.append((begin, end))
+
+    header = "".join(lines[:header_lines])
+    chunks = []
+    for i, (begin, end) in enumerate(ranges):
+        if i > 0:
+            begin = max(begin - overlap_lines, 0)
+        text = "".join(lines[begin:end])
+        if i > 0 and header and begin >= header_lines:
+            text = header + "...\n" + text
+        chunks.append(CodeChunk(begin, end, text))
+    return chunks
+
+
+def _normalize(text: str) -> str:
+    return " ".join(text.split()).lower()
+
+
+def risk_key(risk: Dict) -> tuple:
+    """
+    two risks with the same key are the same finding
+    """
+    return (_normalize(str(risk.get("which_part_of_code", ""))),
+            _normalize(str(risk.get("reason", "")))[:80])
+
+
+def merge_risks(risk_lists: List[List[Dict]]) -> List[Dict]:
+    """
+    merge the risks of every chunk, keeping the order of the chunks.
+    overlapping chunks report the same code twice: risks on the same
+    code with the same reason are dropped.
+    """
+    seen = set()
+    merged = []
+    for risks in risk_lists:
+        for risk in risks:
+            key = risk_key(risk)
+            if key in seen:
+                continue
+            seen.add(key)
+            merged.append(risk)
+    return merged
@@ -1,40 +1,93 @@
-from haystack.components.embedders import (
-    SentenceTransformersDocumentEmbedder, SentenceTransformersTextEmbedder)
-from haystack.utils import ComponentDevice
-from haystack_integrations.document_stores.qdrant import QdrantDocumentStore
+import os
 
-# bydefault use the same index for RAG
-# we wil use topic for next version
+from embedding import (EmbeddingService, SharedDocumentEmbedder,
+                       SharedTextEmbedder)
+from embedding_cache import EMBED_CACHE_CAPACITY, EmbeddingCache
+from haystack_integrations.document_stores.qdrant import QdrantDocumentStore
+from local_store import (LocalDocumentStore, LocalEmbeddingRetriever,
+                         get_local_store)
+from partition import distinct_topics, ensure_payload_indexes
+from quantization import (ensure_quantized, new_embedding_retriever,
+                          store_options)
+from splitter import CodeAwareSplitter
+
+# the only RAG collection, a topic is a partition of it (see partition.py)
 INDEX_NAME = "documents"
 MODEL_ID = "WhereIsAI/UAE-Large-V1"
+# UAE-Large-V1 reads 512 tokens, chunks are kept below so they are
+# embedded entirely
+RAG_CHUNK_TOKENS = int(os.getenv("RAG_CHUNK_TOKENS", "480"))
+RAG_CHUNK_OVERLAP_TOKENS = int(os.getenv("RAG_CHUNK_OVERLAP_TOKENS", "48"))
+# qdrant: the server on 127.0.0.1:6333
+# local: in-process vector index under LOCAL_STORE_DIR, no service needed
+RAG_STORE = os.getenv("RAG_STORE", "qdrant")
+
+# the only copy of the embedding model in the process
+embedding_service = EmbeddingService(
+    MODEL_ID,
+    device="cpu",
+    cache=EmbeddingCache(MODEL_ID) if EMBED_CACHE_CAPACITY > 0 else None)
 
 
 def get_text_embedder():
     "this embedder is used for querying the document store"
-    return SentenceTransformersTextEmbedder(
-        model=MODEL_ID, device=ComponentDevice.from_str("cpu"))
+    return SharedTextEmbedder(embedding_service)
 
 
 """
-pipeline can not share the same component. so we have to create instance on the fly
+pipeline can not share the same component. so we have to create instance on the fly,
+they all use the model of embedding_service
 """
 
 
 def get_doc_embedder():
     "this embedder is used for writing documents to the document store"
-    return SentenceTransformersDocumentEmbedder(
-        model=MODEL_ID, device=ComponentDevice.from_str("cpu"))
+    return SharedDocumentEmbedder(embedding_service)
+
+
+def get_splitter():
+    "this splitter is used for documents before they are embedded"
+    return CodeAwareSplitter(embedding_service.count_tokens,
+                             max_tokens=RAG_CHUNK_TOKENS,
+                             overlap_tokens=RAG_CHUNK_OVERLAP_TOKENS)
 
 
-def get_document_store():
+def get_document_store(index: str = INDEX_NAME,
+                       write_batch_size: int = 100,
+                       return_embedding: bool = False):
     """
-    return the document store
+    return the document store of collection index, write_documents upserts
+    write_batch_size points per request. the documents read from the store
+    only carry their embedding with return_embedding.
+    the local store ignores write_batch_size and never returns embeddings.
     """
-    return QdrantDocumentStore(host="127.0.0.1",
-                               return_embedding=True,
-                               wait_result_from_api=True,
-                               embedding_dim=1024,
-                               index=INDEX_NAME)
+    if RAG_STORE == "local":
+        return get_local_store(index)
+    store = QdrantDocumentStore(host="127.0.0.1",
+                                return_embedding=return_embedding,
+                                wait_result_from_api=True,
+                                embedding_dim=1024,
+                                index=index,
+                                write_batch_size=write_batch_size,
+                                **store_options())
+    ensure_quantized(store)
+    ensure_payload_indexes(store.client, index)
+    return store
+
+
+def get_embedding_retriever(document_store, filters=None):
+    "dense retriever of the document store, one per pipeline"
+    if isinstance(document_store, LocalDocumentStore):
+        return LocalEmbeddingRetriever(document_store, filters)
+    return new_embedding_retriever(document_store, filters)
+
+
+def list_topics():
+    "the topics of the document store, the lint topics"
+    store = get_document_store()
+    if isinstance(store, LocalDocumentStore):
+        return store.topics()
+    return distinct_topics(store.client, INDEX_NAME)
 
 
 is_warm_up = False
@@ -43,8 +96,7 @@ is_warm_up = False
 def initialize():
     global is_warm_up
     if not is_warm_up:
-        SentenceTransformersDocumentEmbedder(
-            model=MODEL_ID, device=ComponentDevice.from_str("cpu")).warm_up()
+        embedding_service.warm_up()
         is_warm_up = True
 
 
@@ -7,6 +7,7 @@ from typing import Dict
 from urllib.parse import urlparse
 
 import utils
+from admission import run_then
 from cover_agent.CoverAgent import CoverAgent
 from cover_agent.version import __version__
 from fastapi import HTTPException
@@ -34,11 +35,18 @@ def add_task(task: Task):
 
 class Agent:
 
-    def __init__(self, repo_path, source_file_path, test_file_path, task):
+    def __init__(self,
+                 repo_path,
+                 source_file_path,
+                 test_file_path,
+                 task,
+                 on_exit=None):
         self.repo_path = repo_path
         self.source_file_path = source_file_path
         self.test_file_path = test_file_path
         self.task = task
+        # called when the agent thread exits
+        self.on_exit = on_exit
 
     def run(self):
         test_dir = os.path.dirname(self.test_file_path)
@@ -144,10 +152,10 @@ class Agent:
         logger.info(args)
 
         agent = CoverAgent(args, self.task)
-        Thread(target=agent.run).start()
+        Thread(target=run_then(agent.run, self.on_exit)).start()
 
 
-def handle_cover(request) -> str:
+def handle_cover(request, on_exit=None) -> str:
     new_task = Task("cover task")
     logger.info(f'new_task: {new_task.get_id()}')
     add_task(new_task)
@@ -177,7 +185,8 @@ def handle_cover(request) -> str:
     new_task.set_status(TaskStatus.RUNNING)
 
     try:
-        agent = Agent(repo_folder, source_file_path, test_file_path, new_task)
+        agent = Agent(repo_folder, source_file_path, test_file_path, new_task,
+                      on_exit)
         agent.run()
         new_task.set_cover_repo_dir(repo_folder)
         new_task.set_cover_test_file(test_file_path)
@@ -0,0 +1,362 @@
+import hashlib
+import os
+import re
+from dataclasses import asdict, dataclass, replace
+from threading import Lock
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from embedding_cache import normalize
+from haystack import Document, component
+from logger import init_logger
+from partition import all_of, update_meta
+from sparse_index import sparse_index
+
+logger = init_logger(__name__)
+
+# chunks whose estimated Jaccard similarity (of their 5-token shingles)
+# with an indexed chunk reaches DEDUP_THRESHOLD are near-duplicates.
+# 1 only drops exact duplicates.
+DEDUP_THRESHOLD = float(os.getenv("DEDUP_THRESHOLD", "0.9"))
+# 16 bands of 8 rows: pairs above 0.9 are compared with a probability
+# above 99.9%, pairs below 0.5 rarely are
+MINHASH_PERMUTATIONS = 128
+MINHASH_BANDS = 16
+SHINGLE_TOKENS = 5
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+
+
+class MinHasher(object):
+    """
+    MinHash signatures of the token shingles of a text
+    """
+
+    def __init__(self,
+                 permutations: int = MINHASH_PERMUTATIONS,
+                 shingle: int = SHINGLE_TOKENS,
+                 seed: int = 1):
+        self.shingle = shingle
+        #the signatures stay comparable across processes and restarts
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1,
+                             _MERSENNE_PRIME,
+                             size=permutations,
+                             dtype=np.uint64)
+        self.b = rng.randint(0,
+                             _MERSENNE_PRIME,
+                             size=permutations,
+                             dtype=np.uint64)
+
+    def signature(self, text: str) -> Optional[np.ndarray]:
+        """
+        None when the text is shorter than one shingle
+        """
+        tokens = _TOKEN_RE.findall(text)
+        if len(tokens) < self.shingle:
+            return None
+        shingles = {
+            " ".join(tokens[i:i + self.shingle])
+            for i in range(len(tokens) - self.shingle + 1)
+        }
+        digests = [
+            hashlib.blake2b(s.encode(), digest_size=4).digest()
+            for s in shingles
+        ]
+        hashes = np.frombuffer(b"".join(digests),
+                               dtype="<u4").astype(np.uint64)
+        #one universal hash per permutation, products wrap around
+        permuted = (np.outer(hashes, self.a) + self.b) % _MERSENNE_PRIME
+        return (permuted & _MAX_HASH).min(axis=0).astype(np.uint32)
+
+
+_hasher = MinHasher()
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(normalize(text).encode()).hexdigest()[:32]
+
+
+def band_keys(signature: np.ndarray, bands: int = MINHASH_BANDS) -> List[str]:
+    return [
+        f"{i}:{hashlib.blake2b(band.tobytes(), digest_size=8).hexdigest()}"
+        for i, band in enumerate(signature.reshape(bands, -1))
+    ]
+
+
+def similarity(a: np.ndarray, b: np.ndarray) -> float:
+    """
+    estimated Jaccard similarity of two signatures
+    """
+    return float(np.mean(a == b))
+
+
+@dataclass
+class Fingerprint:
+    hash: str
+    signature: Optional[np.ndarray]
+    bands: List[str]
+
+
+def fingerprint(text: str) -> Fingerprint:
+    text = normalize(text)
+    signature = _hasher.signature(text)
+    bands = band_keys(signature) if signature is not None else []
+    return Fingerprint(content_hash(text), signature, bands)
+
+
+@dataclass
+class Duplicate:
+    document: str
+    split_id: Optional[int]
+    # chunk which is kept, "document#split_id"
+    duplicate_of: str
+    # exact or near
+    kind: str
+    similarity: float
+
+
+def chunk_ref(doc: Document) -> Tuple[str, Optional[int]]:
+    name = doc.meta.get("file_path") or doc.meta.get("document_name") or ""
+    return name, doc.meta.get("split_id")
+
+
+class DedupIndex(object):
+    """
+    content hashes and LSH buckets of the MinHash signatures of the chunks
+    seen so far
+    """
+
+    def __init__(self, threshold: float = DEDUP_THRESHOLD):
+        self.threshold = threshold
+        self._hashes: Dict[str, str] = {}
+        self._buckets: Dict[str, List[int]] = {}
+        self._refs: List[str] = []
+        self._signatures: List[np.ndarray] = []
+
+    def find(self, fp: Fingerprint) -> Optional[Tuple[str, str, float]]:
+        """
+        (kind, ref, similarity) of the chunk fp duplicates, if any
+        """
+        ref = self._hashes.get(fp.hash)
+        if ref is not None:
+            return "exact", ref, 1.0
+        if fp.signature is None or self.threshold >= 1:
+            return None
+        candidates = set()
+        for key in fp.bands:
+            candidates.update(self._buckets.get(key, ()))
+        best = None
+        for i in candidates:
+            sim = similarity(fp.signature, self._signatures[i])
+            if sim >= self.threshold and (best is None or sim > best[2]):
+                best = ("near", self._refs[i], sim)
+        return best
+
+    def add(self, fp: Fingerprint, ref: str):
+        self._hashes.setdefault(fp.hash, ref)
+        if fp.signature is None:
+            return
+        i = len(self._refs)
+        self._refs.append(ref)
+        self._signatures.append(fp.signature)
+        for key in fp.bands:
+            self._buckets.setdefault(key, []).append(i)
+
+
+# meta of a chunk which tells its document apart, an alias takes them over
+OWNER_FIELDS = ("document_name", "file_path", "split_id", "repo", "commit")
+
+
+def owner(meta: Dict) -> Dict:
+    return {f: meta[f] for f in OWNER_FIELDS if f in meta}
+
+
+def _same_document(a: Dict, b: Dict) -> bool:
+    return all(
+        a.get(f) == b.get(f) for f in ("document_name", "repo", "commit"))
+
+
+def _set_aliases(meta: Dict, aliases: List[Dict]):
+    """
+    alias_meta: the owner meta of the chunks dropped as duplicates of this
+    one, aliases: their document names, which deletes look up
+    """
+    meta["alias_meta"] = aliases
+    meta["aliases"] = sorted({a.get("document_name") for a in aliases})
+
+
+@component
+class DuplicateFilter:
+    """
+    drop the chunks whose content is an exact or near duplicate of a chunk
+    already indexed (matching scope, a list of filter conditions), or of
+    a chunk seen before by this filter, so they are not embedded. the
+    first chunk of a document (split_id 0) is always kept.
+    the kept chunks get meta content_hash and minhash_bands, which later
+    filters look up. a dropped chunk of another document becomes an alias
+    of the chunk it duplicates, which passes to it when its own document
+    is removed: see remove_chunks(). link() stores the aliases once the
+    chunks are written.
+    """
+
+    def __init__(self,
+                 store=None,
+                 scope: Optional[List[Dict]] = None,
+                 threshold: float = DEDUP_THRESHOLD):
+        self.store = store
+        self.scope = scope or []
+        self.index = DedupIndex(threshold)
+        self._lock = Lock()
+        # owner meta of the chunks in self.index by id
+        self._owners: Dict[str, Dict] = {}
+        # aliases not stored yet by chunk id
+        self._pending: Dict[str, List[Dict]] = {}
+
+    def _load_indexed(self, fps: List[Fingerprint]):
+        hashes = [fp.hash for fp in fps]
+        bands = sorted(set(key for fp in fps for key in fp.bands))
+        lookup: Dict = {
+            "field": "meta.content_hash",
+            "operator": "in",
+            "value": hashes
+        }
+        if bands and self.index.threshold < 1:
+            lookup = {
+                "operator":
+                "OR",
+                "conditions": [
+                    lookup, {
+                        "field": "meta.minhash_bands",
+                        "operator": "in",
+                        "value": bands
+                    }
+                ]
+            }
+        filters = lookup
+        if self.scope:
+            filters = {"operator": "AND", "conditions": self.scope + [lookup]}
+        for doc in self.store.filter_documents(filters):
+            if doc.id in self._owners:
+                continue
+            self._owners[doc.id] = owner(doc.meta)
+            self.index.add(fingerprint(doc.content or ""), doc.id)
+
+    def filter(self, documents: List[Document]):
+        """
+        return (kept documents, duplicates)
+        """
+        fps = [fingerprint(doc.content or "") for doc in documents]
+        if self.store is not None and documents:
+            self._load_indexed(fps)
+        kept, duplicates = [], []
+        for doc, fp in zip(documents, fps):
+            name, split_id = chunk_ref(doc)
+            found = self.index.find(fp)
+            #the first chunk is kept, the document is listed by it
+            if found is not None and split_id != 0:
+                kind, id, sim = found
+                kept_owner = self._owners[id]
+                duplicates.append(
+                    Duplicate(
+                        name, split_id, f"{kept_owner.get('document_name')}"
+                        f"#{kept_owner.get('split_id')}", kind, sim))
+                alias = owner(doc.meta)
+                if not _same_document(alias, kept_owner):
+                    with self._lock:
+                        self._pending.setdefault(id, []).append(alias)
+                continue
+            doc.meta["content_hash"] = fp.hash
+            doc.meta["minhash_bands"] = fp.bands
+            self._owners[doc.id] = owner(doc.meta)
+            self.index.add(fp, doc.id)
+            kept.append(doc)
+        if duplicates:
+            logger.info(f"dropped {len(duplicates)} duplicate chunks of "
+                        f"{len(documents)}")
+        return kept, duplicates
+
+    def link(self, store) -> int:
+        """
+        add the pending aliases to their chunks which are written, the
+        others stay pending. return the number of chunks updated.
+        """
+        with self._lock:
+            pending = dict(self._pending)
+        if not pending:
+            return 0
+        docs = store.filter_documents({
+            "field": "id",
+            "operator": "in",
+            "value": list(pending)
+        })
+        for doc in docs:
+            _set_aliases(doc.meta,
+                         doc.meta.get("alias_meta", []) + pending[doc.id])
+        update_meta(store, docs)
+        sparse_index.add(store.index, docs)
+        with self._lock:
+            for doc in docs:
+                added = pending[doc.id]
+                left = self._pending[doc.id][len(added):]
+                if left:
+                    self._pending[doc.id] = left
+                else:
+                    del self._pending[doc.id]
+        return len(docs)
+
+    @component.output_types(documents=List[Document], duplicates=List[Dict])
+    def run(self, documents: List[Document]):
+        kept, duplicates = self.filter(documents)
+        return {
+            "documents": kept,
+            "duplicates": [asdict(d) for d in duplicates]
+        }
+
+
+def remove_chunks(store, docs: List[Document], scope: Optional[Dict],
+                  removed: Callable[[Dict], bool]) -> List[str]:
+    """
+    remove docs, the chunks of the documents being removed, from store.
+    removed(owner meta) tells whether a document is removed. a chunk with
+    aliases left passes to the first of them instead of being deleted,
+    the aliases of the removed documents are dropped from the chunks of
+    scope. return the ids deleted.
+    """
+    ids = {doc.id for doc in docs}
+    names = sorted({doc.meta.get("document_name") for doc in docs} - {None})
+    aliasing = []
+    if names:
+        aliasing = [
+            doc for doc in store.filter_documents(
+                all_of(scope, {
+                    "field": "meta.aliases",
+                    "operator": "in",
+                    "value": names
+                })) if doc.id not in ids
+        ]
+    deleted, updated = [], []
+    for doc in docs:
+        aliases = [a for a in doc.meta.get("alias_meta", []) if not removed(a)]
+        if not aliases:
+            deleted.append(doc.id)
+            continue
+        meta = dict(doc.meta)
+        meta.update(aliases[0])
+        _set_aliases(meta, aliases[1:])
+        updated.append(replace(doc, meta=meta))
+    for doc in aliasing:
+        meta = dict(doc.meta)
+        _set_aliases(meta, [a for a in meta["alias_meta"] if not removed(a)])
+        updated.append(replace(doc, meta=meta))
+    update_meta(store, updated)
+    sparse_index.add(store.index, updated)
+    if deleted:
+        store.delete_documents(deleted)
+        sparse_index.delete(deleted)
+    if updated:
+        logger.info(f"{len(updated)} chunks passed to or unlinked from "
+                    "their aliases")
+    return deleted
@@ -0,0 +1,148 @@
+import os
+import time
+from threading import Lock
+from typing import List, Optional
+
+from batcher import MicroBatcher
+from embedding_cache import EmbeddingCache
+from haystack import Document, component
+from logger import init_logger
+
+logger = init_logger(__name__)
+
+# concurrent single text queries are embedded together: a batch starts
+# EMBED_BATCH_WAIT_MS after its first text or when EMBED_BATCH_MAX texts
+# are waiting. EMBED_BATCH_MAX=1 turns batching off.
+EMBED_BATCH_MAX = int(os.getenv("EMBED_BATCH_MAX", "32"))
+EMBED_BATCH_WAIT_MS = float(os.getenv("EMBED_BATCH_WAIT_MS", "5"))
+
+
+class EmbeddingService(object):
+    """
+    one copy of the embedding model weights per process, shared by every
+    pipeline. the model is loaded on first use or by warm_up().
+    """
+
+    def __init__(self,
+                 model_id: str,
+                 device: str = "cpu",
+                 batch_size: int = 32,
+                 cache: Optional[EmbeddingCache] = None):
+        self.model_id = model_id
+        self.device = device
+        self.batch_size = batch_size
+        # texts found in the cache skip the forward pass
+        self.cache = cache
+        self._model = None
+        self._load_lock = Lock()
+        # one forward pass at a time, torch already uses every core
+        self._encode_lock = Lock()
+        self._batcher = None
+        if EMBED_BATCH_MAX > 1:
+            self._batcher = MicroBatcher("embedding", self.embed_texts,
+                                         EMBED_BATCH_MAX,
+                                         EMBED_BATCH_WAIT_MS / 1000)
+
+    def warm_up(self):
+        if self._model is not None:
+            return
+        with self._load_lock:
+            if self._model is not None:
+                return
+            from sentence_transformers import SentenceTransformer
+            start = time.time()
+            self._model = SentenceTransformer(self.model_id,
+                                              device=self.device)
+            logger.info(f"loaded {self.model_id} on {self.device}, "
+                        f"dur:{time.time() - start:.2f}")
+
+    def _encode(self, texts: List[str]) -> List[List[float]]:
+        self.warm_up()
+        with self._encode_lock:
+            embeddings = self._model.encode(texts,
+                                            batch_size=self.batch_size,
+                                            show_progress_bar=False)
+        return embeddings.tolist()
+
+    def embed_texts(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        if self.cache is None:
+            return self._encode(texts)
+        keys = [self.cache.key(text) for text in texts]
+        found = self.cache.get_many(keys)
+        #the same text is only encoded once
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found:
+                missing.setdefault(key, text)
+        if missing:
+            computed = dict(
+                zip(missing.keys(), self._encode(list(missing.values()))))
+            self.cache.put_many(computed)
+            found.update(computed)
+        return [found[key] for key in keys]
+
+    def count_tokens(self, texts: List[str]) -> List[int]:
+        """
+        tokens of each text for the model tokenizer, special tokens excluded
+        """
+        if not texts:
+            return []
+        self.warm_up()
+        ids = self._model.tokenizer(texts,
+                                    add_special_tokens=False)["input_ids"]
+        return [len(i) for i in ids]
+
+    def embed_text(self, text: str) -> List[float]:
+        """
+        embed one query, batched with the queries of the other threads
+        """
+        if self._batcher is None:
+            return self.embed_texts([text])[0]
+        return self._batcher.call(text)
+
+    def embed_documents(self, documents: List[Document]) -> List[Document]:
+        """
+        set the embedding of each document from its content
+        """
+        embeddings = self.embed_texts([d.content or "" for d in documents])
+        for doc, embedding in zip(documents, embeddings):
+            doc.embedding = embedding
+        return documents
+
+
+# Components can not be shared between pipelines, these ones are cheap:
+# they only hold the shared service.
+@component
+class SharedTextEmbedder:
+    """
+    same input and output as SentenceTransformersTextEmbedder
+    """
+
+    def __init__(self, service: EmbeddingService):
+        self.service = service
+
+    def warm_up(self):
+        self.service.warm_up()
+
+    @component.output_types(embedding=List[float])
+    def run(self, text: str):
+        return {"embedding": self.service.embed_text(text)}
+
+
+@component
+class SharedDocumentEmbedder:
+    """
+    same input and output as SentenceTransformersDocumentEmbedder
+    """
+
+    def __init__(self, service: EmbeddingService):
+        self.service = service
+
+    def warm_up(self):
+        self.service.warm_up()
+
+    @component.output_types(documents=List[Document])
+    def run(self, documents: List[Document]):
+        return {"documents": self.service.embed_documents(documents)}
@@ -0,0 +1,215 @@
+import fcntl
+import hashlib
+import json
+import os
+import re
+import tempfile
+from collections import OrderedDict
+from threading import Lock
+from typing import Dict, List, Optional
+
+import metrics
+import numpy as np
+from logger import init_logger
+
+logger = init_logger(__name__)
+
+# Persistent cache of embeddings, one directory per model:
+#   meta.json    model id, dimension and capacity
+#   vectors.f16  memory-mapped float16 array, one row per cached text
+#   index.log    append-only "key row" lines, "key -" frees a row
+EMBED_CACHE_DIR = os.getenv("EMBED_CACHE_DIR",
+                            tempfile.gettempdir() + "/ailint/embeddings")
+# rows of the vector file, 0 disables the cache.
+# UAE-Large-V1 needs 2KB per row
+EMBED_CACHE_CAPACITY = int(os.getenv("EMBED_CACHE_CAPACITY", "100000"))
+# index.log lines tolerated beyond twice the cached texts
+_COMPACT_SLACK = 1000
+
+_TRAILING_SPACE_RE = re.compile(r"[ \t]+$", re.MULTILINE)
+
+
+def normalize(text: str) -> str:
+    """
+    whitespace which does not change the meaning of code or prose
+    """
+    text = text.replace("\r\n", "\n")
+    return _TRAILING_SPACE_RE.sub("", text).strip()
+
+
+class EmbeddingCache(object):
+    """
+    LRU cache of embeddings keyed by the hash of the normalized text.
+    only one process can use a cache directory, the others run without
+    cache.
+    """
+
+    def __init__(self,
+                 model_id: str,
+                 cache_dir: str = EMBED_CACHE_DIR,
+                 capacity: int = EMBED_CACHE_CAPACITY):
+        self.model_id = model_id
+        self.capacity = capacity
+        self.dir = os.path.join(
+            cache_dir,
+            hashlib.sha256(model_id.encode()).hexdigest()[:16])
+        self.dim: Optional[int] = None
+        self._lock = Lock()
+        # key -> row, least recently used first
+        self._rows: OrderedDict[str, int] = OrderedDict()
+        self._free: List[int] = []
+        self._next_row = 0
+        self._vectors: Optional[np.memmap] = None
+        self._log = None
+        self._log_lines = 0
+        self.enabled = False
+        self.hits = metrics.counter("embedding.cache_hits")
+        self.misses = metrics.counter("embedding.cache_misses")
+        if capacity > 0:
+            self._open()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.dir, name)
+
+    def _open(self):
+        os.makedirs(self.dir, exist_ok=True)
+        self._lock_file = open(self._path("lock"), "w")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            logger.warning(f"{self.dir} is used by another process, "
+                           "embedding cache disabled")
+            return
+        meta = None
+        try:
+            with open(self._path("meta.json")) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            pass
+        if (meta and meta.get("model") == self.model_id
+                and meta.get("capacity") == self.capacity
+                and os.path.exists(self._path("vectors.f16"))):
+            self.dim = meta["dim"]
+            self._vectors = np.memmap(self._path("vectors.f16"),
+                                      dtype=np.float16,
+                                      mode="r+",
+                                      shape=(self.capacity, self.dim))
+            self._replay()
+        else:
+            #new cache, or its layout changed
+            for name in ("meta.json", "vectors.f16", "index.log"):
+                if os.path.exists(self._path(name)):
+                    os.remove(self._path(name))
+        self._log = open(self._path("index.log"), "a")
+        self.enabled = True
+        logger.info(f"embedding cache {self.dir}: {len(self._rows)} "
+                    f"of {self.capacity} rows")
+
+    def _replay(self):
+        lines = 0
+        try:
+            with open(self._path("index.log")) as f:
+                for line in f:
+                    lines += 1
+                    parts = line.split()
+                    if len(parts) != 2:
+                        #torn write of the last line
+                        continue
+                    key, row = parts
+                    if row == "-":
+                        self._rows.pop(key, None)
+                        continue
+                    self._rows.pop(key, None)
+                    self._rows[key] = int(row)
+        except FileNotFoundError:
+            pass
+        used = set(self._rows.values())
+        self._next_row = max(used) + 1 if used else 0
+        self._free = [i for i in range(self._next_row) if i not in used]
+        self._log_lines = lines
+        self._maybe_compact()
+
+    def _maybe_compact(self):
+        """
+        rewrite index.log with one line per cached text, least recently
+        used first, once the evictions and freed rows make up most of it
+        """
+        if self._log_lines <= 2 * len(self._rows) + _COMPACT_SLACK:
+            return
+        tmp = self._path("index.log.tmp")
+        with open(tmp, "w") as f:
+            for key, row in self._rows.items():
+                f.write(f"{key} {row}\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._path("index.log"))
+        if self._log is not None:
+            self._log.close()
+            self._log = open(self._path("index.log"), "a")
+        self._log_lines = len(self._rows)
+
+    def _create(self, dim: int):
+        self.dim = dim
+        self._vectors = np.memmap(self._path("vectors.f16"),
+                                  dtype=np.float16,
+                                  mode="w+",
+                                  shape=(self.capacity, dim))
+        with open(self._path("meta.json"), "w") as f:
+            json.dump(
+                {
+                    "model": self.model_id,
+                    "dim": dim,
+                    "capacity": self.capacity
+                }, f)
+
+    def key(self, text: str) -> str:
+        h = hashlib.sha256()
+        h.update(self.model_id.encode())
+        h.update(b"\0")
+        h.update(normalize(text).encode())
+        return h.hexdigest()[:32]
+
+    def get_many(self, keys: List[str]) -> Dict[str, List[float]]:
+        found = {}
+        if not self.enabled:
+            return found
+        with self._lock:
+            for key in keys:
+                row = self._rows.get(key)
+                if row is None:
+                    continue
+                self._rows.move_to_end(key)
+                found[key] = self._vectors[row].astype(np.float32).tolist()
+        self.hits.inc(len(found))
+        self.misses.inc(len(keys) - len(found))
+        return found
+
+    def _allocate(self) -> int:
+        if self._free:
+            return self._free.pop()
+        if self._next_row < self.capacity:
+            self._next_row += 1
+            return self._next_row - 1
+        key, row = self._rows.popitem(last=False)
+        #free the row on disk before it is overwritten
+        self._log.write(f"{key} -\n")
+        self._log.flush()
+        self._log_lines += 1
+        return row
+
+    def put_many(self, items: Dict[str, List[float]]):
+        if not self.enabled or not items:
+            return
+        with self._lock:
+            if self._vectors is None:
+                self._create(len(next(iter(items.values()))))
+            for key, vector in items.items():
+                if key in self._rows or len(vector) != self.dim:
+                    continue
+                row = self._allocate()
+                self._vectors[row] = vector
+                self._rows[key] = row
+                self._log.write(f"{key} {row}\n")
+                self._log_lines += 1
+            self._log.flush()
+            self._maybe_compact()
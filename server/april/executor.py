@@ -0,0 +1,44 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from logger import init_logger
+
+logger = init_logger(__name__)
+
+# Blocking work must never run on the event loop, otherwise one slow request
+# stalls every other client of the uvicorn worker.
+# cpu pool: embedding (torch releases the GIL, so threads scale with cores)
+# io pool: LLM HTTP calls and git clone, mostly waiting on the network
+CPU_WORKERS = int(os.getenv("CPU_WORKERS", str(os.cpu_count() or 1)))
+IO_WORKERS = int(os.getenv("IO_WORKERS", "32"))
+
+cpu_executor = ThreadPoolExecutor(max_workers=CPU_WORKERS,
+                                  thread_name_prefix="april-cpu")
+io_executor = ThreadPoolExecutor(max_workers=IO_WORKERS,
+                                 thread_name_prefix="april-io")
+
+
+async def run_cpu(fn, *args, **kwargs):
+    """
+    run fn in the cpu pool and await the result
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(cpu_executor,
+                                      partial(fn, *args, **kwargs))
+
+
+async def run_io(fn, *args, **kwargs):
+    """
+    run fn in the io pool and await the result
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(io_executor,
+                                      partial(fn, *args, **kwargs))
+
+
+def shutdown():
+    logger.info("shutting down executors...")
+    cpu_executor.shutdown(wait=False, cancel_futures=True)
+    io_executor.shutdown(wait=False, cancel_futures=True)
@@ -1,19 +1,21 @@
 import json
-import os
 import time
-from typing import List
+from typing import Callable, Dict, List, Optional
 
-import qdrant_client
+from common import INDEX_NAME, get_document_store, list_topics
 from haystack import Pipeline, component
 from haystack.components.builders import PromptBuilder
-from haystack.components.embedders import SentenceTransformersTextEmbedder
 from haystack.components.generators.chat import OpenAIChatGenerator
-from haystack.dataclasses import ChatMessage
-from haystack.utils import ComponentDevice, Secret
-from haystack_integrations.components.retrievers.qdrant import \
-    QdrantEmbeddingRetriever
-from haystack_integrations.document_stores.qdrant import QdrantDocumentStore
+from haystack.dataclasses import ChatMessage, StreamingChunk
+from haystack.utils import Secret
+from llm_client import openai_client
 from logger import init_logger
+from pipelines import registry
+from prompt_budget import DocumentBudget
+from risk_stream import PlainRiskDecoder, ToolRiskDecoder
+from router import BACKENDS
+from sparse_index import add_retrieval, retrieval_inputs, retrieval_mode
+from topics import TopicCatalog
 
 #lint.log record all lint messages.
 logger = init_logger(__name__, "lint.log")
@@ -94,7 +96,14 @@ This is the code you want to review:
 
 '''
 
-templates = {"openai": openai_template, "custom": openai_template}
+templates = {
+    "openai": openai_template,
+    "custom": openai_template,
+    "ollama": openai_template
+}
+
+#default model of each backend
+models = {name: backend.model for name, backend in BACKENDS.items()}
 
 
 #this could be also use in debug.
@@ -149,123 +158,145 @@ lint_tools = [{
     },
 }]
 
-QDRANT_ADDR = "http://localhost:6333"
-client = qdrant_client.QdrantClient(url=QDRANT_ADDR)
-text_embeder = SentenceTransformersTextEmbedder(
-    model="WhereIsAI/UAE-Large-V1", device=ComponentDevice.from_str("cpu"))
-text_embeder.warm_up()
+
+class StreamSink:
+    """
+    streaming_callback of pooled generators. The generator is built once,
+    so whoever borrows the pipeline points target to its own handler.
+    """
+
+    def __init__(self):
+        self.target: Optional[Callable[[StreamingChunk], None]] = None
+
+    def __call__(self, chunk: StreamingChunk):
+        if self.target is not None:
+            self.target(chunk)
+
+
+topic_catalog = TopicCatalog(list_topics)
+topic_catalog.start()
 
 
 def suppported_topics():
     """
     Get the list of supported topics
     """
-    return [cd.name for cd in client.get_collections().collections]
+    return topic_catalog.topics()
 
 
 class QueryLint(object):
 
-    def __init__(self, ai):
+    def __init__(self, ai, model: Optional[str] = None):
         #check ai backend
         self.ai = ai
         if not self.ai:
             raise Exception("AI_BACKEND not specifiled")
-        if self.ai == "openai":
-            self.api_base_url = None
-            if "OPENAI_API_KEY" not in os.environ:
-                raise Exception("openai should have env OPENAI_API_KEY")
-        if self.ai == "custom":
-            self.api_base_url = "http://localhost:8081/v1"
-            pass
+        if self.ai not in BACKENDS:
+            raise Exception(f"unknown AI_BACKEND {self.ai}")
+        backend = BACKENDS[self.ai]
+        if not backend.available(requested=True):
+            raise Exception(f"{self.ai} is not available, openai should "
+                            "have env OPENAI_API_KEY")
+        self.api_base_url = backend.base_url
+        self.api_key = backend.api_key or "FAKE"
+        self.model = model or models[self.ai]
+        # seconds of the last pipeline run, without the wait for a pipeline
+        self.latency: Optional[float] = None
 
     @staticmethod
     def topic_exist(topic) -> bool:
-        return topic in [
-            cd.name for cd in client.get_collections().collections
-        ]
-
-    def _build_query_pipe(
-        self,
-        ai: str,
-    ):
+        return topic_catalog.exists(topic)
+
+    def _new_llm(self, streaming: bool):
+        sink = StreamSink() if streaming else None
+        if self.ai == "openai":
+            #only openai supports function call.
+            llm = OpenAIChatGenerator(api_key=Secret.from_token(self.api_key),
+                                      model=self.model,
+                                      api_base_url=self.api_base_url,
+                                      streaming_callback=sink,
+                                      generation_kwargs={"tools": lint_tools})
+        else:
+            #vllm and ollama are compatible to openai API.
+            llm = OpenAIChatGenerator(api_key=Secret.from_token(self.api_key),
+                                      model=self.model,
+                                      api_base_url=self.api_base_url,
+                                      streaming_callback=sink)
+        #share the pooled keep-alive connections of the backend
+        llm.client = openai_client(self.ai, self.api_key, self.api_base_url)
+        return llm
+
+    def _build_query_pipe(self, ai: str, streaming: bool = False):
         query_pipeline = Pipeline()
         query_pipeline.add_component("prompt_builder",
                                      PromptBuilder(template=templates[ai]))
         query_pipeline.add_component("prompt_convert", PromptConvert())
-        if self.ai == "openai":
-            #only openai supports function call.
-            query_pipeline.add_component(
-                "llm",
-                OpenAIChatGenerator(model="gpt-3.5-turbo",
-                                    generation_kwargs={"tools": lint_tools}))
-        else:
-            #vllm is compatible to openai API.
-            #we can use FAKE api_key
-            query_pipeline.add_component(
-                "llm",
-                OpenAIChatGenerator(
-                    api_key=Secret.from_token("FAKE"),
-                    model="deepseek-ai/deepseek-coder-7b-instruct-v1.5",
-                    api_base_url=self.api_base_url))
+        query_pipeline.add_component("llm", self._new_llm(streaming))
 
         query_pipeline.connect("prompt_builder", "prompt_convert")
         query_pipeline.connect("prompt_convert", "llm")
         return query_pipeline
 
-    def _build_rag_query_pipe(self, ai: str,
-                              document_store: QdrantDocumentStore):
+    def _build_rag_query_pipe(self,
+                              ai: str,
+                              document_store,
+                              topic: str,
+                              streaming: bool = False,
+                              mode: str = "dense"):
         query_pipeline = Pipeline()
 
-        query_pipeline.add_component("text_embedder", text_embeder)
-        query_pipeline.add_component(
-            "retriever",
-            QdrantEmbeddingRetriever(document_store=document_store))
+        retrieved = add_retrieval(query_pipeline, mode, document_store,
+                                  INDEX_NAME, topic)
+        query_pipeline.add_component("doc_budget", DocumentBudget(self.model))
         query_pipeline.add_component("prompt_builder",
                                      PromptBuilder(template=templates[ai]))
         query_pipeline.add_component("prompt_convert", PromptConvert())
+        query_pipeline.add_component("llm", self._new_llm(streaming))
 
-        if self.ai == "openai":
-            #only openai supports function call.
-            query_pipeline.add_component(
-                "llm",
-                OpenAIChatGenerator(model="gpt-3.5-turbo",
-                                    generation_kwargs={"tools": lint_tools}))
-        else:
-            #vllm is compatible to openai API.
-            query_pipeline.add_component(
-                "llm",
-                OpenAIChatGenerator(
-                    model="deepseek-ai/deepseek-coder-7b-instruct-v1.5",
-                    api_base_url=self.api_base_url))
-
-        query_pipeline.connect("text_embedder.embedding",
-                               "retriever.query_embedding")
-        query_pipeline.connect("retriever", "prompt_builder.documents")
+        query_pipeline.connect(retrieved, "doc_budget")
+        query_pipeline.connect("doc_budget", "prompt_builder.documents")
         query_pipeline.connect("prompt_builder", "prompt_convert")
         query_pipeline.connect("prompt_convert", "llm")
         return query_pipeline
 
-    def _query_rag(self, topic: str, code: str):
-        #BUG: this QdrantDocumentStore will ALWAYS create collection
-        document_store = QdrantDocumentStore(
-            QDRANT_ADDR,
-            embedding_dim=1024,
-            index=topic,
-        )
-        query_pipeline = self._build_rag_query_pipe(self.ai, document_store)
-        result = query_pipeline.run({
-            "text_embedder": {
-                "text": code
-            },
-            "retriever": {
-                "top_k": 3
-            },
-            "prompt_builder": {
-                "code": code
-            }
-        })
+    def _new_rag_query_pipe(self, topic: str, streaming: bool, mode: str):
+        #same layout as /dev: the partition of topic in the RAG index
+        document_store = get_document_store()
+        return self._build_rag_query_pipe(self.ai, document_store, topic,
+                                          streaming, mode)
+
+    def _run(self, key, builder, data: Dict,
+             on_chunk: Optional[Callable[[StreamingChunk], None]]):
+        with registry.acquire(key, builder) as query_pipeline:
+            sink = query_pipeline.get_component("llm").streaming_callback
+            if sink is not None:
+                sink.target = on_chunk
+            start = time.monotonic()
+            try:
+                result = query_pipeline.run(data)
+                self.latency = time.monotonic() - start
+            finally:
+                if sink is not None:
+                    sink.target = None
         return self.handle_response(result)
 
+    def _query_rag(self,
+                   topic: str,
+                   code: str,
+                   on_chunk=None,
+                   docs_budget: Optional[int] = None):
+        #pipelines are prebuilt per (backend, model, topic, retrieval) and
+        #reused
+        streaming = on_chunk is not None
+        mode = retrieval_mode(code, INDEX_NAME, topic)
+        key = (self.ai, self.model, topic, streaming, mode)
+        data = retrieval_inputs(mode, code, 3)
+        data["doc_budget"] = {"max_tokens": docs_budget}
+        data["prompt_builder"] = {"code": code}
+        return self._run(
+            key, lambda: self._new_rag_query_pipe(topic, streaming, mode),
+            data, on_chunk)
+
     def handle_response(self, result) -> str:
         if self.ai != "openai":
             return result["llm"]["replies"][0].content
@@ -278,21 +309,58 @@ class QueryLint(object):
         """
         return function_args
 
-    def _query(self, code: str):
-        query_pipeline = self._build_query_pipe(self.ai)
-        result = query_pipeline.run(
-            {"prompt_builder": {
-                "code": code,
-                "documents": []
-            }})
-        return self.handle_response(result)
+    def _query(self, code: str, on_chunk=None):
+        streaming = on_chunk is not None
+        key = (self.ai, self.model, None, streaming)
+        return self._run(key,
+                         lambda: self._build_query_pipe(self.ai, streaming),
+                         {"prompt_builder": {
+                             "code": code,
+                             "documents": []
+                         }}, on_chunk)
+
+    @staticmethod
+    def risk_decoder(ai: str):
+        if ai == "openai":
+            return ToolRiskDecoder()
+        return PlainRiskDecoder()
 
-    def query_lint(self, topic: str, code: str):
+    def _chunk_text(self, chunk: StreamingChunk) -> str:
+        if self.ai != "openai":
+            return chunk.content
+        #function call arguments are streamed in the tool call deltas
+        text = ""
+        for delta in chunk.meta.get("tool_calls") or []:
+            if delta.function and delta.function.arguments:
+                text += delta.function.arguments
+        return text
+
+    def query_lint(self,
+                   topic: str,
+                   code: str,
+                   on_risk: Optional[Callable[[Dict], None]] = None,
+                   docs_budget: Optional[int] = None):
+        """
+        on_risk is called from the worker thread for every risk as soon as
+        it is decoded from the token stream
+        docs_budget caps the tokens of the retrieved documents in the prompt
+        """
         start = time.time()
-        if self.topic_exist(topic):
-            ret = self._query_rag(topic, code)
+        on_chunk = None
+        if on_risk is not None:
+            decoder = self.risk_decoder(self.ai)
+
+            def on_chunk(chunk: StreamingChunk):
+                for risk in decoder.feed(self._chunk_text(chunk)):
+                    on_risk(risk)
 
-        ret = self._query(code)
+        if self.topic_exist(topic):
+            ret = self._query_rag(topic, code, on_chunk, docs_budget)
+        else:
+            ret = self._query(code, on_chunk)
+        if on_risk is not None:
+            for risk in decoder.close():
+                on_risk(risk)
         logger.info(
             f"lint code len:{len(code)}, dur:{time.time() - start:.2f}")
         return ret
@@ -0,0 +1,446 @@
+"""
+bulk ingestion of a whole directory tree into one RAG topic.
+
+files are read and split in a process pool, the chunks are embedded in
+large batches and written to qdrant in sized batches, while the next
+batch is embedded. a checkpoint records the files which are completely
+written, an interrupted ingestion started again skips them.
+
+usage: python ingest.py --topic cannyls-go data/cannyls-go
+"""
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+import uuid
+import zipfile
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from itertools import repeat
+from threading import Lock, Thread
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+from admission import run_then
+from dedup import DuplicateFilter
+from logger import init_logger
+from partition import topic_filter
+from sparse_index import sparse_index
+from splitter import CodeAwareSplitter, document_kind
+
+logger = init_logger(__name__)
+
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", str(os.cpu_count() or 1)))
+# chunks embedded in one call
+INGEST_EMBED_BATCH = int(os.getenv("INGEST_EMBED_BATCH", "256"))
+# points sent to qdrant in one upsert
+INGEST_WRITE_BATCH = int(os.getenv("INGEST_WRITE_BATCH", "256"))
+# bigger files are generated or data, not worth indexing
+INGEST_MAX_FILE_BYTES = int(os.getenv("INGEST_MAX_FILE_BYTES", "1048576"))
+# size of an archive uploaded to /rag/bulk
+INGEST_MAX_UPLOAD_BYTES = int(
+    os.getenv("INGEST_MAX_UPLOAD_BYTES", str(2 * 1024 * 1024 * 1024)))
+# extracted size and number of files of an archive, against zip/tar bombs
+INGEST_MAX_EXTRACT_BYTES = int(
+    os.getenv("INGEST_MAX_EXTRACT_BYTES", str(8 * 1024 * 1024 * 1024)))
+INGEST_MAX_EXTRACT_FILES = int(os.getenv("INGEST_MAX_EXTRACT_FILES", "200000"))
+# seconds the status of a finished /rag/bulk job is kept
+INGEST_JOB_TTL = float(os.getenv("INGEST_JOB_TTL", "86400"))
+INGEST_STATE_DIR = os.getenv("INGEST_STATE_DIR",
+                             tempfile.gettempdir() + "/ailint/ingest")
+SKIP_DIRS = {".git", ".hg", ".svn", "node_modules", "__pycache__", ".venv"}
+
+
+def iter_files(root: str) -> Iterator[str]:
+    """
+    paths relative to root of the files to ingest, in a stable order
+    """
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if d not in SKIP_DIRS)
+        for name in sorted(filenames):
+            yield os.path.relpath(os.path.join(dirpath, name), root)
+
+
+# state of the worker processes
+_splitter: Optional[CodeAwareSplitter] = None
+
+
+def _init_worker(model_id: str, max_tokens: int, overlap_tokens: int):
+    """
+    the workers only need the tokenizer, not the model
+    """
+    global _splitter
+    from transformers import AutoTokenizer
+    tokenizer = AutoTokenizer.from_pretrained(model_id)
+
+    def count_tokens(texts: List[str]) -> List[int]:
+        if not texts:
+            return []
+        ids = tokenizer(texts, add_special_tokens=False)["input_ids"]
+        return [len(i) for i in ids]
+
+    _splitter = CodeAwareSplitter(count_tokens, max_tokens, overlap_tokens)
+
+
+def read_text(path: str) -> Tuple[Optional[str], Optional[str]]:
+    """
+    return the text of a file, or why it is skipped
+    """
+    try:
+        if os.path.getsize(path) > INGEST_MAX_FILE_BYTES:
+            return None, "too large"
+        with open(path, "rb") as f:
+            data = f.read()
+    except OSError as e:
+        return None, f"{e}"
+    if b"\0" in data[:8192]:
+        return None, "binary"
+    try:
+        return data.decode("utf-8"), None
+    except UnicodeDecodeError:
+        return None, "not utf-8"
+
+
+def _split_file(root: str, rel: str,
+                meta: Dict) -> Tuple[str, List[Tuple[str, Dict]], str]:
+    """
+    runs in a worker process: (rel, [(content, meta)...], skip reason)
+    """
+    text, reason = read_text(os.path.join(root, rel))
+    if text is None:
+        return rel, [], reason
+    chunks = []
+    for split_id, chunk in enumerate(
+            _splitter.split_text(text, document_kind(rel))):
+        chunk_meta = dict(meta)
+        chunk_meta.update({
+            "document_name": rel,
+            "file_path": rel,
+            "split_id": split_id,
+        })
+        chunk_meta.update(chunk.meta)
+        chunks.append((chunk.content, chunk_meta))
+    return rel, chunks, ""
+
+
+class Checkpoint(object):
+    """
+    append-only list of the files which are completely written
+    """
+
+    def __init__(self, key: str):
+        os.makedirs(INGEST_STATE_DIR, exist_ok=True)
+        self.path = os.path.join(INGEST_STATE_DIR, key + ".log")
+        self.done: Set[str] = set()
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.done = set(line.rstrip("\n") for line in f)
+        self._lock = Lock()
+        self._file = open(self.path, "a")
+
+    def mark(self, rel: str):
+        with self._lock:
+            self._file.write(rel + "\n")
+            self._file.flush()
+
+    def remove(self):
+        """
+        the ingestion is complete, the next one starts from scratch
+        """
+        self._file.close()
+        os.remove(self.path)
+
+
+def checkpoint_key(topic: str, source: str) -> str:
+    return hashlib.sha256(f"{topic}\0{source}".encode()).hexdigest()[:32]
+
+
+@dataclass
+class IngestReport:
+    topic: str
+    files: int = 0
+    chunks: int = 0
+    # files already written by an interrupted run
+    resumed: int = 0
+    skipped: Dict[str, str] = field(default_factory=dict)
+    # chunks not embedded, their content is already indexed
+    duplicates: List[Dict] = field(default_factory=list)
+    seconds: float = 0.0
+
+
+class Ingester(object):
+    """
+    the chunks are written to the partition of topic in the RAG index.
+    meta is added to the meta of every chunk. the chunks which duplicate
+    a chunk of the topic are dropped, they become its aliases.
+    """
+
+    def __init__(self,
+                 topic: str,
+                 meta: Optional[Dict] = None,
+                 workers: int = INGEST_WORKERS,
+                 embed_batch: int = INGEST_EMBED_BATCH,
+                 write_batch: int = INGEST_WRITE_BATCH):
+        self.topic = topic
+        self.meta = dict(meta or {})
+        self.meta["topic"] = topic
+        self.workers = max(workers, 1)
+        self.embed_batch = embed_batch
+        self.write_batch = write_batch
+        self._lock = Lock()
+        # chunks of each file not written yet
+        self._remaining: Dict[str, int] = {}
+
+    def _completed(self, paths: List[str], checkpoint: Checkpoint):
+        """
+        one chunk of each path is written or dropped
+        """
+        for rel in paths:
+            with self._lock:
+                self._remaining[rel] -= 1
+                complete = self._remaining[rel] == 0
+                if complete:
+                    del self._remaining[rel]
+            if complete:
+                checkpoint.mark(rel)
+
+    def _write(self, store, docs, checkpoint: Checkpoint,
+               dedup: DuplicateFilter):
+        from haystack.document_stores.types import DuplicatePolicy
+        store.write_documents(docs, policy=DuplicatePolicy.OVERWRITE)
+        sparse_index.add(store.index, docs)
+        #the aliases of the chunks written so far
+        dedup.link(store)
+        self._completed([doc.meta["file_path"] for doc in docs], checkpoint)
+
+    def run(self,
+            root: str,
+            paths: Optional[List[str]] = None,
+            source: Optional[str] = None) -> IngestReport:
+        """
+        ingest paths (relative to root), every file of root by default.
+        source identifies the content for the checkpoint, root by default.
+        """
+        # the model is only loaded by the process which embeds
+        from common import (MODEL_ID, RAG_CHUNK_OVERLAP_TOKENS,
+                            RAG_CHUNK_TOKENS, embedding_service,
+                            get_document_store)
+        from haystack import Document
+        from lint_cache import lint_cache
+
+        start = time.time()
+        report = IngestReport(self.topic)
+        checkpoint = Checkpoint(
+            checkpoint_key(self.topic, source or os.path.abspath(root)))
+        if paths is None:
+            paths = list(iter_files(root))
+        todo = [rel for rel in paths if rel not in checkpoint.done]
+        report.resumed = len(paths) - len(todo)
+        if report.resumed:
+            logger.info(f"{self.topic}: resume, {report.resumed} files "
+                        "already written")
+        store = get_document_store(write_batch_size=self.write_batch)
+        dedup = DuplicateFilter(store, scope=[topic_filter(self.topic)])
+
+        writer = ThreadPoolExecutor(1, thread_name_prefix="ingest-writer")
+        writing: Optional[Future] = None
+        batch: List[Document] = []
+
+        def flush():
+            nonlocal writing, batch
+            if not batch:
+                return
+            batch, duplicates = dedup.filter(batch)
+            report.duplicates.extend(asdict(d) for d in duplicates)
+            self._completed([d.document for d in duplicates], checkpoint)
+            if not batch:
+                return
+            embeddings = embedding_service.embed_texts(
+                [doc.content for doc in batch])
+            for doc, embedding in zip(batch, embeddings):
+                doc.embedding = embedding
+            #one batch written while the next one is embedded
+            if writing is not None:
+                writing.result()
+            writing = writer.submit(self._write, store, batch, checkpoint,
+                                    dedup)
+            batch = []
+
+        # spawn: forking a process which runs torch threads could deadlock
+        pool = ProcessPoolExecutor(
+            self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(MODEL_ID, RAG_CHUNK_TOKENS, RAG_CHUNK_OVERLAP_TOKENS))
+        try:
+            for rel, chunks, reason in pool.map(_split_file,
+                                                repeat(root),
+                                                todo,
+                                                repeat(self.meta),
+                                                chunksize=16):
+                report.files += 1
+                if reason:
+                    report.skipped[rel] = reason
+                if not chunks:
+                    checkpoint.mark(rel)
+                    continue
+                with self._lock:
+                    self._remaining[rel] = len(chunks)
+                for content, meta in chunks:
+                    batch.append(Document(content=content, meta=meta))
+                report.chunks += len(chunks)
+                if len(batch) >= self.embed_batch:
+                    flush()
+                    logger.info(f"{self.topic}: {report.files}/{len(todo)} "
+                                f"files, {report.chunks} chunks")
+            flush()
+            if writing is not None:
+                writing.result()
+            dedup.link(store)
+        finally:
+            pool.shutdown(cancel_futures=True)
+            writer.shutdown()
+        checkpoint.remove()
+        lint_cache.invalidate_topic(self.topic)
+        report.seconds = time.time() - start
+        logger.info(f"{self.topic}: ingested {report.files} files, "
+                    f"{report.chunks} chunks, {len(report.duplicates)} "
+                    f"duplicates, dur:{report.seconds:.2f}")
+        return report
+
+
+def _check_extract_size(sizes: List[int]):
+    if len(sizes) > INGEST_MAX_EXTRACT_FILES:
+        raise ValueError(f"archive has {len(sizes)} files, more than "
+                         f"{INGEST_MAX_EXTRACT_FILES}")
+    if sum(sizes) > INGEST_MAX_EXTRACT_BYTES:
+        raise ValueError(f"archive extracts to {sum(sizes)} bytes, more "
+                         f"than {INGEST_MAX_EXTRACT_BYTES}")
+
+
+def extract_archive(path: str, dest: str):
+    """
+    extract the regular files of a zip or tar(.gz/.bz2/.xz) archive,
+    nothing is written outside dest. the sizes are checked before
+    anything is extracted, zipfile never inflates a file beyond the size
+    it declares.
+    """
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as z:
+            infos = [info for info in z.infolist() if not info.is_dir()]
+            _check_extract_size([info.file_size for info in infos])
+            # ZipFile.extract drops absolute paths and ".."
+            for info in infos:
+                z.extract(info, dest)
+        return
+    if not tarfile.is_tarfile(path):
+        raise ValueError("not a tar or zip archive")
+    root = os.path.realpath(dest)
+    with tarfile.open(path) as t:
+        members = []
+        for member in t.getmembers():
+            target = os.path.realpath(os.path.join(dest, member.name))
+            if member.isfile() and target.startswith(root + os.sep):
+                members.append(member)
+        _check_extract_size([member.size for member in members])
+        t.extractall(dest, members=members)
+
+
+@dataclass
+class IngestJob:
+    id: str
+    topic: str
+    status: str = "running"
+    report: Optional[Dict] = None
+    error: Optional[str] = None
+    # time.monotonic() when the job ended
+    finished: Optional[float] = None
+
+
+jobs_mutex = Lock()
+jobs: Dict[str, IngestJob] = {}
+
+
+def _prune_jobs():
+    "forget the jobs which ended more than INGEST_JOB_TTL seconds ago"
+    expired = time.monotonic() - INGEST_JOB_TTL
+    with jobs_mutex:
+        for job_id in [
+                id for id, job in jobs.items()
+                if job.finished is not None and job.finished < expired
+        ]:
+            del jobs[job_id]
+
+
+def get_job(job_id: str) -> Optional[IngestJob]:
+    with jobs_mutex:
+        return jobs.get(job_id)
+
+
+def _file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def start_archive_job(topic: str,
+                      archive: str,
+                      on_exit: Optional[Callable] = None) -> str:
+    """
+    ingest an uploaded archive in a background thread, the archive is
+    removed when the job ends. the same archive uploaded again after an
+    interruption resumes from the checkpoint.
+    return the job id
+    """
+    _prune_jobs()
+    job = IngestJob(str(uuid.uuid4()), topic)
+    with jobs_mutex:
+        jobs[job.id] = job
+
+    def run():
+        workdir = tempfile.mkdtemp(prefix="ingest-")
+        try:
+            source = "archive:" + _file_sha256(archive)
+            extract_archive(archive, workdir)
+            report = Ingester(topic).run(workdir, source=source)
+            job.report = asdict(report)
+            job.status = "done"
+        except Exception as e:
+            logger.exception(f"ingest job {job.id} failed")
+            job.error = f"{e}"
+            job.status = "failed"
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+            os.remove(archive)
+            job.finished = time.monotonic()
+
+    Thread(target=run_then(run, on_exit),
+           name=f"ingest-{job.id[:8]}",
+           daemon=True).start()
+    return job.id
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="index a directory tree into a RAG topic")
+    parser.add_argument("--topic", required=True)
+    parser.add_argument("--workers", type=int, default=INGEST_WORKERS)
+    parser.add_argument("--restart",
+                        action="store_true",
+                        help="ignore the checkpoint of an interrupted run")
+    parser.add_argument("root")
+    args = parser.parse_args()
+    if args.restart:
+        path = os.path.join(
+            INGEST_STATE_DIR,
+            checkpoint_key(args.topic, os.path.abspath(args.root)) + ".log")
+        if os.path.exists(path):
+            os.remove(path)
+    report = Ingester(args.topic, workers=args.workers).run(args.root)
+    print(json.dumps(asdict(report), indent=2))
@@ -9,7 +9,9 @@ from urllib.parse import urlparse
 
 import git
 #from fastapi.responses import JSONResponse
+from admission import run_then
 from fastapi import HTTPException
+from prompt_budget import fit_texts
 from rag import RagDocument
 from task import Task, TaskStatus
 
@@ -28,6 +30,8 @@ logger = init_logger(__name__)
 # All the project related files, include repository, files generated by agent
 # are saved in a folder generated by owner&repo under WORK_SPACE
 WORK_SPACE = tempfile.gettempdir() + "/ailint/workspace"
+# at most this many tokens of related documents are added to a dev prompt
+DEV_DOCS_MAX_TOKENS = int(os.getenv("DEV_DOCS_MAX_TOKENS", "4000"))
 
 # Python built-in dict is multi-thread safe for single operation
 # But not for operations like: dict[i] = dick[j], dict[i] += 1 etc
@@ -38,7 +42,7 @@ tasks: Dict[str, Task] = {}
 
 class SWEAgent:
 
-    def __init__(self, data_path, repo_path, task, model):
+    def __init__(self, data_path, repo_path, task, model, on_exit=None):
         '''
         data_path: the path to the issue file, should be end with .md or .txt
         repo_path: the path to the repo directory, should be clean except the issue file
@@ -51,6 +55,8 @@ class SWEAgent:
         else:
             self.model_name = model
         self.task = task
+        # called when the agent thread exits
+        self.on_exit = on_exit
 
     def run(self):
         '''
@@ -67,7 +73,7 @@ class SWEAgent:
         ])
         run_main = run.Main(script_args)
         run_main.agent.add_hook(StepHook(self.task))
-        Thread(target=run_main.main).start()
+        Thread(target=run_then(run_main.main, self.on_exit)).start()
         return os.path.join(swe_dir, run_main.traj_dir)
 
 
@@ -199,12 +205,12 @@ def clone_repo(url_obj, token=None, folder_suffix=""):
 
 
 # The handler function for repo prompt
-def handle_prompt(request) -> str:
+def handle_prompt(request, on_exit=None) -> str:
     """
     The worker function to handle a dev request for a  project based
     prompt
     The promptObj contains "repo", "token" and "prompt"
-    create swe-agent task
+    create swe-agent task, on_exit is called when the agent thread exits
     return taskID
     """
     new_task = Task(request.prompt)
@@ -231,10 +237,11 @@ def handle_prompt(request) -> str:
             # Use Rag if topic is contained in the request
             if request.topic:
                 prompt_file.write("Related Documents below:\n")
-                # Add the top 2 documents into the prompt
+                # Add the top 2 documents into the prompt, cut to the budget
                 rag = RagDocument()
                 related_docs = rag.get_docs(request.prompt, request.topic)
-                related_docs = related_docs[:2]
+                related_docs, _ = fit_texts(related_docs[:2],
+                                            DEV_DOCS_MAX_TOKENS)
                 for idx, doc in enumerate(related_docs, start=1):
                     prompt_file.write(f"Document_{idx}: {doc}\n\n")
                 logger.info(f"prompt_file_name, {prompt_file_name}")
@@ -247,7 +254,7 @@ def handle_prompt(request) -> str:
 
     try:
         agent = SWEAgent(prompt_file_name, repo_folder, new_task,
-                         request.model)
+                         request.model, on_exit)
         result_dir = agent.run()
         new_task.set_data_dir(result_dir)
     except Exception as e:
@@ -0,0 +1,200 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+from threading import Lock
+from typing import Dict, Optional
+
+from logger import init_logger
+
+logger = init_logger(__name__)
+
+# Lint results are cached in two tiers:
+#   1. an in-memory LRU for the hot files CI keeps re-linting
+#   2. an on-disk tier which survives restarts, evicted by total size
+# Both tiers are content addressed, the key covers everything that could
+# change the LLM answer: code, topic, model, prompt template and the
+# version of the RAG documents registered under the topic.
+LINT_CACHE_DIR = os.getenv("LINT_CACHE_DIR",
+                           tempfile.gettempdir() + "/ailint/lint_cache")
+LINT_CACHE_MEM_ENTRIES = int(os.getenv("LINT_CACHE_MEM_ENTRIES", "1024"))
+LINT_CACHE_DISK_BYTES = int(
+    os.getenv("LINT_CACHE_DISK_BYTES", str(512 * 1024 * 1024)))
+
+# version file is shared with other processes (ui.py registers documents too)
+VERSIONS_FILE = "topic_versions.json"
+
+
+def _topic_dir(topic: str) -> str:
+    return hashlib.sha256(topic.encode("utf-8")).hexdigest()[:16]
+
+
+class LintCache(object):
+
+    def __init__(self,
+                 cache_dir: str = LINT_CACHE_DIR,
+                 max_entries: int = LINT_CACHE_MEM_ENTRIES,
+                 max_disk_bytes: int = LINT_CACHE_DISK_BYTES):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_disk_bytes = max_disk_bytes
+        self._lock = Lock()
+        # key => (topic, value)
+        self._mem: OrderedDict[str, tuple[str, str]] = OrderedDict()
+        self._versions: Dict[str, int] = {}
+        self._versions_mtime = 0.0
+        os.makedirs(os.path.join(self.cache_dir, "entries"), exist_ok=True)
+        self._disk_bytes = self._scan_disk_bytes()
+
+    def _versions_path(self) -> str:
+        return os.path.join(self.cache_dir, VERSIONS_FILE)
+
+    def _entry_path(self, key: str, topic: str) -> str:
+        return os.path.join(self.cache_dir, "entries", _topic_dir(topic),
+                            key + ".json")
+
+    def _scan_disk_bytes(self) -> int:
+        total = 0
+        for root, _, files in os.walk(os.path.join(self.cache_dir, "entries")):
+            for f in files:
+                try:
+                    total += os.path.getsize(os.path.join(root, f))
+                except OSError:
+                    pass
+        return total
+
+    def _reload_versions(self):
+        """
+        reload topic versions if another process bumped them.
+        caller must hold self._lock
+        """
+        try:
+            mtime = os.path.getmtime(self._versions_path())
+        except OSError:
+            return
+        if mtime == self._versions_mtime:
+            return
+        try:
+            with open(self._versions_path()) as f:
+                self._versions = json.load(f)
+            self._versions_mtime = mtime
+        except (OSError, ValueError) as e:
+            logger.warning(f"failed to load lint cache topic versions: {e}")
+
+    def _write_file(self, path: str, content: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "w") as f:
+            f.write(content)
+        os.replace(tmp, path)
+
+    def topic_version(self, topic: str) -> int:
+        with self._lock:
+            self._reload_versions()
+            return self._versions.get(topic, 0)
+
+    def make_key(self, code: str, topic: str, model: str,
+                 template: str) -> str:
+        h = hashlib.sha256()
+        for part in (code, topic, model, template,
+                     str(self.topic_version(topic))):
+            h.update(part.encode("utf-8"))
+            h.update(b"\0")
+        return h.hexdigest()
+
+    def get(self, key: str, topic: str) -> Optional[str]:
+        with self._lock:
+            if key in self._mem:
+                self._mem.move_to_end(key)
+                return self._mem[key][1]
+
+        path = self._entry_path(key, topic)
+        try:
+            with open(path) as f:
+                value = json.load(f)["value"]
+            # bump mtime, disk eviction is LRU on mtime
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            return None
+        self._put_mem(key, topic, value)
+        return value
+
+    def _put_mem(self, key: str, topic: str, value: str):
+        with self._lock:
+            self._mem[key] = (topic, value)
+            self._mem.move_to_end(key)
+            while len(self._mem) > self.max_entries:
+                self._mem.popitem(last=False)
+
+    def put(self, key: str, topic: str, value: str):
+        self._put_mem(key, topic, value)
+        content = json.dumps({"topic": topic, "value": value})
+        try:
+            self._write_file(self._entry_path(key, topic), content)
+        except OSError as e:
+            logger.warning(f"failed to write lint cache entry: {e}")
+            return
+        with self._lock:
+            self._disk_bytes += len(content)
+            over = self._disk_bytes > self.max_disk_bytes
+        if over:
+            self._evict_disk()
+
+    def _evict_disk(self):
+        """
+        drop the least recently used entries until the disk tier is
+        below 90% of its budget
+        """
+        entries = []
+        for root, _, files in os.walk(os.path.join(self.cache_dir, "entries")):
+            for f in files:
+                path = os.path.join(root, f)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        entries.sort()
+        total = sum(e[1] for e in entries)
+        target = int(self.max_disk_bytes * 0.9)
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        with self._lock:
+            self._disk_bytes = total
+        logger.debug(f"lint cache evicted, disk usage {total} bytes")
+
+    def invalidate_topic(self, topic: str):
+        """
+        called when documents of the topic changed. bumping the version
+        makes every key of the topic unreachable, old entries are removed
+        right away to give the space back.
+        """
+        with self._lock:
+            self._reload_versions()
+            self._versions[topic] = self._versions.get(topic, 0) + 1
+            try:
+                self._write_file(self._versions_path(),
+                                 json.dumps(self._versions))
+                self._versions_mtime = os.path.getmtime(self._versions_path())
+            except OSError as e:
+                logger.warning(
+                    f"failed to persist lint cache topic versions: {e}")
+            for key in [k for k, v in self._mem.items() if v[0] == topic]:
+                del self._mem[key]
+        shutil.rmtree(os.path.join(self.cache_dir, "entries",
+                                   _topic_dir(topic)),
+                      ignore_errors=True)
+        with self._lock:
+            self._disk_bytes = self._scan_disk_bytes()
+        logger.info(f"lint cache invalidated for topic {topic}")
+
+
+lint_cache = LintCache()
@@ -0,0 +1,199 @@
+import email.utils
+import os
+import random
+import time
+from threading import BoundedSemaphore, Lock
+from typing import Dict, Optional
+
+import httpx
+from logger import init_logger
+from openai import OpenAI
+
+logger = init_logger(__name__)
+
+# Process wide LLM HTTP clients. Every OpenAI compatible backend gets one
+# pooled httpx client, so connections (and their TLS sessions) are kept
+# alive and reused by lint, TF generation and whatever comes next.
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "120"))
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "5"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "0.5"))
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "20"))
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "64"))
+LLM_KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "120"))
+# in-flight requests per backend, LLM_CONCURRENCY_OPENAI=8 ...
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "16"))
+
+# http2 needs the optional h2 package
+has_http2 = False
+try:
+    import h2  # noqa: F401
+    has_http2 = True
+except ImportError as _:
+    pass
+
+# chat completions are not idempotent, a request the server may have
+# processed is never sent again: only the rejections which tell when to
+# retry (Retry-After) ...
+RETRY_STATUS = {429, 503}
+# ... and the errors raised before the request reached the server
+RETRY_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+def backoff(attempt: int) -> float:
+    """
+    exponential backoff with full jitter
+    """
+    return random.uniform(0, min(LLM_BACKOFF_MAX,
+                                 LLM_BACKOFF_BASE * 2**attempt))
+
+
+def retry_after(response: httpx.Response) -> Optional[float]:
+    value = response.headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return min(float(value), LLM_BACKOFF_MAX)
+    except ValueError:
+        pass
+    date = email.utils.parsedate_to_datetime(value)
+    if date is None:
+        return None
+    return min(max(date.timestamp() - time.time(), 0), LLM_BACKOFF_MAX)
+
+
+class _ReleasingStream(httpx.SyncByteStream):
+    """
+    keep the backend slot until the body is consumed, LLM answers are
+    often streamed for a long time after the headers arrived
+    """
+
+    def __init__(self, stream: httpx.SyncByteStream, release):
+        self._stream = stream
+        self._release = release
+
+    def __iter__(self):
+        for chunk in self._stream:
+            yield chunk
+
+    def close(self):
+        try:
+            self._stream.close()
+        finally:
+            self._release()
+
+
+class BackendTransport(httpx.BaseTransport):
+    """
+    caps the in-flight requests of one backend and retries the requests
+    which did not reach it, with jittered exponential backoff, and the
+    ones it rejected with a Retry-After
+    """
+
+    def __init__(self, backend: str, concurrency: int, max_retries: int):
+        self.backend = backend
+        self.max_retries = max_retries
+        self._slots = BoundedSemaphore(concurrency)
+        self._transport = httpx.HTTPTransport(
+            http2=has_http2,
+            limits=httpx.Limits(max_connections=LLM_MAX_CONNECTIONS,
+                                max_keepalive_connections=LLM_MAX_CONNECTIONS,
+                                keepalive_expiry=LLM_KEEPALIVE_EXPIRY))
+
+    def _send(self, request: httpx.Request) -> httpx.Response:
+        for attempt in range(self.max_retries + 1):
+            last = attempt == self.max_retries
+            try:
+                response = self._transport.handle_request(request)
+            except RETRY_ERRORS as e:
+                if last:
+                    raise
+                delay = backoff(attempt)
+                logger.warning(f"{self.backend}: {e!r}, retry in {delay:.2f}s")
+                time.sleep(delay)
+                continue
+            if response.status_code not in RETRY_STATUS or last:
+                return response
+            delay = retry_after(response)
+            if delay is None:
+                return response
+            response.close()
+            logger.warning(f"{self.backend}: http {response.status_code}, "
+                           f"retry in {delay:.2f}s")
+            time.sleep(delay)
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        self._slots.acquire()
+        try:
+            response = self._send(request)
+        except BaseException:
+            self._slots.release()
+            raise
+        released = Lock()
+
+        def release():
+            # close could be called more than once
+            if released.acquire(blocking=False):
+                self._slots.release()
+
+        return httpx.Response(status_code=response.status_code,
+                              headers=response.headers,
+                              stream=_ReleasingStream(response.stream,
+                                                      release),
+                              extensions=response.extensions)
+
+    def close(self):
+        self._transport.close()
+
+
+_lock = Lock()
+_http_clients: Dict[str, httpx.Client] = {}
+_openai_clients: Dict[tuple, OpenAI] = {}
+
+
+def http_client(backend: str) -> httpx.Client:
+    """
+    the pooled http client of backend, shared by the whole process
+    """
+    with _lock:
+        if backend not in _http_clients:
+            concurrency = int(
+                os.getenv("LLM_CONCURRENCY_" + backend.upper(),
+                          str(LLM_CONCURRENCY)))
+            _http_clients[backend] = httpx.Client(
+                transport=BackendTransport(backend, concurrency,
+                                           LLM_MAX_RETRIES),
+                timeout=httpx.Timeout(LLM_TIMEOUT,
+                                      connect=LLM_CONNECT_TIMEOUT))
+            logger.info(f"llm client for {backend}: concurrency "
+                        f"{concurrency}, http2 {has_http2}")
+        return _http_clients[backend]
+
+
+def openai_client(backend: str,
+                  api_key: Optional[str] = None,
+                  base_url: Optional[str] = None) -> OpenAI:
+    """
+    OpenAI SDK client on top of the shared http client, retries are done
+    by the transport so the SDK ones are disabled
+    """
+    key = (backend, api_key, base_url)
+    with _lock:
+        if key in _openai_clients:
+            return _openai_clients[key]
+    client = OpenAI(api_key=api_key,
+                    base_url=base_url,
+                    http_client=http_client(backend),
+                    max_retries=0,
+                    timeout=httpx.Timeout(LLM_TIMEOUT,
+                                          connect=LLM_CONNECT_TIMEOUT))
+    with _lock:
+        return _openai_clients.setdefault(key, client)
+
+
+def close():
+    with _lock:
+        for client in _http_clients.values():
+            client.close()
+        _http_clients.clear()
+        _openai_clients.clear()
@@ -0,0 +1,658 @@
+"""
+in-process vector store, RAG without a qdrant server (RAG_STORE=local).
+
+one directory per collection:
+  meta.json     dimension and capacity of the vector file
+  vectors.f32   memory-mapped normalized vectors, one row per document
+  docs.jsonl    payloads: {"row", "gen", "list", "doc"} writes a row,
+                {"delete": row} frees it. a line is written after its
+                vector, a torn last line is dropped on load.
+  ivf.npz       IVF centroids, the inverted list of each row and the
+                generation of the training
+the rows freed by overwrites and deletes are reused, and docs.jsonl is
+rewritten with the live documents once it holds twice as many lines.
+small collections are searched exactly; from LOCAL_IVF_MIN_ROWS rows on,
+an IVF index built by k-means in a background thread restricts the search
+to the LOCAL_IVF_NPROBE lists closest to the query.
+one process writes a collection, the others read it.
+"""
+import fcntl
+import json
+import os
+import tempfile
+from bisect import bisect_left, insort
+from dataclasses import replace
+from threading import Lock, RLock, Thread
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from haystack import Document, component
+from haystack.document_stores.errors import DuplicateDocumentError
+from haystack.document_stores.types import DuplicatePolicy
+from logger import init_logger
+
+logger = init_logger(__name__)
+
+LOCAL_STORE_DIR = os.getenv("LOCAL_STORE_DIR",
+                            tempfile.gettempdir() + "/ailint/vectors")
+LOCAL_IVF_MIN_ROWS = int(os.getenv("LOCAL_IVF_MIN_ROWS", "20000"))
+LOCAL_IVF_NPROBE = int(os.getenv("LOCAL_IVF_NPROBE", "16"))
+# k-means trains on a sample
+_IVF_TRAIN_SAMPLE = 50000
+_IVF_ITERATIONS = 10
+# docs.jsonl lines tolerated beyond twice the documents
+_COMPACT_SLACK = 10000
+
+
+def _value(doc: Document, field: str):
+    if field.startswith("meta."):
+        return doc.meta.get(field[len("meta."):])
+    return getattr(doc, field, None)
+
+
+def _compare(op: str, value, target) -> bool:
+    if value is None:
+        return False
+    try:
+        if op == ">":
+            return value > target
+        if op == ">=":
+            return value >= target
+        if op == "<":
+            return value < target
+        return value <= target
+    except TypeError:
+        return False
+
+
+def matches(filters: Optional[Dict[str, Any]], doc: Document) -> bool:
+    """
+    haystack filters with qdrant semantics: a condition on a list field
+    matches when one of its values does
+    """
+    if not filters:
+        return True
+    op = filters["operator"]
+    if "conditions" in filters:
+        results = (matches(c, doc) for c in filters["conditions"])
+        if op == "AND":
+            return all(results)
+        if op == "OR":
+            return any(results)
+        if op == "NOT":
+            return not all(results)
+        raise ValueError(f"unknown operator {op}")
+    value = _value(doc, filters["field"])
+    values = value if isinstance(value, list) else [value]
+    target = filters["value"]
+    if op == "==":
+        return target in values
+    if op == "!=":
+        return target not in values
+    if op == "in":
+        return any(v in target for v in values)
+    if op == "not in":
+        return not any(v in target for v in values)
+    if op in (">", ">=", "<", "<="):
+        return any(_compare(op, v, target) for v in values)
+    raise ValueError(f"unknown operator {op}")
+
+
+def _topic(filters: Optional[Dict[str, Any]]) -> Optional[str]:
+    """
+    topic the filters require, the documents of other topics are skipped
+    without evaluating the filters
+    """
+    if not filters:
+        return None
+    if filters.get("field") == "meta.topic" and filters["operator"] == "==":
+        return filters["value"]
+    if filters.get("operator") == "AND" and "conditions" in filters:
+        for condition in filters["conditions"]:
+            topic = _topic(condition)
+            if topic is not None:
+                return topic
+    return None
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class IVFIndex(object):
+    """
+    inverted lists of the rows closest to each k-means centroid
+    """
+
+    def __init__(self, centroids: np.ndarray, assign: np.ndarray,
+                 generation: int):
+        self.centroids = centroids
+        # list of each row, -1 for a free row
+        self.assign = assign
+        self.trained_rows = int((assign >= 0).sum())
+        # the lists of docs.jsonl are those of this training when they carry
+        # its generation
+        self.generation = generation
+        self._lists: Optional[List[np.ndarray]] = None
+
+    @classmethod
+    def train(cls, vectors: np.ndarray, rows: np.ndarray,
+              generation: int) -> "IVFIndex":
+        rng = np.random.RandomState(0)
+        nlist = max(int(4 * np.sqrt(len(rows))), 1)
+        sample = vectors[rng.choice(rows,
+                                    min(len(rows), _IVF_TRAIN_SAMPLE),
+                                    replace=False)]
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)]
+        for _ in range(_IVF_ITERATIONS):
+            nearest = np.argmax(sample @ centroids.T, axis=1)
+            for i in range(nlist):
+                members = sample[nearest == i]
+                if len(members):
+                    centroids[i] = members.mean(axis=0)
+            centroids = _normalize(centroids)
+        assign = np.full(len(vectors), -1, dtype=np.int32)
+        for i in range(0, len(rows), 8192):
+            batch = rows[i:i + 8192]
+            assign[batch] = np.argmax(vectors[batch] @ centroids.T, axis=1)
+        return cls(centroids.astype(np.float32), assign, generation)
+
+    def nearest(self, vectors: np.ndarray) -> np.ndarray:
+        return np.argmax(vectors @ self.centroids.T, axis=1).astype(np.int32)
+
+    def grow(self, capacity: int):
+        if capacity > len(self.assign):
+            assign = np.full(capacity, -1, dtype=np.int32)
+            assign[:len(self.assign)] = self.assign
+            self.assign = assign
+
+    def set(self, rows: np.ndarray, lists: np.ndarray):
+        self.assign[rows] = lists
+        self._lists = None
+
+    def list_of(self, row: int) -> Optional[int]:
+        list_id = int(self.assign[row])
+        return None if list_id < 0 else list_id
+
+    def probe(self, query: np.ndarray, nprobe: int) -> np.ndarray:
+        if self._lists is None:
+            order = np.argsort(self.assign, kind="stable")
+            bounds = np.searchsorted(self.assign[order],
+                                     np.arange(len(self.centroids) + 1))
+            self._lists = [
+                order[bounds[i]:bounds[i + 1]]
+                for i in range(len(self.centroids))
+            ]
+        closest = np.argsort(-(self.centroids @ query))[:nprobe]
+        return np.concatenate([self._lists[i] for i in closest])
+
+
+class StoreBusyError(RuntimeError):
+    "the collection is written by another process"
+
+
+class LocalDocumentStore(object):
+    """
+    haystack document store of one collection, shared by the pipelines of
+    the process: see get_local_store(). one process writes a collection,
+    the others open it read_only and reload it when its files change.
+    """
+
+    def __init__(self,
+                 index: str,
+                 embedding_dim: int = 1024,
+                 root: str = LOCAL_STORE_DIR,
+                 read_only: bool = False):
+        self.index = index
+        self.embedding_dim = embedding_dim
+        self.dir = os.path.join(root, index)
+        self.read_only = read_only
+        self._lock = RLock()
+        # documents without embedding by row, None for a free row
+        self._docs: List[Optional[Document]] = []
+        self._rows: Dict[str, int] = {}
+        # ids in order, the pages of scroll_documents; None while loading
+        self._ids: Optional[List[str]] = None
+        self._topics: Dict[str, set] = {}
+        # free rows, reused by the next writes
+        self._free_rows: List[int] = []
+        self._vectors: Optional[np.memmap] = None
+        self._ivf: Optional[IVFIndex] = None
+        # rows written while the IVF trains, None when it does not
+        self._written: Optional[set] = None
+        self._log = None
+        self._log_lines = 0
+        self._stamp = None
+        os.makedirs(self.dir, exist_ok=True)
+        if not read_only:
+            self._lock_file = open(self._path("lock"), "w")
+            try:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                raise StoreBusyError(
+                    f"{self.dir} is written by another process")
+        self._load()
+        if not read_only:
+            self._log = open(self._path("docs.jsonl"), "a")
+        logger.info(f"local store {self.dir}: {len(self._rows)} documents"
+                    f"{', read only' if read_only else ''}")
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.dir, name)
+
+    def _files_stamp(self) -> tuple:
+        stamp = []
+        for name in ("meta.json", "docs.jsonl", "ivf.npz"):
+            try:
+                st = os.stat(self._path(name))
+                stamp.append((st.st_ino, st.st_size, st.st_mtime_ns))
+            except FileNotFoundError:
+                stamp.append(None)
+        return tuple(stamp)
+
+    def _load(self):
+        self._docs, self._rows, self._topics = [], {}, {}
+        self._ids = None
+        self._vectors, self._ivf = None, None
+        self._log_lines = 0
+        self._stamp = self._files_stamp()
+        capacity = 0
+        if os.path.exists(self._path("meta.json")):
+            with open(self._path("meta.json")) as f:
+                meta = json.load(f)
+            if meta["dim"] != self.embedding_dim:
+                raise ValueError(f"{self.dir} holds {meta['dim']}-d vectors")
+            capacity = meta["capacity"]
+        if capacity:
+            self._vectors = np.memmap(self._path("vectors.f32"),
+                                      dtype=np.float32,
+                                      mode="r" if self.read_only else "r+",
+                                      shape=(capacity, self.embedding_dim))
+        ivf = None
+        if os.path.exists(self._path("ivf.npz")) and capacity:
+            data = np.load(self._path("ivf.npz"))
+            generation = int(data["generation"]) if "generation" in data else 0
+            ivf = IVFIndex(data["centroids"], data["assign"], generation)
+        lists = {}
+        if os.path.exists(self._path("docs.jsonl")):
+            with open(self._path("docs.jsonl")) as f:
+                for line in f:
+                    self._log_lines += 1
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        #torn write of the last line
+                        continue
+                    if "delete" in record:
+                        self._free(record["delete"])
+                        lists.pop(record["delete"], None)
+                        continue
+                    row = record["row"]
+                    self._set(row, Document.from_dict(record["doc"]))
+                    #a list of an earlier training is stale, the row keeps
+                    #the one of ivf.npz
+                    if (ivf is not None and record.get("list") is not None
+                            and record.get("gen") == ivf.generation):
+                        lists[row] = record["list"]
+                    else:
+                        lists.pop(row, None)
+        self._free_rows = [r for r, d in enumerate(self._docs) if d is None]
+        self._ids = sorted(self._rows)
+        if ivf is not None:
+            ivf.grow(capacity)
+            if lists:
+                ivf.set(np.array(list(lists.keys())),
+                        np.array(list(lists.values())))
+            #rows freed since the training
+            if self._free_rows:
+                ivf.set(np.array(self._free_rows),
+                        np.full(len(self._free_rows), -1))
+            self._ivf = ivf
+
+    def _refresh(self):
+        "a read only store reloads the files changed by the writer"
+        if self.read_only and self._files_stamp() != self._stamp:
+            self._load()
+
+    def _check_writable(self):
+        if self.read_only:
+            raise StoreBusyError(f"{self.dir} is opened read only, it is "
+                                 "written by another process")
+
+    def _set(self, row: int, doc: Document):
+        while len(self._docs) <= row:
+            self._docs.append(None)
+        self._free(row)
+        old = self._rows.get(doc.id)
+        if old is not None:
+            self._free(old)
+        self._docs[row] = doc
+        self._rows[doc.id] = row
+        if self._ids is not None:
+            insort(self._ids, doc.id)
+        self._topics.setdefault(doc.meta.get("topic"), set()).add(row)
+
+    def _free(self, row: int):
+        if row >= len(self._docs) or self._docs[row] is None:
+            return
+        doc = self._docs[row]
+        self._docs[row] = None
+        self._free_rows.append(row)
+        del self._rows[doc.id]
+        if self._ids is not None:
+            del self._ids[bisect_left(self._ids, doc.id)]
+        self._topics.get(doc.meta.get("topic"), set()).discard(row)
+        if self._ivf is not None and row < len(self._ivf.assign):
+            self._ivf.set(np.array([row]), np.array([-1]))
+
+    def _grow(self, rows: int):
+        capacity = 0 if self._vectors is None else len(self._vectors)
+        if rows <= capacity:
+            return
+        new_capacity = max(1024, capacity * 2, rows)
+        tmp = self._path("vectors.f32.tmp")
+        vectors = np.memmap(tmp,
+                            dtype=np.float32,
+                            mode="w+",
+                            shape=(new_capacity, self.embedding_dim))
+        if capacity:
+            vectors[:capacity] = self._vectors
+            vectors.flush()
+        os.replace(tmp, self._path("vectors.f32"))
+        self._vectors = vectors
+        with open(self._path("meta.json"), "w") as f:
+            json.dump({"dim": self.embedding_dim, "capacity": new_capacity}, f)
+        if self._ivf is not None:
+            self._ivf.grow(new_capacity)
+
+    def _take_rows(self, n: int) -> np.ndarray:
+        """
+        rows of n new documents: the free rows first, then new ones
+        """
+        reused = [
+            self._free_rows.pop() for _ in range(min(n, len(self._free_rows)))
+        ]
+        start = len(self._docs)
+        self._grow(start + n - len(reused))
+        return np.array(reused + list(range(start, start + n - len(reused))),
+                        dtype=np.int64)
+
+    def _record(self, row: int, doc: Document) -> str:
+        list_id, generation = None, None
+        if self._ivf is not None:
+            list_id, generation = self._ivf.list_of(row), self._ivf.generation
+        return json.dumps({
+            "row": row,
+            "gen": generation,
+            "list": list_id,
+            "doc": doc.to_dict(flatten=False)
+        }) + "\n"
+
+    def _maybe_compact(self):
+        """
+        rewrite docs.jsonl with one line per document once the overwritten
+        and deleted ones make up most of it
+        """
+        live = len(self._rows)
+        if self._log_lines <= 2 * live + _COMPACT_SLACK:
+            return
+        tmp = self._path("docs.jsonl.tmp")
+        with open(tmp, "w") as f:
+            for row, doc in enumerate(self._docs):
+                if doc is not None:
+                    f.write(self._record(row, doc))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._path("docs.jsonl"))
+        self._log.close()
+        self._log = open(self._path("docs.jsonl"), "a")
+        logger.info(f"{self.index}: compacted {self._log_lines} records "
+                    f"to {live}")
+        self._log_lines = live
+
+    def _maybe_train(self):
+        """
+        start the training of the IVF index when the collection is large
+        enough, or has doubled since the last one. k-means runs in a thread
+        without the lock, the searches go on with the former index.
+        """
+        count = len(self._rows)
+        if self._written is not None or count < LOCAL_IVF_MIN_ROWS:
+            return
+        if self._ivf is not None and count < 2 * self._ivf.trained_rows:
+            return
+        self._written = set()
+        alive = np.array(sorted(self._rows.values()))
+        generation = 1 if self._ivf is None else self._ivf.generation + 1
+        Thread(target=self._train,
+               args=(self._vectors, alive, generation),
+               name=f"ivf-{self.index}",
+               daemon=True).start()
+
+    def _train(self, vectors: np.ndarray, alive: np.ndarray, generation: int):
+        try:
+            ivf = IVFIndex.train(vectors, alive, generation)
+            with self._lock:
+                #the rows written or freed meanwhile
+                ivf.grow(len(self._vectors))
+                written = np.array(sorted(self._written), dtype=np.int64)
+                if len(written):
+                    ivf.set(written, ivf.nearest(self._vectors[written]))
+                if self._free_rows:
+                    ivf.set(np.array(self._free_rows),
+                            np.full(len(self._free_rows), -1))
+                tmp = self._path("ivf.npz.tmp")
+                with open(tmp, "wb") as f:
+                    np.savez(f,
+                             centroids=ivf.centroids,
+                             assign=ivf.assign,
+                             generation=ivf.generation)
+                os.replace(tmp, self._path("ivf.npz"))
+                self._ivf = ivf
+            logger.info(f"{self.index}: IVF of {len(ivf.centroids)} lists "
+                        f"over {len(alive)} documents")
+        except Exception as e:
+            logger.warning(f"{self.index}: IVF training failed: {e}")
+        finally:
+            with self._lock:
+                self._written = None
+
+    def count_documents(self) -> int:
+        with self._lock:
+            self._refresh()
+            return len(self._rows)
+
+    def topics(self) -> List[str]:
+        "the topics of the documents, the partitions of the collection"
+        with self._lock:
+            self._refresh()
+            return sorted(t for t, rows in self._topics.items()
+                          if rows and t is not None)
+
+    def _matching_rows(self, filters: Optional[Dict[str, Any]]) -> List[int]:
+        topic = _topic(filters)
+        if topic is not None:
+            rows = sorted(self._topics.get(topic, ()))
+        else:
+            rows = sorted(self._rows.values())
+        return [r for r in rows if matches(filters, self._docs[r])]
+
+    def filter_documents(self,
+                         filters: Optional[Dict[str, Any]] = None
+                         ) -> List[Document]:
+        with self._lock:
+            self._refresh()
+            return [self._docs[r] for r in self._matching_rows(filters)]
+
+    def scroll_documents(
+            self,
+            filters: Optional[Dict[str, Any]] = None,
+            cursor: Optional[str] = None,
+            limit: int = 20) -> Tuple[List[Document], Optional[str]]:
+        """
+        one page of the documents matching filters in id order, from the id
+        cursor on, and the id of the next page, None after the last one
+        """
+        with self._lock:
+            self._refresh()
+            docs = []
+            start = 0 if cursor is None else bisect_left(self._ids, cursor)
+            for i in range(start, len(self._ids)):
+                doc = self._docs[self._rows[self._ids[i]]]
+                if not matches(filters, doc):
+                    continue
+                if len(docs) == limit:
+                    return docs, doc.id
+                docs.append(doc)
+            return docs, None
+
+    def write_documents(self,
+                        documents: List[Document],
+                        policy: DuplicatePolicy = DuplicatePolicy.NONE) -> int:
+        with self._lock:
+            self._check_writable()
+            if policy in (DuplicatePolicy.NONE, DuplicatePolicy.FAIL):
+                for doc in documents:
+                    if doc.id in self._rows:
+                        raise DuplicateDocumentError(
+                            f"ID '{doc.id}' already exists.")
+            if policy == DuplicatePolicy.SKIP:
+                documents = [d for d in documents if d.id not in self._rows]
+            if not documents:
+                return 0
+            #a replaced document frees its old row, reused by a later write
+            rows = self._take_rows(len(documents))
+            vectors = _normalize(
+                np.array([d.embedding for d in documents], dtype=np.float32))
+            self._vectors[rows] = vectors
+            self._vectors.flush()
+            if self._ivf is not None:
+                self._ivf.set(rows, self._ivf.nearest(vectors))
+            if self._written is not None:
+                self._written.update(rows.tolist())
+            for row, doc in zip(rows.tolist(), documents):
+                stored = replace(doc, embedding=None, score=None)
+                self._set(row, stored)
+                self._log.write(self._record(row, stored))
+            self._log_lines += len(documents)
+            self._log.flush()
+            self._maybe_compact()
+            self._maybe_train()
+            return len(documents)
+
+    def update_meta(self, documents: List[Document]):
+        """
+        replace the meta of the stored documents, their vectors are kept
+        """
+        with self._lock:
+            self._check_writable()
+            for doc in documents:
+                row = self._rows.get(doc.id)
+                if row is None:
+                    continue
+                old = self._docs[row]
+                stored = replace(old, meta=dict(doc.meta))
+                self._topics.get(old.meta.get("topic"), set()).discard(row)
+                self._topics.setdefault(stored.meta.get("topic"),
+                                        set()).add(row)
+                self._docs[row] = stored
+                self._log.write(self._record(row, stored))
+                self._log_lines += 1
+            self._log.flush()
+            self._maybe_compact()
+
+    def delete_documents(self, document_ids: List[str]):
+        with self._lock:
+            self._check_writable()
+            for id in document_ids:
+                row = self._rows.get(id)
+                if row is None:
+                    continue
+                self._free(row)
+                self._log.write(json.dumps({"delete": row}) + "\n")
+                self._log_lines += 1
+            self._log.flush()
+            self._maybe_compact()
+
+    def query_by_embedding(self,
+                           query_embedding: List[float],
+                           filters: Optional[Dict[str, Any]] = None,
+                           top_k: int = 10) -> List[Document]:
+        """
+        cosine similarity scaled to [0, 1], as the qdrant retriever
+        """
+        query = _normalize(np.array(query_embedding, dtype=np.float32))
+        with self._lock:
+            self._refresh()
+            if not self._rows:
+                return []
+            if filters:
+                rows = np.array(self._matching_rows(filters), dtype=np.int64)
+            else:
+                rows = np.array(sorted(self._rows.values()), dtype=np.int64)
+            if self._ivf is not None and len(rows) > LOCAL_IVF_MIN_ROWS:
+                probed = self._ivf.probe(query, LOCAL_IVF_NPROBE)
+                rows = np.intersect1d(rows, probed, assume_unique=True)
+            if not len(rows):
+                return []
+            scores = self._vectors[rows] @ query
+            k = min(top_k, len(rows))
+            best = np.argpartition(-scores, k - 1)[:k]
+            best = best[np.argsort(-scores[best])]
+            return [
+                replace(self._docs[rows[i]], score=float(scores[i] + 1) / 2)
+                for i in best
+            ]
+
+
+_stores_lock = Lock()
+_stores: Dict[str, LocalDocumentStore] = {}
+
+
+def get_local_store(index: str,
+                    embedding_dim: int = 1024) -> LocalDocumentStore:
+    """
+    the store of collection index, opened on first use. read only when
+    another process writes it: the api owns the collection, ui.py and the
+    command line tools can still read it, their writes fail.
+    """
+    with _stores_lock:
+        store = _stores.get(index)
+        if store is None:
+            try:
+                store = LocalDocumentStore(index, embedding_dim)
+            except StoreBusyError as e:
+                logger.warning(f"{e}, opened read only")
+                store = LocalDocumentStore(index,
+                                           embedding_dim,
+                                           read_only=True)
+            _stores[index] = store
+        return store
+
+
+@component
+class LocalEmbeddingRetriever:
+    """
+    same input and output as QdrantEmbeddingRetriever
+    """
+
+    def __init__(self,
+                 document_store: LocalDocumentStore,
+                 filters: Optional[Dict[str, Any]] = None,
+                 top_k: int = 10):
+        self.document_store = document_store
+        self.filters = filters
+        self.top_k = top_k
+
+    @component.output_types(documents=List[Document])
+    def run(self,
+            query_embedding: List[float],
+            filters: Optional[Dict[str, Any]] = None,
+            top_k: Optional[int] = None):
+        return {
+            "documents":
+            self.document_store.query_by_embedding(query_embedding, filters
+                                                   or self.filters, top_k
+                                                   or self.top_k)
+        }
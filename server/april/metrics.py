@@ -1,8 +1,10 @@
+import bisect
 import json
 import os
 from dataclasses import dataclass
 from datetime import datetime
-from typing import List
+from threading import Lock
+from typing import Dict, List, Sequence
 
 from pydantic import BaseModel
 
@@ -26,6 +28,78 @@ class LintPoint:
     dur: float
 
 
+class Counter(object):
+
+    def __init__(self):
+        self._lock = Lock()
+        self._value = 0
+
+    def inc(self, n: int = 1):
+        with self._lock:
+            self._value += n
+
+    def snapshot(self):
+        with self._lock:
+            return self._value
+
+
+class Histogram(object):
+    """
+    cumulative counts of observations less or equal to each bucket bound
+    """
+
+    def __init__(self, buckets: Sequence[float]):
+        self._lock = Lock()
+        self.buckets = sorted(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._count = 0
+        self._sum = 0.0
+
+    def observe(self, value: float):
+        with self._lock:
+            self._counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._count += 1
+            self._sum += value
+
+    def snapshot(self):
+        with self._lock:
+            buckets = {}
+            total = 0
+            for bound, n in zip(self.buckets + ["+Inf"], self._counts):
+                total += n
+                buckets[str(bound)] = total
+            return {"count": self._count, "sum": self._sum, "buckets": buckets}
+
+
+# runtime metrics of the API server, exposed by GET /metrics
+_registry_lock = Lock()
+_registry: Dict[str, object] = {}
+
+
+def counter(name: str) -> Counter:
+    with _registry_lock:
+        return _registry.setdefault(name, Counter())
+
+
+def histogram(name: str, buckets: Sequence[float]) -> Histogram:
+    with _registry_lock:
+        return _registry.setdefault(name, Histogram(buckets))
+
+
+def register(name: str, metric):
+    """
+    expose any object with a snapshot() method
+    """
+    with _registry_lock:
+        _registry[name] = metric
+
+
+def snapshot() -> Dict:
+    with _registry_lock:
+        items = list(_registry.items())
+    return {name: m.snapshot() for name, m in items}
+
+
 def find_traj_files(directory):
     for root, dirs, files in os.walk(directory):
         for file in files:
@@ -0,0 +1,322 @@
+"""
+RAG layout: every topic is a partition of the shared collection, keyed by
+meta.topic. lint, dev and the ingestion tools all read and write it, a
+search of a topic is a filtered search.
+
+keyword payload indexes on the filtered fields keep filtered searches
+flat as topics grow. meta.topic is a tenant index: qdrant (>= 1.11)
+stores the points of a topic together.
+
+usage: python partition.py migrate cannyls-go [--drop]
+copies a collection of the former one-collection-per-topic layout into
+its partition.
+usage: python partition.py backfill
+numbers the chunks written before the chunks carried meta.split_id, the
+documents are listed by their first chunk.
+"""
+import argparse
+from threading import Lock
+from typing import Dict, List, Optional, Set, Tuple
+
+from haystack_integrations.document_stores.qdrant.converters import convert_id
+from haystack_integrations.document_stores.qdrant.filters import \
+    convert_filters_to_qdrant
+from local_store import LocalDocumentStore
+from logger import init_logger
+from qdrant_client.http import models as rest
+
+logger = init_logger(__name__)
+
+TOPIC_FIELD = "meta.topic"
+# fields of the filters of rag, dedup, reindex and the listing, and their
+# type
+INDEXED_FIELDS = {
+    TOPIC_FIELD: rest.PayloadSchemaType.KEYWORD,
+    "meta.document_name": rest.PayloadSchemaType.KEYWORD,
+    "meta.file_path": rest.PayloadSchemaType.KEYWORD,
+    "meta.split_id": rest.PayloadSchemaType.INTEGER,
+    "meta.content_hash": rest.PayloadSchemaType.KEYWORD,
+    "meta.minhash_bands": rest.PayloadSchemaType.KEYWORD,
+    "meta.aliases": rest.PayloadSchemaType.KEYWORD,
+}
+# a document is listed by its first chunk
+FIRST_CHUNK = {"field": "meta.split_id", "operator": "==", "value": 0}
+
+_indexed_lock = Lock()
+_indexed: Set[str] = set()
+
+
+def topic_filter(topic: str) -> Dict:
+    return {"field": TOPIC_FIELD, "operator": "==", "value": topic}
+
+
+def all_of(*conditions: Optional[Dict]) -> Dict:
+    "AND of the conditions which are set"
+    return {"operator": "AND", "conditions": [c for c in conditions if c]}
+
+
+def _tenant_schema():
+    if hasattr(rest, "KeywordIndexParams"):
+        return rest.KeywordIndexParams(type=rest.KeywordIndexType.KEYWORD,
+                                       is_tenant=True)
+    return rest.PayloadSchemaType.KEYWORD
+
+
+def ensure_payload_indexes(client, collection: str):
+    """
+    create the missing payload indexes of collection, once per process
+    """
+    with _indexed_lock:
+        if collection in _indexed:
+            return
+        _indexed.add(collection)
+    try:
+        existing = client.get_collection(collection).payload_schema or {}
+        for field, schema in INDEXED_FIELDS.items():
+            if field in existing:
+                continue
+            tenant = field == TOPIC_FIELD
+            try:
+                client.create_payload_index(
+                    collection,
+                    field,
+                    _tenant_schema() if tenant else schema,
+                    wait=False)
+            except Exception:
+                if not tenant:
+                    raise
+                #server older than tenant indexes
+                client.create_payload_index(collection,
+                                            field,
+                                            schema,
+                                            wait=False)
+            logger.info(f"{collection}: payload index on {field}")
+    except Exception as e:
+        logger.warning(f"{collection}: failed to create payload indexes: {e}")
+
+
+def distinct_topics(client, collection: str) -> List[str]:
+    """
+    one indexed lookup per topic: the next point of a topic not seen yet
+    """
+    topics: List[str] = []
+    no_topic = rest.IsEmptyCondition(is_empty=rest.PayloadField(
+        key=TOPIC_FIELD))
+    while True:
+        must_not = [no_topic]
+        if topics:
+            must_not.append(
+                rest.FieldCondition(key=TOPIC_FIELD,
+                                    match=rest.MatchAny(any=topics)))
+        points, _ = client.scroll(collection,
+                                  scroll_filter=rest.Filter(must_not=must_not),
+                                  limit=1,
+                                  with_payload=[TOPIC_FIELD],
+                                  with_vectors=False)
+        if not points:
+            return sorted(topics)
+        topics.append(points[0].payload["meta"]["topic"])
+
+
+def count_chunks(store, filters: Optional[Dict]) -> int:
+    """
+    number of chunks matching filters, the payloads are not read
+    """
+    if isinstance(store, LocalDocumentStore):
+        if not filters:
+            return store.count_documents()
+        return len(store.filter_documents(filters))
+    return store.client.count(store.index,
+                              count_filter=convert_filters_to_qdrant(filters),
+                              exact=True).count
+
+
+def scroll_chunks(store,
+                  filters: Optional[Dict],
+                  fields: List[str],
+                  cursor: Optional[str] = None,
+                  limit: int = 20) -> Tuple[List[Dict], Optional[str]]:
+    """
+    one page of the chunks matching filters in id order, from cursor on.
+    return the meta fields of each chunk and the cursor of the next page,
+    None after the last one.
+    """
+    if isinstance(store, LocalDocumentStore):
+        docs, next_cursor = store.scroll_documents(filters, cursor, limit)
+        return [{f: d.meta.get(f) for f in fields} for d in docs], next_cursor
+    points, next_cursor = store.client.scroll(
+        store.index,
+        scroll_filter=convert_filters_to_qdrant(filters),
+        limit=limit,
+        offset=cursor,
+        with_payload=[f"meta.{f}" for f in fields],
+        with_vectors=False)
+    metas = [point.payload.get("meta", {}) for point in points]
+    return metas, None if next_cursor is None else str(next_cursor)
+
+
+def update_meta(store, docs: List):
+    """
+    replace the meta of stored chunks, their content and vectors are kept
+    """
+    if not docs:
+        return
+    if isinstance(store, LocalDocumentStore):
+        store.update_meta(docs)
+        return
+    store.client.batch_update_points(store.index, [
+        rest.SetPayloadOperation(set_payload=rest.SetPayload(
+            payload={"meta": doc.meta}, points=[convert_id(doc.id)]))
+        for doc in docs
+    ],
+                                     wait=True)
+
+
+class SplitIds(object):
+    """
+    split_id of the chunks without one, numbered per document after the
+    chunks of the document numbered in store, from 0 without store
+    """
+
+    def __init__(self, store=None):
+        self.store = store
+        self._next: Dict[Tuple[Optional[str], str], int] = {}
+
+    def next(self, topic: Optional[str], document_name: str) -> int:
+        key = (topic, document_name)
+        if key not in self._next and self.store is None:
+            self._next[key] = 0
+        if key not in self._next:
+            scope = topic_filter(topic) if topic is not None else None
+            name = {
+                "field": "meta.document_name",
+                "operator": "==",
+                "value": document_name
+            }
+            numbered = {"field": "meta.split_id", "operator": ">=", "value": 0}
+            self._next[key] = count_chunks(self.store,
+                                           all_of(scope, name, numbered))
+        split_id = self._next[key]
+        self._next[key] += 1
+        return split_id
+
+
+def _document_name(meta: Dict, default: str) -> str:
+    return meta.get("document_name") or meta.get("file_path") or meta.get(
+        "name") or default
+
+
+def migrate(collection: str,
+            topic: Optional[str] = None,
+            drop: bool = False,
+            batch: int = 256) -> int:
+    """
+    copy the points of collection, with their vectors, into the partition
+    of topic (the collection name by default). return the number copied.
+    """
+    from common import INDEX_NAME, get_document_store
+    from haystack import Document
+    from haystack.document_stores.types import DuplicatePolicy
+    from sparse_index import sparse_index
+
+    target = get_document_store()
+    if isinstance(target, LocalDocumentStore):
+        raise ValueError("only qdrant collections can be migrated")
+    topic = topic or collection
+    source = get_document_store(index=collection)
+    #the points of a document are all copied, a copy run again numbers
+    #them the same
+    split_ids = SplitIds()
+    copied = 0
+    offset = None
+    while True:
+        points, offset = source.client.scroll(collection,
+                                              limit=batch,
+                                              offset=offset,
+                                              with_payload=True,
+                                              with_vectors=True)
+        docs = []
+        for point in points:
+            doc = Document.from_dict({
+                **point.payload, "embedding": point.vector
+            })
+            doc.meta["topic"] = topic
+            doc.meta["document_name"] = _document_name(doc.meta, doc.id)
+            if doc.meta.get("split_id") is None:
+                doc.meta["split_id"] = split_ids.next(
+                    topic, doc.meta["document_name"])
+            docs.append(doc)
+        if docs:
+            target.write_documents(docs, policy=DuplicatePolicy.OVERWRITE)
+            sparse_index.add(INDEX_NAME, docs)
+            copied += len(docs)
+        if offset is None:
+            break
+    logger.info(f"copied {copied} points of {collection} to topic {topic}")
+    if drop:
+        source.client.delete_collection(collection)
+    return copied
+
+
+def backfill(batch: int = 256) -> int:
+    """
+    number the chunks of the RAG collection without meta.split_id, which
+    haystack's former DocumentSplitter did not set: the first one of a
+    document becomes its first chunk and lists it. return the number of
+    chunks numbered.
+    """
+    from common import INDEX_NAME, get_document_store
+
+    store = get_document_store()
+    if isinstance(store, LocalDocumentStore):
+        raise ValueError("the chunks of the local store are numbered")
+    split_ids = SplitIds(store)
+    unnumbered = rest.Filter(must=[
+        rest.IsEmptyCondition(is_empty=rest.PayloadField(key="meta.split_id"))
+    ])
+    numbered = 0
+    while True:
+        #the numbered points leave the filter, each scroll starts over
+        points, _ = store.client.scroll(INDEX_NAME,
+                                        scroll_filter=unnumbered,
+                                        limit=batch,
+                                        with_payload=["meta"],
+                                        with_vectors=False)
+        if not points:
+            break
+        operations = []
+        for point in points:
+            meta = point.payload.get("meta") or {}
+            meta["document_name"] = _document_name(meta, str(point.id))
+            meta["split_id"] = split_ids.next(meta.get("topic"),
+                                              meta["document_name"])
+            operations.append(
+                rest.SetPayloadOperation(set_payload=rest.SetPayload(
+                    payload={"meta": meta}, points=[point.id])))
+        store.client.batch_update_points(INDEX_NAME, operations, wait=True)
+        numbered += len(points)
+    logger.info(f"numbered {numbered} chunks of {INDEX_NAME}")
+    return numbered
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="RAG topic partitions")
+    sub = parser.add_subparsers(dest="command", required=True)
+    cmd = sub.add_parser("migrate",
+                         help="copy a per-topic collection into its topic")
+    cmd.add_argument("collection")
+    cmd.add_argument("--topic", help="the collection name by default")
+    cmd.add_argument("--drop",
+                     action="store_true",
+                     help="delete the collection once copied")
+    cmd = sub.add_parser("backfill",
+                         help="number the chunks written without split_id")
+    cmd.add_argument("--batch",
+                     type=int,
+                     default=256,
+                     help="points numbered per request")
+    args = parser.parse_args()
+    if args.command == "migrate":
+        migrate(args.collection, args.topic, args.drop)
+    elif args.command == "backfill":
+        backfill(args.batch)
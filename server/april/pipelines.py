@@ -0,0 +1,112 @@
+import os
+import queue
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import Lock
+from typing import Callable, Hashable, Optional
+
+from haystack import Pipeline
+from logger import init_logger
+
+logger = init_logger(__name__)
+
+# haystack Pipeline.run is not re-entrant: components keep per-run state.
+# So each (backend, model, topic) gets a bounded pool of prebuilt pipelines,
+# a request borrows one instance and gives it back when done.
+PIPELINE_POOL_SIZE = int(os.getenv("PIPELINE_POOL_SIZE", "8"))
+# how long a request waits for a free pipeline before giving up
+PIPELINE_ACQUIRE_TIMEOUT = float(os.getenv("PIPELINE_ACQUIRE_TIMEOUT", "300"))
+# keys come from requests (model, topic), the pools least recently used
+# beyond PIPELINE_MAX_POOLS are dropped with their pipelines
+PIPELINE_MAX_POOLS = int(os.getenv("PIPELINE_MAX_POOLS", "32"))
+
+Builder = Callable[[], Pipeline]
+
+
+class PipelinePool(object):
+    """
+    pipelines are built lazily, up to size instances
+    """
+
+    def __init__(self, name: str, builder: Builder, size: int):
+        self.name = name
+        self.builder = builder
+        self.size = size
+        self._idle: queue.Queue = queue.Queue(maxsize=size)
+        self._lock = Lock()
+        self._created = 0
+
+    def _build(self) -> Pipeline:
+        logger.info(f"building pipeline {self.name} "
+                    f"({self._created}/{self.size})")
+        pipe = self.builder()
+        pipe.warm_up()
+        return pipe
+
+    def _get(self, timeout: Optional[float]) -> Pipeline:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            build = self._created < self.size
+            if build:
+                self._created += 1
+        if not build:
+            try:
+                return self._idle.get(timeout=timeout)
+            except queue.Empty:
+                raise TimeoutError(f"no free pipeline for {self.name}")
+        try:
+            return self._build()
+        except Exception:
+            with self._lock:
+                self._created -= 1
+            raise
+
+    @contextmanager
+    def acquire(self, timeout: Optional[float] = PIPELINE_ACQUIRE_TIMEOUT):
+        pipe = self._get(timeout)
+        try:
+            yield pipe
+        finally:
+            self._idle.put(pipe)
+
+
+class PipelineRegistry(object):
+    """
+    LRU of pools. the pipelines borrowed from an evicted pool are returned
+    to it and freed with it.
+    """
+
+    def __init__(self,
+                 size: int = PIPELINE_POOL_SIZE,
+                 max_pools: int = PIPELINE_MAX_POOLS):
+        self.size = size
+        self.max_pools = max_pools
+        self._lock = Lock()
+        self._pools: "OrderedDict[Hashable, PipelinePool]" = OrderedDict()
+
+    def pool(self, key: Hashable, builder: Builder) -> PipelinePool:
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is None:
+                pool = PipelinePool(str(key), builder, self.size)
+                self._pools[key] = pool
+                while len(self._pools) > self.max_pools:
+                    evicted, _ = self._pools.popitem(last=False)
+                    logger.info(f"evicted pipeline pool {evicted}")
+            else:
+                self._pools.move_to_end(key)
+            return pool
+
+    def acquire(self, key: Hashable, builder: Builder):
+        """
+        usage:
+            with registry.acquire(key, builder) as pipe:
+                pipe.run(...)
+        """
+        return self.pool(key, builder).acquire()
+
+
+registry = PipelineRegistry()
@@ -0,0 +1,176 @@
+import os
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from haystack import Document, component
+from logger import init_logger
+
+logger = init_logger(__name__)
+
+# tiktoken is in requirements.txt, without it tokens are overestimated
+# from the length of the text
+has_tiktoken = False
+try:
+    import tiktoken
+    has_tiktoken = True
+except ImportError as _:
+    logger.warning("tiktoken is not installed, a prompt is counted as one "
+                   "token per 3 characters")
+
+# context window of the models we talk to, in tokens
+CONTEXT_WINDOWS = {
+    "gpt-3.5-turbo": 16385,
+    "gpt-4": 8192,
+    "gpt-4-turbo": 128000,
+    "gpt-4o": 128000,
+    "gpt-4o-mini": 128000,
+    "deepseek-ai/deepseek-coder-7b-instruct-v1.5": 4096,
+}
+DEFAULT_CONTEXT_WINDOW = int(os.getenv("DEFAULT_CONTEXT_WINDOW", "8192"))
+
+# USD per 1M tokens: (input, output). local models are free
+PRICES = {
+    "gpt-3.5-turbo": (0.5, 1.5),
+    "gpt-4": (30.0, 60.0),
+    "gpt-4-turbo": (10.0, 30.0),
+    "gpt-4o": (5.0, 15.0),
+    "gpt-4o-mini": (0.15, 0.6),
+}
+
+# tokens kept free for the answer
+MAX_OUTPUT_TOKENS = int(os.getenv("LINT_MAX_OUTPUT_TOKENS", "2048"))
+# at most this many tokens of retrieved documents go into a prompt
+MAX_DOCS_TOKENS = int(os.getenv("LINT_MAX_DOCS_TOKENS", "3000"))
+# a document cut below this size is not worth sending
+MIN_DOC_TOKENS = 64
+
+# BPE tokens of source code are rarely shorter than 3 characters on
+# average, the estimate stays above the real count
+_CHARS_PER_TOKEN = 3
+
+
+class PromptTooLarge(Exception):
+    pass
+
+
+def _encoding(model: str):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+_encodings: Dict[str, object] = {}
+
+
+def count_tokens(text: str, model: str = "gpt-3.5-turbo") -> int:
+    if has_tiktoken:
+        if model not in _encodings:
+            _encodings[model] = _encoding(model)
+        return len(_encodings[model].encode(text, disallowed_special=()))
+    return -(-len(text) // _CHARS_PER_TOKEN)
+
+
+def truncate(text: str, max_tokens: int, model: str = "gpt-3.5-turbo") -> str:
+    if has_tiktoken:
+        if model not in _encodings:
+            _encodings[model] = _encoding(model)
+        enc = _encodings[model]
+        return enc.decode(enc.encode(text, disallowed_special=())[:max_tokens])
+    return text[:max_tokens * _CHARS_PER_TOKEN]
+
+
+def context_window(model: str) -> int:
+    return CONTEXT_WINDOWS.get(model, DEFAULT_CONTEXT_WINDOW)
+
+
+@dataclass
+class PromptPlan:
+    model: str
+    instruction_tokens: int
+    code_tokens: int
+    # documents may use up to this many tokens
+    docs_budget: int
+
+    @property
+    def max_prompt_tokens(self) -> int:
+        return self.instruction_tokens + self.code_tokens + self.docs_budget
+
+    def estimated_cost(self) -> float:
+        """
+        upper bound in USD: every doc slot used, full answer
+        """
+        price_in, price_out = PRICES.get(self.model, (0.0, 0.0))
+        return (self.max_prompt_tokens * price_in +
+                MAX_OUTPUT_TOKENS * price_out) / 1e6
+
+
+def plan_prompt(model: str, template: str, code: str) -> PromptPlan:
+    """
+    give the instructions, the code and the retrieved documents their
+    share of the context window. raise PromptTooLarge before any network
+    call if the code alone does not fit.
+    """
+    instruction_tokens = count_tokens(template, model)
+    code_tokens = count_tokens(code, model)
+    available = context_window(model) - MAX_OUTPUT_TOKENS - instruction_tokens
+    if code_tokens > available:
+        raise PromptTooLarge(
+            f"code is {code_tokens} tokens, {model} only has room for "
+            f"{max(available, 0)}, use chunked lint")
+    docs_budget = min(available - code_tokens, MAX_DOCS_TOKENS)
+    return PromptPlan(model, instruction_tokens, code_tokens, docs_budget)
+
+
+def fit_texts(texts: List[str],
+              budget: int,
+              model: str = "gpt-3.5-turbo") -> Tuple[List[str], int]:
+    """
+    keep texts in rank order while they fit in budget tokens, the first
+    text which does not fit is cut, the lower ranked ones are dropped.
+    return the kept texts and the number of tokens used
+    """
+    kept = []
+    used = 0
+    for text in texts:
+        n = count_tokens(text, model)
+        if used + n <= budget:
+            kept.append(text)
+            used += n
+            continue
+        left = budget - used
+        if left >= MIN_DOC_TOKENS:
+            kept.append(truncate(text, left, model))
+            used = budget
+        break
+    if len(kept) < len(texts):
+        logger.info(f"context trimmed to {len(kept)}/{len(texts)} "
+                    f"documents, {used} tokens")
+    return kept, used
+
+
+@component
+class DocumentBudget:
+    """
+    sits between the retriever and the prompt builder, documents come
+    ranked by the retriever
+    """
+
+    def __init__(self, model: str):
+        self.model = model
+
+    @component.output_types(documents=List[Document])
+    def run(self, documents: List[Document], max_tokens: Optional[int] = None):
+        if max_tokens is None:
+            return {"documents": documents}
+        contents, _ = fit_texts([d.content or "" for d in documents],
+                                max_tokens, self.model)
+        kept = []
+        for doc, content in zip(documents, contents):
+            if content != doc.content:
+                doc = Document(id=doc.id,
+                               content=content,
+                               meta=doc.meta,
+                               score=doc.score)
+            kept.append(doc)
+        return {"documents": kept}
@@ -0,0 +1,127 @@
+import os
+from threading import Lock
+from typing import Any, Dict, List, Optional, Set
+
+from haystack import Document, component
+from haystack_integrations.components.retrievers.qdrant import \
+    QdrantEmbeddingRetriever
+from haystack_integrations.document_stores.qdrant import QdrantDocumentStore
+from haystack_integrations.document_stores.qdrant.filters import \
+    convert_filters_to_qdrant
+from logger import init_logger
+from qdrant_client.http import models as rest
+
+logger = init_logger(__name__)
+
+# none: float32 vectors in RAM.
+# int8: scalar quantized vectors in RAM (4x smaller), binary: 1 bit per
+# dimension (32x smaller); the full vectors stay on disk and only rescore
+# the best candidates of the quantized search.
+RAG_QUANTIZATION = os.getenv("RAG_QUANTIZATION", "none")
+# candidates of the quantized search per result, binary needs more
+RAG_OVERSAMPLING = float(
+    os.getenv("RAG_OVERSAMPLING",
+              "4" if RAG_QUANTIZATION == "binary" else "2"))
+
+_updated_lock = Lock()
+_updated: Set[str] = set()
+
+
+def quantization_config() -> Optional[Any]:
+    if RAG_QUANTIZATION == "int8":
+        return rest.ScalarQuantization(scalar=rest.ScalarQuantizationConfig(
+            type=rest.ScalarType.INT8, quantile=0.99, always_ram=True))
+    if RAG_QUANTIZATION == "binary":
+        return rest.BinaryQuantization(binary=rest.BinaryQuantizationConfig(
+            always_ram=True))
+    if RAG_QUANTIZATION != "none":
+        raise ValueError(f"unknown RAG_QUANTIZATION {RAG_QUANTIZATION}")
+    return None
+
+
+def store_options() -> Dict:
+    """
+    QdrantDocumentStore arguments of new collections
+    """
+    config = quantization_config()
+    if config is None:
+        return {}
+    return {"quantization_config": config, "on_disk": True}
+
+
+def ensure_quantized(store: QdrantDocumentStore):
+    """
+    quantize a collection created before quantization was turned on, once
+    per process. qdrant rebuilds it in the background.
+    """
+    config = quantization_config()
+    if config is None:
+        return
+    with _updated_lock:
+        if store.index in _updated:
+            return
+        _updated.add(store.index)
+    try:
+        info = store.client.get_collection(store.index)
+        if info.config.quantization_config is not None:
+            return
+        store.client.update_collection(
+            collection_name=store.index,
+            vectors_config={"": rest.VectorParamsDiff(on_disk=True)},
+            quantization_config=config)
+        logger.info(f"{store.index}: {RAG_QUANTIZATION} quantization "
+                    "enabled, full vectors moved to disk")
+    except Exception as e:
+        logger.warning(f"{store.index}: failed to enable quantization: {e}")
+
+
+@component
+class RescoringEmbeddingRetriever:
+    """
+    same input and output as QdrantEmbeddingRetriever. the quantized vectors
+    select top_k * RAG_OVERSAMPLING candidates, the full vectors rescore
+    them and the best top_k are returned, without their embedding.
+    """
+
+    def __init__(self,
+                 document_store: QdrantDocumentStore,
+                 filters: Optional[Dict[str, Any]] = None,
+                 top_k: int = 10,
+                 oversampling: float = RAG_OVERSAMPLING):
+        self.document_store = document_store
+        self.filters = filters
+        self.top_k = top_k
+        self.search_params = rest.SearchParams(
+            quantization=rest.QuantizationSearchParams(
+                rescore=True, oversampling=oversampling))
+
+    @component.output_types(documents=List[Document])
+    def run(self,
+            query_embedding: List[float],
+            filters: Optional[Dict[str, Any]] = None,
+            top_k: Optional[int] = None):
+        points = self.document_store.client.search(
+            collection_name=self.document_store.index,
+            query_vector=query_embedding,
+            query_filter=convert_filters_to_qdrant(filters or self.filters),
+            limit=top_k or self.top_k,
+            search_params=self.search_params,
+            with_vectors=False)
+        return {
+            "documents": [
+                Document.from_dict({
+                    **point.payload, "score": point.score
+                }) for point in points
+            ]
+        }
+
+
+def new_embedding_retriever(document_store: QdrantDocumentStore,
+                            filters: Optional[Dict[str, Any]] = None):
+    """
+    dense retriever of document_store, rescoring when quantization is on
+    """
+    if RAG_QUANTIZATION == "none":
+        return QdrantEmbeddingRetriever(document_store=document_store,
+                                        filters=filters)
+    return RescoringEmbeddingRetriever(document_store, filters)
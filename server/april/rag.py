@@ -1,13 +1,17 @@
-from typing import List
+from typing import Dict, List, Optional
 
-from common import get_doc_embedder, get_document_store, get_text_embedder
+from common import (INDEX_NAME, get_doc_embedder, get_document_store,
+                    get_splitter)
+from dedup import DuplicateFilter, remove_chunks
 from haystack import Document, Pipeline
-from haystack.components.preprocessors import DocumentSplitter
 from haystack.components.writers import DocumentWriter
 from haystack.document_stores.types import DuplicatePolicy
-from haystack_integrations.components.retrievers.qdrant import \
-    QdrantEmbeddingRetriever
+from lint_cache import lint_cache
 from logger import init_logger
+from partition import (FIRST_CHUNK, all_of, count_chunks, scroll_chunks,
+                       topic_filter)
+from sparse_index import (SparseWriter, add_retrieval, retrieval_inputs,
+                          retrieval_mode, sparse_index)
 
 logger = init_logger(__name__)
 
@@ -17,7 +21,11 @@ class RagDocument(object):
     def __init__(self):
         pass
 
-    def register_doc(self, doc: str, topic: str, document_name: str):
+    def register_doc(self, doc: str, topic: str, document_name: str) -> Dict:
+        """
+        return the number of chunks written and the duplicate chunks which
+        were skipped
+        """
         logger.debug(f"register doc: {doc}")
 
         # Get the document store
@@ -49,17 +57,24 @@ class RagDocument(object):
 
         # Define the processing pipeline
         pipeline = Pipeline()
-        pipeline.add_component(
-            "splitter", DocumentSplitter(split_by="word", split_length=5000))
+        pipeline.add_component("splitter", get_splitter())
+        # chunks already indexed in the topic are not stored again, they
+        # become aliases of the indexed ones
+        dedup = DuplicateFilter(document_store, scope=[topic_filter(topic)])
+        pipeline.add_component("dedup", dedup)
         pipeline.add_component("doc_embedder", get_doc_embedder())
         pipeline.add_component(
             "writer",
             DocumentWriter(document_store=get_document_store(),
                            policy=DuplicatePolicy.OVERWRITE))
+        pipeline.add_component("sparse_writer",
+                               SparseWriter(sparse_index, INDEX_NAME))
 
         # Connect the components
-        pipeline.connect("splitter.documents", "doc_embedder")
+        pipeline.connect("splitter.documents", "dedup.documents")
+        pipeline.connect("dedup.documents", "doc_embedder")
         pipeline.connect("doc_embedder.documents", "writer")
+        pipeline.connect("doc_embedder.documents", "sparse_writer")
 
         # Process documents through the pipeline
         document = Document(content=doc,
@@ -69,34 +84,73 @@ class RagDocument(object):
                             })
         result = pipeline.run({"splitter": {"documents": [document]}})
         logger.debug(f"register docs result: {result}")
+        dedup.link(document_store)
+        # lint results of this topic were computed with the old documents
+        lint_cache.invalidate_topic(topic)
+        return {
+            "chunks": result["writer"]["documents_written"],
+            "duplicates": result["dedup"]["duplicates"]
+        }
 
     def get_docs(self, hint: str, topic: str) -> List[str]:
+        #dense and BM25 rankings fused, BM25 only for a symbol name
+        mode = retrieval_mode(hint, INDEX_NAME, topic)
         pipeline = Pipeline()
-        pipeline.add_component("text_embedder", get_text_embedder())
-        filters = {"field": "meta.topic", "operator": "==", "value": topic}
-        pipeline.add_component(
-            "retriever",
-            QdrantEmbeddingRetriever(document_store=get_document_store(),
-                                     filters=filters))
-        pipeline.connect("text_embedder", "retriever.query_embedding")
-        retrieved_docs = pipeline.run({"text_embedder": {"text": hint}})
+        retrieved = add_retrieval(pipeline, mode, get_document_store(),
+                                  INDEX_NAME, topic)
+        retrieved_docs = pipeline.run(retrieval_inputs(mode, hint, 10))
 
-        retrieved_docs = retrieved_docs["retriever"]["documents"]
+        retrieved_docs = retrieved_docs[retrieved]["documents"]
         logger.debug(f"RAG: {retrieved_docs}")
         return [doc.content for doc in retrieved_docs]
 
-    def list_docs(self):
+    def list_docs(self,
+                  topic: Optional[str] = None,
+                  cursor: Optional[str] = None,
+                  limit: int = 20,
+                  totals: bool = True) -> Dict:
         """
-        list docs is used by ui.py, TODO: support paging on UI
-        return at most 100
+        one page of the documents, of topic when set. a document is listed
+        by its first chunk, only names are read: the content is loaded by
+        get_preview. cursor is the next_cursor of the previous page, None
+        after the last one. with totals, the first page also counts the
+        documents and chunks.
         """
-        import qdrant_client
-
-        QDRANT_ADDR = "http://localhost:6333"
-        client = qdrant_client.QdrantClient(url=QDRANT_ADDR)
-        from common import INDEX_NAME
-        scroll_result = client.scroll(collection_name=INDEX_NAME, limit=100)
-        return scroll_result[0]
+        document_store = get_document_store()
+        scope = topic_filter(topic) if topic is not None else None
+        heads = all_of(scope, FIRST_CHUNK)
+        first_chunks, next_cursor = scroll_chunks(document_store, heads,
+                                                  ["topic", "document_name"],
+                                                  cursor, limit)
+        page = {"documents": first_chunks, "next_cursor": next_cursor}
+        if totals and cursor is None:
+            page["total_documents"] = count_chunks(document_store, heads)
+            page["total_chunks"] = count_chunks(document_store, scope)
+        return page
+
+    def get_preview(self,
+                    topic: str,
+                    document_name: str,
+                    chars: int = 500) -> str:
+        """
+        the beginning of the first chunk of the document
+        """
+        docs = get_document_store().filter_documents(
+            all_of(self._document_filter(topic, document_name), FIRST_CHUNK))
+        if not docs:
+            raise ValueError(
+                f"Document with name '{document_name}' and topic '{topic}' not found."
+            )
+        return (docs[0].content or "")[:chars]
+
+    @staticmethod
+    def _document_filter(topic: str, document_name: str) -> Dict:
+        name = {
+            "field": "meta.document_name",
+            "operator": "==",
+            "value": document_name
+        }
+        return all_of(topic_filter(topic), name)
 
     def delete_doc(self, topic: str, document_name: str):
         # Get the document store
@@ -126,8 +180,13 @@ class RagDocument(object):
                 f"Document with name '{document_name}' and topic '{topic}' not found."
             )
 
-        doc_ids = [doc.id for doc in deleting_docs]
-        document_store.delete_documents(doc_ids)
+        def deleted(alias: Dict) -> bool:
+            return alias.get("document_name") == document_name
+
+        # the chunks other documents alias pass to them
+        remove_chunks(document_store, deleting_docs, topic_filter(topic),
+                      deleted)
+        lint_cache.invalidate_topic(topic)
         logger.debug(
             f"Deleted document with name '{document_name}' and topic '{topic}'."
         )
@@ -141,4 +200,5 @@ if __name__ == "__main__":
         document_name="President_Biden_1")
     print(rag.get_docs("Biden", "President"))
     print(rag.list_docs())
+    print(rag.get_preview("President", "President_Biden_1"))
     rag.delete_doc("President", "President_Biden_1")
@@ -0,0 +1,49 @@
+import asyncio
+import os
+import time
+from typing import Dict
+
+# requests per second allowed to each LLM backend, 0 means unlimited.
+# e.g. LINT_RATE_LIMIT_OPENAI=5 LINT_RATE_LIMIT_CUSTOM=20
+RATE_LIMIT_ENV_PREFIX = "LINT_RATE_LIMIT_"
+
+
+class RateLimiter(object):
+    """
+    token bucket, rate tokens per second with a burst of `burst` tokens
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self._tokens = float(self.burst)
+        self._last = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        if self.rate <= 0:
+            return
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.burst, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+_limiters: Dict[str, RateLimiter] = {}
+
+
+def backend_limiter(backend: str) -> RateLimiter:
+    """
+    limiter shared by every request going to the backend
+    """
+    if backend not in _limiters:
+        rate = float(
+            os.getenv(RATE_LIMIT_ENV_PREFIX + backend.upper(), "0") or 0)
+        _limiters[backend] = RateLimiter(rate, burst=max(int(rate), 1))
+    return _limiters[backend]
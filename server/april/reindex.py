@@ -0,0 +1,247 @@
+"""
+incremental re-indexing of a git repository into a RAG topic.
+
+the commit indexed last is recorded per topic. the next run re-embeds
+only the files changed since that commit, then deletes the chunks of the
+changed and deleted files which were not written for the new commit: a
+nightly refresh scales with the size of the diff, not of the repository.
+the first run, or a run whose last commit is gone (force push), indexes
+every tracked file.
+
+usage: python reindex.py --topic cannyls-go --include '*.go' data/cannyls-go
+"""
+import argparse
+import fnmatch
+import json
+import os
+import time
+from dataclasses import asdict, dataclass
+from threading import Lock
+from typing import Dict, List, Optional, Tuple
+
+import git
+from dedup import remove_chunks
+from ingest import INGEST_STATE_DIR, Ingester
+from logger import init_logger
+from partition import topic_filter
+
+logger = init_logger(__name__)
+
+REINDEX_STATE_FILE = os.getenv("REINDEX_STATE_FILE",
+                               os.path.join(INGEST_STATE_DIR, "commits.json"))
+# paths per delete filter
+_DELETE_BATCH = 100
+
+_state_lock = Lock()
+
+
+def load_state() -> Dict[str, Dict]:
+    """
+    topic -> {"repo", "commit", "time"} of the last complete indexing
+    """
+    try:
+        with open(REINDEX_STATE_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_state(topic: str, entry: Dict):
+    with _state_lock:
+        state = load_state()
+        state[topic] = entry
+        os.makedirs(os.path.dirname(REINDEX_STATE_FILE), exist_ok=True)
+        tmp = REINDEX_STATE_FILE + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(state, f, indent=2)
+        os.replace(tmp, REINDEX_STATE_FILE)
+
+
+def changed_files(repo: git.Repo, base: str,
+                  head: str) -> Tuple[List[str], List[str]]:
+    """
+    (added or modified, deleted) files between two commits, a rename is a
+    deletion and an addition
+    """
+    changed, deleted = set(), set()
+    for diff in repo.commit(base).diff(head):
+        if diff.change_type == "D":
+            deleted.add(diff.a_path)
+            continue
+        if diff.change_type == "R":
+            deleted.add(diff.a_path)
+        changed.add(diff.b_path)
+    return sorted(changed), sorted(deleted - changed)
+
+
+@dataclass
+class ReindexReport:
+    topic: str
+    commit: str
+    # commit of the previous indexing, None for a full indexing
+    base: Optional[str] = None
+    changed: int = 0
+    deleted: int = 0
+    # stale chunks removed from the index
+    removed_chunks: int = 0
+    ingest: Optional[Dict] = None
+    seconds: float = 0.0
+
+
+class Reindexer(object):
+    """
+    keeps topic in sync with the HEAD of the repository at root.
+    include: fnmatch patterns of the files to index, every file by default.
+    """
+
+    def __init__(self,
+                 topic: str,
+                 root: str,
+                 include: Optional[List[str]] = None):
+        self.topic = topic
+        self.root = root
+        self.include = include or []
+        self.repo = git.Repo(root)
+        self.name = os.path.basename(os.path.abspath(self.repo.working_dir))
+
+    def _included(self, path: str) -> bool:
+        if not self.include:
+            return True
+        return any(fnmatch.fnmatch(path, p) for p in self.include)
+
+    def _scope(self) -> List[Dict]:
+        """
+        conditions matching the chunks indexed from this repository
+        """
+        return [
+            topic_filter(self.topic), {
+                "field": "meta.repo",
+                "operator": "==",
+                "value": self.name
+            }
+        ]
+
+    def _remove_stale(self, store, commit: str,
+                      paths: Optional[List[str]]) -> int:
+        """
+        delete the chunks of paths (all the chunks of the repository when
+        None) which were not written for commit. a chunk aliased by a
+        document left passes to it.
+        """
+        selected = None if paths is None else set(paths)
+
+        def stale(alias: Dict) -> bool:
+            if alias.get("repo") != self.name or alias.get("commit") == commit:
+                return False
+            return selected is None or alias.get("file_path") in selected
+
+        removed = 0
+        batches = [None] if paths is None else [
+            paths[i:i + _DELETE_BATCH]
+            for i in range(0, len(paths), _DELETE_BATCH)
+        ]
+        for batch in batches:
+            conditions = self._scope() + [{
+                "field": "meta.commit",
+                "operator": "!=",
+                "value": commit
+            }]
+            if batch is not None:
+                conditions.append({
+                    "field": "meta.file_path",
+                    "operator": "in",
+                    "value": batch
+                })
+            docs = store.filter_documents({
+                "operator": "AND",
+                "conditions": conditions
+            })
+            if docs:
+                removed += len(
+                    remove_chunks(store, docs, topic_filter(self.topic),
+                                  stale))
+        return removed
+
+    def run(self, full: bool = False) -> ReindexReport:
+        from common import get_document_store
+        from lint_cache import lint_cache
+
+        start = time.time()
+        head = self.repo.head.commit.hexsha
+        last = load_state().get(self.topic, {})
+        base = None if full else last.get("commit")
+        if base is not None:
+            try:
+                self.repo.commit(base)
+            except (ValueError, git.BadName):
+                logger.warning(f"{self.topic}: indexed commit {base} is "
+                               "not in the repository anymore, full indexing")
+                base = None
+        report = ReindexReport(self.topic, head, base)
+        if base == head:
+            logger.info(f"{self.topic}: already indexed at {head}")
+            return report
+
+        if base is None:
+            changed = self.repo.git.ls_files("-z").split("\0")
+            deleted = []
+        else:
+            changed, deleted = changed_files(self.repo, base, head)
+        changed = [p for p in changed if p and self._included(p)]
+        deleted = [p for p in deleted if self._included(p)]
+        report.changed, report.deleted = len(changed), len(deleted)
+        logger.info(f"{self.topic}: {base or 'full'}..{head}, "
+                    f"{len(changed)} changed, {len(deleted)} deleted files")
+
+        #the chunks are tagged with the commit, the old ones are told
+        #apart from the new ones once these are written
+        if changed:
+            ingester = Ingester(self.topic,
+                                meta={
+                                    "repo": self.name,
+                                    "commit": head
+                                })
+            ingest = ingester.run(self.repo.working_dir,
+                                  paths=changed,
+                                  source=f"git:{base}..{head}")
+            report.ingest = asdict(ingest)
+        store = get_document_store()
+        report.removed_chunks = self._remove_stale(
+            store, head, None if base is None else changed + deleted)
+        lint_cache.invalidate_topic(self.topic)
+
+        save_state(
+            self.topic, {
+                "repo": os.path.abspath(self.repo.working_dir),
+                "commit": head,
+                "time": time.time()
+            })
+        report.seconds = time.time() - start
+        logger.info(f"{self.topic}: indexed {head}, removed "
+                    f"{report.removed_chunks} stale chunks, "
+                    f"dur:{report.seconds:.2f}")
+        return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="re-index the files of a git repository changed since "
+        "the last indexing")
+    parser.add_argument("--topic", required=True)
+    parser.add_argument("--include",
+                        action="append",
+                        help="fnmatch pattern of the files to index, "
+                        "may be repeated")
+    parser.add_argument("--pull",
+                        action="store_true",
+                        help="git pull before indexing")
+    parser.add_argument("--full",
+                        action="store_true",
+                        help="index every file, not only the changed ones")
+    parser.add_argument("root")
+    args = parser.parse_args()
+    reindexer = Reindexer(args.topic, args.root, args.include)
+    if args.pull:
+        reindexer.repo.remotes.origin.pull()
+    report = reindexer.run(full=args.full)
+    print(json.dumps(asdict(report), indent=2))
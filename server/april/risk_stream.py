@@ -0,0 +1,132 @@
+import json
+import re
+from typing import Dict, List, Optional
+
+from logger import init_logger
+
+logger = init_logger(__name__)
+
+# Decoders turning the LLM token stream into risk objects as early as
+# possible. Both expose the same interface:
+#   feed(text) -> risks completed by this piece of text
+#   close()    -> risks left when the stream ended
+
+
+class ToolRiskDecoder(object):
+    """
+    decode the arguments of the code_potentia_risks tool call:
+        {"risks": [{"which_part_of_code":..., "reason":..., "fix":...}, ...]}
+    an element of the risks array is emitted as soon as its closing brace
+    arrives.
+    """
+
+    def __init__(self):
+        self._buf: List[str] = []
+        self._pos = 0
+        # stack of open containers, '{' or '['
+        self._stack: List[str] = []
+        self._in_string = False
+        self._escape = False
+        self._start: Optional[int] = None
+
+    def feed(self, text: str) -> List[Dict]:
+        risks = []
+        for ch in text:
+            self._buf.append(ch)
+            idx = self._pos
+            self._pos += 1
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                continue
+            if ch == '"':
+                self._in_string = True
+            elif ch in "{[":
+                if ch == "{" and self._stack == ["{", "["]:
+                    self._start = idx
+                self._stack.append(ch)
+            elif ch in "}]":
+                if self._stack:
+                    self._stack.pop()
+                if ch == "}" and self._stack == ["{", "["] and \
+                        self._start is not None:
+                    risk = self._decode("".join(self._buf[self._start:]))
+                    if risk is not None:
+                        risks.append(risk)
+                    self._start = None
+        return risks
+
+    def _decode(self, text: str) -> Optional[Dict]:
+        try:
+            return json.loads(text)
+        except ValueError as e:
+            logger.warning(f"failed to decode risk {text}: {e}")
+            return None
+
+    def close(self) -> List[Dict]:
+        return []
+
+
+_LABELS = ("which_part_of_code", "reason", "fix")
+# a label at the beginning of a line, markdown decorations are allowed:
+# "**Reason**:", "- Fix   :", "1. which_part_of_code:" ...
+_LABEL_RE = re.compile(
+    r"^[ \t*_#>\-\d.]*(which_part_of_code|reason|fix)[*_ \t]*:[*_ \t]*",
+    re.IGNORECASE | re.MULTILINE)
+
+
+class PlainRiskDecoder(object):
+    """
+    decode the free text answer of models without function calling,
+    which follows the examples of the prompt template:
+        which_part_of_code: ...
+        Reason: ...
+        Fix: ...
+    a risk is complete when the next which_part_of_code starts.
+    """
+
+    def __init__(self):
+        self._text = ""
+        # offset of the which_part_of_code label of the open risk
+        self._start: Optional[int] = None
+
+    def _starts(self, begin: int) -> List[int]:
+        return [
+            m.start() for m in _LABEL_RE.finditer(self._text, begin)
+            if m.group(1).lower() == "which_part_of_code"
+        ]
+
+    def feed(self, text: str) -> List[Dict]:
+        self._text += text
+        # only lines ending with newline are stable, labels could be cut
+        stable = self._text.rfind("\n") + 1
+        begin = self._start if self._start is not None else 0
+        risks = []
+        for pos in self._starts(begin):
+            if pos >= stable:
+                break
+            if self._start is not None and pos > self._start:
+                risks.append(self._parse(self._text[self._start:pos]))
+            self._start = pos
+        return risks
+
+    def close(self) -> List[Dict]:
+        if self._start is None:
+            return []
+        risk = self._parse(self._text[self._start:])
+        self._start = None
+        return [risk]
+
+    @staticmethod
+    def _parse(block: str) -> Dict:
+        risk = {label: "" for label in _LABELS}
+        matches = list(_LABEL_RE.finditer(block))
+        for i, m in enumerate(matches):
+            end = matches[i +
+                          1].start() if i + 1 < len(matches) else len(block)
+            risk[m.group(1).lower()] = block[m.end():end].strip()
+        return risk
@@ -0,0 +1,305 @@
+import os
+import time
+from dataclasses import dataclass
+from threading import Lock
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+import metrics
+from logger import init_logger
+from openai import APIConnectionError, APIStatusError
+
+logger = init_logger(__name__)
+
+# a backend is moved behind the healthy ones for ROUTER_COOLDOWN seconds
+# after ROUTER_MAX_FAILURES failures in a row. after the cooldown it is
+# back in rotation, but its next failure moves it back again until one
+# request succeeds.
+ROUTER_MAX_FAILURES = int(os.getenv("ROUTER_MAX_FAILURES", "3"))
+ROUTER_COOLDOWN = float(os.getenv("ROUTER_COOLDOWN", "30"))
+# weight of the last request in the rolling latency and error rate
+ROUTER_EWMA_ALPHA = float(os.getenv("ROUTER_EWMA_ALPHA", "0.2"))
+# backends the router may use
+LLM_BACKENDS = os.getenv("LLM_BACKENDS", "openai,custom,ollama").split(",")
+# errors of the openai client, which every backend is called with: it
+# could not reach the backend (timeouts included) or got an HTTP error
+BACKEND_ERRORS = (APIConnectionError, APIStatusError)
+
+
+@dataclass(frozen=True)
+class Backend:
+    name: str
+    # None is the default url of the openai SDK
+    base_url: Optional[str]
+    # model used when the request does not name one of this backend
+    model: str
+    # the model runs on our own machines, the code does not leave them
+    local: bool
+    # the url of a local backend was set, not only defaulted
+    configured: bool = False
+
+    @property
+    def api_key(self) -> str:
+        if self.name == "openai":
+            return os.getenv("OPENAI_API_KEY", "")
+        #vllm and ollama are compatible to openai API, any key works
+        return "FAKE"
+
+    def available(self, requested: bool = False) -> bool:
+        """
+        the backend can serve requests. a local backend whose url is the
+        default is only used when the request names it (requested).
+        """
+        if self.name not in LLM_BACKENDS:
+            return False
+        if self.local:
+            return self.configured or requested
+        return bool(self.api_key) or self.base_url is not None
+
+
+# every url can be pointed to another OpenAI compatible server, e.g. a
+# local stub: LLM_BASE_URL_OPENAI=http://127.0.0.1:9000/v1
+BACKENDS: Dict[str, Backend] = {
+    "openai":
+    Backend("openai",
+            os.getenv("LLM_BASE_URL_OPENAI") or None,
+            os.getenv("LLM_MODEL_OPENAI", "gpt-3.5-turbo"), False),
+    "custom":
+    Backend(
+        "custom", os.getenv("LLM_BASE_URL_CUSTOM", "http://localhost:8081/v1"),
+        os.getenv("LLM_MODEL_CUSTOM",
+                  "deepseek-ai/deepseek-coder-7b-instruct-v1.5"), True,
+        "LLM_BASE_URL_CUSTOM" in os.environ),
+    "ollama":
+    Backend("ollama",
+            os.getenv("LLM_BASE_URL_OLLAMA", "http://localhost:11434/v1"),
+            os.getenv("LLM_MODEL_OLLAMA", "llama3"), True,
+            "LLM_BASE_URL_OLLAMA" in os.environ),
+}
+
+# org of the request model -> backend
+ORGS = {
+    "openai": "openai",
+    "custom": "custom",
+    "vllm": "custom",
+    "deepseek": "custom",
+    "ollama": "ollama",
+}
+
+# short names used by the clients
+MODEL_ALIASES = {
+    # the default of the rust client
+    "gpt3": "gpt-3.5-turbo",
+    "gpt3.5": "gpt-3.5-turbo",
+    "gpt-3.5": "gpt-3.5-turbo",
+    "gpt4": "gpt-4",
+}
+
+# pinned: only the backend of the request org, default for a local org
+# prefer: the backend of the request org while healthy, then the others,
+# default for a remote org
+# fastest: the fastest healthy backend
+# local: the fastest healthy backend running on our machines
+POLICIES = ("pinned", "prefer", "fastest", "local")
+
+
+class NoBackend(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class Route:
+    backend: str
+    model: str
+
+
+@dataclass
+class Attempt:
+    """
+    one call of a route, filled in by the call
+    """
+    route: Route
+    # seconds spent in the backend itself, without the queues before it
+    latency: Optional[float] = None
+    # part of the answer was delivered (streamed), another backend would
+    # deliver it again
+    committed: bool = False
+
+
+def backend_error(e: BaseException) -> bool:
+    """
+    e, or an exception raised from it, is an error of the backend. the
+    others, e.g. of the document store or of parsing the answer, are not
+    the backend's fault.
+    """
+    while e is not None:
+        if isinstance(e, BACKEND_ERRORS):
+            return True
+        e = e.__cause__
+    return False
+
+
+def parse_model(spec: str) -> Tuple[Optional[str], Optional[str]]:
+    """
+    "openai:gpt4" -> ("openai", "gpt-4"), "auto" -> (None, None).
+    raise ValueError for an unknown org
+    """
+    org, _, model = spec.partition(":")
+    org = org.strip().lower()
+    if org in ("", "auto"):
+        return None, None
+    if org not in ORGS:
+        raise ValueError(f"unknown model org {org!r}, "
+                         f"expected one of {sorted(ORGS)} or auto")
+    model = model.strip()
+    return ORGS[org], MODEL_ALIASES.get(model, model) or None
+
+
+class BackendStats(object):
+    """
+    rolling latency and error rate of one backend
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self.latency: Optional[float] = None
+        self.error_rate = 0.0
+        self.failures = 0
+        self.down_until = 0.0
+
+    def record(self, latency: float, ok: bool) -> bool:
+        """
+        return True if the backend just went down
+        """
+        a = ROUTER_EWMA_ALPHA
+        with self._lock:
+            self.error_rate = (1 - a) * self.error_rate + a * (not ok)
+            if ok:
+                if self.latency is None:
+                    self.latency = latency
+                self.latency = (1 - a) * self.latency + a * latency
+                self.failures = 0
+                self.down_until = 0.0
+                return False
+            self.failures += 1
+            if self.failures < ROUTER_MAX_FAILURES:
+                return False
+            self.down_until = time.monotonic() + ROUTER_COOLDOWN
+            return True
+
+    def healthy(self) -> bool:
+        with self._lock:
+            return time.monotonic() >= self.down_until
+
+    def score(self) -> float:
+        """
+        expected latency, a backend never measured is tried first
+        """
+        with self._lock:
+            if self.latency is None:
+                return 0.0
+            return self.latency * (1 + self.error_rate)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "latency": self.latency,
+                "error_rate": self.error_rate,
+                "failures": self.failures,
+                "healthy": time.monotonic() >= self.down_until,
+            }
+
+
+class ModelRouter(object):
+    """
+    picks the backend of each request from the request model and policy,
+    and fails over to the next allowed backend when a call fails.
+    """
+
+    def __init__(self, backends: Dict[str, Backend]):
+        self.backends = backends
+        self.stats = {}
+        for name in backends:
+            self.stats[name] = BackendStats()
+            metrics.register(f"router.{name}", self.stats[name])
+
+    def backend(self, name: str) -> Backend:
+        return self.backends[name]
+
+    def candidates(self,
+                   spec: str,
+                   policy: Optional[str] = None) -> List[Route]:
+        """
+        the routes allowed for spec and policy, best first.
+        unhealthy backends are kept at the end as the last resort.
+        """
+        org, model = parse_model(spec)
+        if policy is None:
+            #the code sent to a local org never leaves our machines
+            #unless the request asks for another policy
+            if org is None:
+                policy = "fastest"
+            elif self.backends[org].local:
+                policy = "pinned"
+            else:
+                policy = "prefer"
+        if policy not in POLICIES:
+            raise ValueError(f"unknown policy {policy!r}, "
+                             f"expected one of {list(POLICIES)}")
+        if org is None and policy in ("pinned", "prefer"):
+            raise ValueError(f"policy {policy} needs a model org")
+
+        names = [n for n, b in self.backends.items() if b.available(n == org)]
+        if policy == "pinned":
+            names = [n for n in names if n == org]
+        elif policy == "local":
+            names = [n for n in names if self.backends[n].local]
+
+        def rank(name: str):
+            preferred = policy == "prefer" and name == org
+            return (not self.stats[name].healthy(), not preferred,
+                    self.stats[name].score())
+
+        names.sort(key=rank)
+        return [
+            Route(n, model if n == org and model else self.backends[n].model)
+            for n in names
+        ]
+
+    async def route(self, routes: List[Route], call: Callable[[Attempt],
+                                                              Awaitable]):
+        """
+        await call(Attempt(route)) on the routes in order until one
+        succeeds, the next route is tried after a backend error. a failed
+        attempt which was committed is not retried, the other errors are
+        raised as is and do not count.
+        return (route, result), raise NoBackend if every route failed.
+        """
+        last_error = None
+        for route in routes:
+            attempt = Attempt(route)
+            start = time.monotonic()
+            try:
+                result = await call(attempt)
+            except Exception as e:
+                if not backend_error(e):
+                    raise
+                last_error = e
+                stats = self.stats[route.backend]
+                if stats.record(0.0, False):
+                    logger.warning(f"backend {route.backend} is down for "
+                                   f"{ROUTER_COOLDOWN}s: {e!r}")
+                else:
+                    logger.warning(f"backend {route.backend} failed: {e!r}")
+                if attempt.committed:
+                    raise
+                continue
+            latency = attempt.latency
+            if latency is None:
+                latency = time.monotonic() - start
+            self.stats[route.backend].record(latency, True)
+            return route, result
+        raise NoBackend(f"no backend could serve the request, "
+                        f"last error: {last_error}")
+
+
+model_router = ModelRouter(BACKENDS)
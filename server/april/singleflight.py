@@ -0,0 +1,36 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, Hashable, Tuple, TypeVar
+
+import metrics
+
+T = TypeVar("T")
+
+
+class SingleFlight(object):
+    """
+    concurrent calls with the same key share one in-flight computation.
+    the computation runs in its own task: a waiter going away (client
+    disconnected) does not cancel it for the others.
+    """
+
+    def __init__(self, name: str):
+        self._calls: Dict[Hashable, asyncio.Future] = {}
+        self.calls = metrics.counter(f"{name}.calls")
+        self.coalesced = metrics.counter(f"{name}.coalesced")
+
+    async def do(self, key: Hashable,
+                 fn: Callable[[], Awaitable[T]]) -> Tuple[T, bool]:
+        """
+        return (result, shared), shared is True if the result was computed
+        for another caller
+        """
+        self.calls.inc()
+        task = self._calls.get(key)
+        if task is not None:
+            self.coalesced.inc()
+            return await asyncio.shield(task), True
+
+        task = asyncio.ensure_future(fn())
+        self._calls[key] = task
+        task.add_done_callback(lambda _: self._calls.pop(key, None))
+        return await asyncio.shield(task), False
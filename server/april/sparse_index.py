@@ -0,0 +1,349 @@
+import json
+import os
+import re
+import sqlite3
+import tempfile
+from threading import Lock
+from typing import Dict, List, Optional
+
+from haystack import Document, component
+from logger import init_logger
+from partition import topic_filter
+
+logger = init_logger(__name__)
+
+# BM25 inverted index of the RAG chunks, kept next to qdrant: sqlite FTS5
+# over the identifiers of each chunk and their camelCase/snake_case parts.
+SPARSE_INDEX_PATH = os.getenv("SPARSE_INDEX_PATH",
+                              tempfile.gettempdir() + "/ailint/sparse.db")
+# hybrid (dense + BM25 fused), dense or sparse
+RAG_RETRIEVAL = os.getenv("RAG_RETRIEVAL", "hybrid")
+# candidates of each retriever given to the fusion
+RAG_FUSION_CANDIDATES = int(os.getenv("RAG_FUSION_CANDIDATES", "20"))
+# rarest query terms kept, a lint query is a whole code chunk
+SPARSE_MAX_QUERY_TERMS = int(os.getenv("SPARSE_MAX_QUERY_TERMS", "64"))
+
+_IDENT_RE = re.compile(r"[A-Za-z_][A-Za-z0-9_]*|\d+")
+_PART_RE = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|\d+")
+# ChunkStore::put, lump_id, os.path.join, getLumpData()
+_SYMBOL_RE = re.compile(r"[A-Za-z_][\w]*((::|\.|->)[A-Za-z_]\w*)*(\(\))?")
+
+
+def terms(text: str) -> List[str]:
+    """
+    lowercased identifiers of text, followed by their parts for compound
+    identifiers: getLumpData -> getlumpdata get lump data
+    """
+    result = []
+    for ident in _IDENT_RE.findall(text):
+        if len(ident) < 2:
+            continue
+        result.append(ident.lower())
+        parts = _PART_RE.findall(ident)
+        if len(parts) > 1:
+            result.extend(p.lower() for p in parts if len(p) > 1)
+    return result
+
+
+def is_identifier_query(text: str) -> bool:
+    """
+    a few symbols, at least one compound: the embedding adds nothing to
+    an exact match
+    """
+    words = text.split()
+    if not words or len(words) > 4:
+        return False
+    if not all(_SYMBOL_RE.fullmatch(w) for w in words):
+        return False
+    return any(len(_PART_RE.findall(w)) > 1 for w in words)
+
+
+class SparseIndex(object):
+    """
+    chunks are keyed by their qdrant document id and grouped by collection,
+    so the same chunk is found by both retrievers
+    """
+
+    def __init__(self, path: str = SPARSE_INDEX_PATH):
+        self.path = path
+        self._lock = Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        try:
+            self._open()
+        except sqlite3.Error as e:
+            logger.warning(f"sparse index {path} disabled: {e}")
+            self._db = None
+
+    @property
+    def enabled(self) -> bool:
+        return self._db is not None
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.executescript("""
+            CREATE TABLE IF NOT EXISTS chunks(
+                rowid INTEGER PRIMARY KEY,
+                id TEXT UNIQUE,
+                collection TEXT,
+                topic TEXT,
+                content TEXT,
+                meta TEXT);
+            CREATE INDEX IF NOT EXISTS chunks_topic
+                ON chunks(collection, topic);
+            CREATE VIRTUAL TABLE IF NOT EXISTS chunk_terms
+                USING fts5(terms, tokenize="unicode61 tokenchars '_'");
+            CREATE VIRTUAL TABLE IF NOT EXISTS chunk_vocab
+                USING fts5vocab(chunk_terms, 'row');
+            """)
+        self._db = db
+
+    def _delete_rows(self, ids: List[str]):
+        for i in range(0, len(ids), 500):
+            batch = ids[i:i + 500]
+            marks = ",".join("?" * len(batch))
+            rows = [
+                r for r, in self._db.execute(
+                    f"SELECT rowid FROM chunks WHERE id IN ({marks})", batch)
+            ]
+            if not rows:
+                continue
+            marks = ",".join("?" * len(rows))
+            self._db.execute(
+                f"DELETE FROM chunk_terms WHERE rowid IN ({marks})", rows)
+            self._db.execute(f"DELETE FROM chunks WHERE rowid IN ({marks})",
+                             rows)
+
+    def add(self, collection: str, documents: List[Document]):
+        """
+        index the documents written to collection, replacing the ones with
+        the same id
+        """
+        if not self.enabled or not documents:
+            return
+        with self._lock, self._db:
+            self._delete_rows([doc.id for doc in documents])
+            for doc in documents:
+                content = doc.content or ""
+                cur = self._db.execute(
+                    "INSERT INTO chunks(id, collection, topic, content, meta) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (doc.id, collection, doc.meta.get("topic"), content,
+                     json.dumps(doc.meta)))
+                self._db.execute(
+                    "INSERT INTO chunk_terms(rowid, terms) VALUES (?, ?)",
+                    (cur.lastrowid, " ".join(terms(content))))
+
+    def delete(self, ids: List[str]):
+        if not self.enabled or not ids:
+            return
+        with self._lock, self._db:
+            self._delete_rows(list(ids))
+
+    def has(self, collection: str, topic: Optional[str] = None) -> bool:
+        """
+        whether chunks of collection, of topic when set, are indexed: the
+        topics share the collection, and a topic ingested before the
+        sparse index or by a process without it has none
+        """
+        if not self.enabled:
+            return False
+        sql = "SELECT 1 FROM chunks WHERE collection = ?"
+        args = [collection]
+        if topic is not None:
+            sql += " AND topic = ?"
+            args.append(topic)
+        with self._lock:
+            row = self._db.execute(sql + " LIMIT 1", args).fetchone()
+        return row is not None
+
+    def _query_terms(self, text: str) -> List[str]:
+        unique = list(dict.fromkeys(terms(text)))
+        if len(unique) <= SPARSE_MAX_QUERY_TERMS:
+            return unique
+        #the rarest terms discriminate, common ones only cost time
+        freq = {}
+        for i in range(0, len(unique), 500):
+            batch = unique[i:i + 500]
+            marks = ",".join("?" * len(batch))
+            freq.update(
+                self._db.execute(
+                    "SELECT term, doc FROM chunk_vocab "
+                    f"WHERE term IN ({marks})", batch))
+        known = sorted((t for t in unique if t in freq), key=lambda t: freq[t])
+        return known[:SPARSE_MAX_QUERY_TERMS]
+
+    def search(self,
+               text: str,
+               collection: str,
+               topic: Optional[str] = None,
+               top_k: int = 10) -> List[Document]:
+        """
+        best BM25 matches of the identifiers of text, best first
+        """
+        if not self.enabled:
+            return []
+        with self._lock:
+            query_terms = self._query_terms(text)
+            if not query_terms:
+                return []
+            match = " OR ".join(f'"{t}"' for t in query_terms)
+            sql = ("SELECT c.id, c.content, c.meta, bm25(chunk_terms) "
+                   "FROM chunk_terms JOIN chunks c "
+                   "ON c.rowid = chunk_terms.rowid "
+                   "WHERE chunk_terms MATCH ? AND c.collection = ?")
+            args = [match, collection]
+            if topic is not None:
+                sql += " AND c.topic = ?"
+                args.append(topic)
+            sql += " ORDER BY bm25(chunk_terms) LIMIT ?"
+            args.append(top_k)
+            rows = self._db.execute(sql, args).fetchall()
+        #bm25() is lower for better matches
+        return [
+            Document(id=id,
+                     content=content,
+                     meta=json.loads(meta),
+                     score=-score) for id, content, meta, score in rows
+        ]
+
+
+sparse_index = SparseIndex()
+
+
+def retrieval_mode(text: str,
+                   collection: str,
+                   topic: Optional[str] = None) -> str:
+    """
+    dense, sparse or hybrid retrieval for the query text in topic, dense
+    when its chunks are not sparse indexed
+    """
+    if RAG_RETRIEVAL == "dense" or not sparse_index.has(collection, topic):
+        return "dense"
+    if RAG_RETRIEVAL == "sparse" or is_identifier_query(text):
+        return "sparse"
+    return "hybrid"
+
+
+@component
+class SparseRetriever:
+    """
+    BM25 retriever over the chunks of collection, of topic when set
+    """
+
+    def __init__(self,
+                 index: SparseIndex,
+                 collection: str,
+                 topic: Optional[str] = None,
+                 top_k: int = 10):
+        self.index = index
+        self.collection = collection
+        self.topic = topic
+        self.top_k = top_k
+
+    @component.output_types(documents=List[Document])
+    def run(self, query: str, top_k: Optional[int] = None):
+        return {
+            "documents":
+            self.index.search(query, self.collection, self.topic, top_k
+                              or self.top_k)
+        }
+
+
+@component
+class SparseWriter:
+    """
+    index the documents written to collection, next to the DocumentWriter
+    """
+
+    def __init__(self, index: SparseIndex, collection: str):
+        self.index = index
+        self.collection = collection
+
+    @component.output_types(documents_written=int)
+    def run(self, documents: List[Document]):
+        self.index.add(self.collection, documents)
+        return {"documents_written": len(documents)}
+
+
+@component
+class RankFusion:
+    """
+    reciprocal rank fusion of the dense and sparse rankings: a document
+    scores sum(1 / (k + rank)) over the rankings it appears in
+    """
+
+    def __init__(self, k: int = 60, top_k: int = 3):
+        self.k = k
+        self.top_k = top_k
+
+    @component.output_types(documents=List[Document])
+    def run(self,
+            dense: List[Document],
+            sparse: List[Document],
+            top_k: Optional[int] = None):
+        scores: Dict[str, float] = {}
+        docs: Dict[str, Document] = {}
+        for ranking in (dense, sparse):
+            for rank, doc in enumerate(ranking):
+                scores[doc.id] = scores.get(doc.id,
+                                            0) + 1 / (self.k + rank + 1)
+                docs.setdefault(doc.id, doc)
+        best = sorted(scores, key=scores.get, reverse=True)
+        fused = []
+        for id in best[:top_k or self.top_k]:
+            doc = docs[id]
+            doc.score = scores[id]
+            fused.append(doc)
+        return {"documents": fused}
+
+
+def add_retrieval(pipeline,
+                  mode: str,
+                  document_store,
+                  collection: str,
+                  topic: Optional[str] = None) -> str:
+    """
+    add the retrievers of mode to pipeline, the dense one searches
+    document_store (restricted to topic when set). return the name of the
+    component which outputs the retrieved documents.
+    """
+    if mode != "sparse":
+        from common import get_embedding_retriever, get_text_embedder
+        filters = None
+        if topic is not None:
+            filters = topic_filter(topic)
+        pipeline.add_component("text_embedder", get_text_embedder())
+        pipeline.add_component(
+            "retriever", get_embedding_retriever(document_store, filters))
+        pipeline.connect("text_embedder.embedding",
+                         "retriever.query_embedding")
+    if mode != "dense":
+        pipeline.add_component(
+            "sparse_retriever", SparseRetriever(sparse_index, collection,
+                                                topic))
+    if mode == "hybrid":
+        pipeline.add_component("fusion", RankFusion())
+        pipeline.connect("retriever", "fusion.dense")
+        pipeline.connect("sparse_retriever", "fusion.sparse")
+        return "fusion"
+    return "retriever" if mode == "dense" else "sparse_retriever"
+
+
+def retrieval_inputs(mode: str, text: str, top_k: int) -> Dict:
+    """
+    run data of the components added by add_retrieval
+    """
+    data: Dict = {}
+    candidates = max(top_k,
+                     RAG_FUSION_CANDIDATES) if mode == "hybrid" else top_k
+    if mode != "sparse":
+        data["text_embedder"] = {"text": text}
+        data["retriever"] = {"top_k": candidates}
+    if mode != "dense":
+        data["sparse_retriever"] = {"query": text, "top_k": candidates}
+    if mode == "hybrid":
+        data["fusion"] = {"top_k": top_k}
+    return data
@@ -0,0 +1,201 @@
+import os
+import re
+from copy import deepcopy
+from dataclasses import dataclass
+from typing import Callable, List, Optional, Set
+
+from chunker import split_units
+from haystack import Document, component
+
+CODE_EXTENSIONS = {
+    ".py", ".go", ".rs", ".c", ".h", ".cc", ".cpp", ".hpp", ".java", ".kt",
+    ".scala", ".js", ".jsx", ".ts", ".tsx", ".cs", ".rb", ".php", ".swift"
+}
+MARKDOWN_EXTENSIONS = {".md", ".markdown"}
+
+_HEADING_RE = re.compile(r"^#{1,6}\s")
+_FENCE_RE = re.compile(r"^\s*(```|~~~)")
+_WORD_RE = re.compile(r"\S+\s*")
+
+
+def document_kind(name: Optional[str]) -> str:
+    """
+    code, markdown or text, from the file name
+    """
+    ext = os.path.splitext(name or "")[1].lower()
+    if ext in CODE_EXTENSIONS:
+        return "code"
+    if ext in MARKDOWN_EXTENSIONS:
+        return "markdown"
+    return "text"
+
+
+def _unit_starts(lines: List[str], kind: str) -> List[int]:
+    """
+    first line of each unit: top level definitions of code, sections of
+    markdown, paragraphs of text
+    """
+    if kind == "code":
+        return [u.start_line for u in split_units("".join(lines))]
+    starts = [0]
+    in_fence = False
+    for idx, line in enumerate(lines):
+        if kind == "markdown":
+            if _FENCE_RE.match(line):
+                in_fence = not in_fence
+            elif not in_fence and idx > 0 and _HEADING_RE.match(line):
+                starts.append(idx)
+        elif idx > 0 and not lines[idx - 1].strip() and line.strip():
+            starts.append(idx)
+    return starts
+
+
+@dataclass
+class _Segment:
+    text: str
+    # 0 based line of the document
+    line: int
+    tokens: int
+    # markdown heading of the section, context for the following chunks
+    heading: Optional[str] = None
+
+
+@component
+class CodeAwareSplitter:
+    """
+    split documents into chunks the embedding model sees entirely: at
+    most max_tokens tokens of its tokenizer. chunks end at function/class
+    boundaries for source files, at headings for markdown and at
+    paragraphs for text; a unit too long for one chunk is cut between
+    lines. each chunk after the first repeats up to overlap_tokens of the
+    previous one (the section heading for markdown).
+    count_tokens returns the token count of each of a list of texts.
+    """
+
+    def __init__(self,
+                 count_tokens: Callable[[List[str]], List[int]],
+                 max_tokens: int = 480,
+                 overlap_tokens: int = 48):
+        self.count_tokens = count_tokens
+        self.max_tokens = max_tokens
+        self.overlap_tokens = min(overlap_tokens, max_tokens // 2)
+
+    def _segments(self, lines: List[str], kind: str,
+                  starts: Set[int]) -> List[_Segment]:
+        segments = []
+        heading = None
+        budget = self.max_tokens - self.overlap_tokens
+        counts = self.count_tokens(lines)
+        for idx, line in enumerate(lines):
+            tokens = counts[idx]
+            if kind == "markdown" and idx in starts and _HEADING_RE.match(
+                    line):
+                heading = line
+            if tokens <= budget:
+                segments.append(_Segment(line, idx, tokens, heading))
+                continue
+            #minified code, long paragraphs: cut between words
+            words = _WORD_RE.findall(line)
+            word_counts = self.count_tokens(words)
+            piece, piece_tokens = "", 0
+            for word, n in zip(words, word_counts):
+                if piece and piece_tokens + n > budget:
+                    segments.append(_Segment(piece, idx, piece_tokens,
+                                             heading))
+                    piece, piece_tokens = "", 0
+                piece += word
+                piece_tokens += n
+            if piece:
+                segments.append(_Segment(piece, idx, piece_tokens, heading))
+        return segments
+
+    def _context(self, previous: List[_Segment], first: _Segment,
+                 kind: str) -> List[_Segment]:
+        if kind == "markdown" and first.heading is not None:
+            if first.text == first.heading:
+                return []
+            tokens = self.count_tokens([first.heading])[0]
+            if tokens <= self.overlap_tokens:
+                return [_Segment(first.heading, first.line, tokens)]
+        context: List[_Segment] = []
+        used = 0
+        for segment in reversed(previous):
+            if used + segment.tokens > self.overlap_tokens:
+                break
+            context.insert(0, segment)
+            used += segment.tokens
+        return context
+
+    def split_text(self, text: str, kind: str) -> List[Document]:
+        lines = text.splitlines(keepends=True)
+        if not lines:
+            return []
+        starts = set(_unit_starts(lines, kind))
+        segments = self._segments(lines, kind, starts)
+        budget = self.max_tokens - self.overlap_tokens
+
+        # group the segments of each unit
+        units: List[List[_Segment]] = []
+        last_line = -1
+        for segment in segments:
+            if not units or (segment.line != last_line
+                             and segment.line in starts):
+                units.append([])
+            units[-1].append(segment)
+            last_line = segment.line
+
+        groups: List[List[_Segment]] = []
+        current: List[_Segment] = []
+        used = 0
+        for unit in units:
+            unit_tokens = sum(s.tokens for s in unit)
+            if current and used + unit_tokens > budget:
+                groups.append(current)
+                current, used = [], 0
+            if unit_tokens <= budget:
+                current.extend(unit)
+                used += unit_tokens
+                continue
+            for segment in unit:
+                if current and used + segment.tokens > budget:
+                    groups.append(current)
+                    current, used = [], 0
+                current.append(segment)
+                used += segment.tokens
+        if current:
+            groups.append(current)
+
+        chunks = []
+        previous: List[_Segment] = []
+        for group in groups:
+            context = self._context(previous, group[0], kind)
+            previous = group
+            content = "".join(s.text for s in context + group)
+            if not content.strip():
+                continue
+            chunks.append(
+                Document(content=content,
+                         meta={
+                             "start_line": group[0].line + 1,
+                             "end_line": group[-1].line + 1
+                         }))
+        return chunks
+
+    @component.output_types(documents=List[Document])
+    def run(self, documents: List[Document]):
+        """
+        the kind of each document is guessed from meta file_path or
+        document_name
+        """
+        split_docs = []
+        for doc in documents:
+            name = doc.meta.get("file_path") or doc.meta.get("document_name")
+            kind = document_kind(name)
+            for split_id, chunk in enumerate(
+                    self.split_text(doc.content or "", kind)):
+                meta = deepcopy(doc.meta)
+                meta.update(chunk.meta)
+                meta["source_id"] = doc.id
+                meta["split_id"] = split_id
+                split_docs.append(Document(content=chunk.content, meta=meta))
+        return {"documents": split_docs}
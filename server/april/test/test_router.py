@@ -0,0 +1,119 @@
+import asyncio
+
+import httpx
+import pytest
+import router
+from openai import OpenAI
+from router import Backend, ModelRouter, NoBackend
+
+
+class StubBackend(object):
+    """
+    OpenAI compatible backend answering in process, or refusing the
+    connection while it is down
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.up = True
+        self.backend = Backend(name, f"http://{name}.stub/v1", f"{name}-model",
+                               True, True)
+
+    def _handle(self, request: httpx.Request) -> httpx.Response:
+        if not self.up:
+            raise httpx.ConnectError("connection refused", request=request)
+        return httpx.Response(200,
+                              json={
+                                  "id":
+                                  "1",
+                                  "object":
+                                  "chat.completion",
+                                  "created":
+                                  0,
+                                  "model":
+                                  self.backend.model,
+                                  "choices": [{
+                                      "index": 0,
+                                      "finish_reason": "stop",
+                                      "message": {
+                                          "role": "assistant",
+                                          "content": self.name
+                                      }
+                                  }]
+                              })
+
+    def client(self) -> OpenAI:
+        http = httpx.Client(transport=httpx.MockTransport(self._handle))
+        return OpenAI(base_url=self.backend.base_url,
+                      api_key=self.backend.api_key,
+                      http_client=http,
+                      max_retries=0)
+
+
+@pytest.fixture
+def stubs():
+    #names of LLM_BACKENDS, the local backends are configured
+    return {name: StubBackend(name) for name in ("custom", "ollama")}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(router.time, "monotonic", lambda: now[0])
+    return now
+
+
+def route(model_router, stubs, spec="auto", policy=None):
+
+    async def call(attempt):
+        client = stubs[attempt.route.backend].client()
+        reply = client.chat.completions.create(model=attempt.route.model,
+                                               messages=[{
+                                                   "role": "user",
+                                                   "content": "hi"
+                                               }])
+        return reply.choices[0].message.content
+
+    routes = model_router.candidates(spec, policy)
+    return asyncio.run(model_router.route(routes, call))
+
+
+def test_failover_and_recovery(stubs, clock):
+    model_router = ModelRouter({n: s.backend for n, s in stubs.items()})
+    stubs["custom"].up = False
+    #custom is preferred while it is healthy, ollama serves meanwhile
+    for _ in range(router.ROUTER_MAX_FAILURES):
+        _, answer = route(model_router, stubs, "custom:", "prefer")
+        assert answer == "ollama"
+    assert not model_router.stats["custom"].healthy()
+    assert [r.backend
+            for r in model_router.candidates("auto")] == ["ollama", "custom"]
+
+    stubs["custom"].up = True
+    clock[0] += router.ROUTER_COOLDOWN
+    assert model_router.stats["custom"].healthy()
+    backend_route, answer = route(model_router, stubs, "custom:", "prefer")
+    assert (backend_route.backend, answer) == ("custom", "custom")
+    assert model_router.stats["custom"].snapshot()["failures"] == 0
+
+
+def test_every_backend_down(stubs, clock):
+    model_router = ModelRouter({n: s.backend for n, s in stubs.items()})
+    for stub in stubs.values():
+        stub.up = False
+    with pytest.raises(NoBackend):
+        route(model_router, stubs)
+
+
+def test_other_errors_do_not_count(stubs, clock):
+    model_router = ModelRouter({n: s.backend for n, s in stubs.items()})
+
+    async def call(attempt):
+        raise ValueError("malformed tool output")
+
+    with pytest.raises(ValueError):
+        asyncio.run(
+            model_router.route(model_router.candidates("custom:", "prefer"),
+                               call))
+    assert model_router.stats["custom"].snapshot()["failures"] == 0
+    assert model_router.stats["ollama"].snapshot()["failures"] == 0
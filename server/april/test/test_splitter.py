@@ -0,0 +1,28 @@
+from splitter import CodeAwareSplitter
+
+
+def count_tokens(texts):
+    #about 4 characters per token, like the real tokenizers
+    return [-(-len(text) // 4) for text in texts]
+
+
+def split(text):
+    splitter = CodeAwareSplitter(count_tokens,
+                                 max_tokens=480,
+                                 overlap_tokens=48)
+    return splitter.split_text(text, "text")
+
+
+def test_long_line_followed_by_more_lines_than_words():
+    #a long line is cut between its 40 words, the next 50 lines must
+    #keep their own counts
+    text = ("w" * 99 + " ") * 40 + "\n" + "x = 1 + 2\n" * 50
+    chunks = split(text)
+    assert chunks[-1].meta["end_line"] == 51
+
+
+def test_chunks_after_a_long_line_fit():
+    text = "ab " * 1500 + "\n" + ("z" * 1600 + "\n") * 5
+    chunks = split(text)
+    for chunk in chunks:
+        assert count_tokens([chunk.content])[0] <= 480
@@ -4,8 +4,8 @@ import subprocess
 from typing import Optional,List
 
 
+from llm_client import openai_client
 from logger import init_logger
-from openai import OpenAI
 from pydantic import BaseModel
 
 logger = init_logger(__name__)
@@ -20,7 +20,8 @@ class ResourceTypes(BaseModel):
     resources: list[Resource]
 
 
-client = OpenAI(api_key=os.environ['OPENAI_API_KEY'])
+# pooled keep-alive client shared with lint
+client = openai_client("openai", api_key=os.environ['OPENAI_API_KEY'])
 
 git_repo = '/root/git/terraform-provider-volcengine/'
 doc_path = f'{git_repo}/website/docs/r'
@@ -0,0 +1,109 @@
+import os
+from threading import Event, Lock, Thread
+from typing import Callable, Dict, List, Optional, Set
+
+from logger import init_logger
+
+logger = init_logger(__name__)
+
+# topics are refreshed in the background every TOPIC_CATALOG_TTL seconds,
+# and right away when the catalog is invalidated by /rag or /delete-rag
+TOPIC_CATALOG_TTL = float(os.getenv("TOPIC_CATALOG_TTL", "60"))
+
+
+class TopicCatalog(object):
+    """
+    cached list of topics, so lint never waits for a metadata round-trip
+    to the vector database to decide whether to use RAG.
+    """
+
+    def __init__(self,
+                 loader: Callable[[], List[str]],
+                 ttl: float = TOPIC_CATALOG_TTL):
+        self.loader = loader
+        self.ttl = ttl
+        self._lock = Lock()
+        self._topics: Optional[Set[str]] = None
+        # topics added by add(), with the number of refreshes started
+        # before: a refresh started earlier may not see them
+        self._added: Dict[str, int] = {}
+        self._started = 0
+        self._wakeup = Event()
+        self._thread: Optional[Thread] = None
+
+    def _refresh(self):
+        with self._lock:
+            self._started += 1
+            started = self._started
+        try:
+            topics = set(self.loader())
+        except Exception as e:
+            # keep serving the last known topics
+            logger.warning(f"failed to refresh topics: {e}")
+            return
+        with self._lock:
+            for topic, seen in list(self._added.items()):
+                if seen >= started:
+                    topics.add(topic)
+                else:
+                    del self._added[topic]
+            self._topics = topics
+
+    def _loop(self):
+        while True:
+            # clear first, an invalidation during the refresh is not lost
+            self._wakeup.clear()
+            self._refresh()
+            self._wakeup.wait(self.ttl)
+
+    def start(self):
+        """
+        start the background refresher, it loads the topics right away
+        """
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = Thread(target=self._loop,
+                                  name="topic-catalog",
+                                  daemon=True)
+        self._thread.start()
+
+    def topics(self) -> List[str]:
+        """
+        the last topics loaded, never waits for the vector database: the
+        handlers of the event loop call it. before the first load only
+        the added topics are known, the background refresher loads them.
+        """
+        with self._lock:
+            loaded = self._topics is not None
+            topics = set(self._topics if loaded else self._added)
+        if not loaded:
+            self.start()
+        return sorted(topics)
+
+    def exists(self, topic: str) -> bool:
+        """
+        called off the event loop by lint, which must not skip RAG because
+        the first background load did not finish yet: loads it then
+        """
+        with self._lock:
+            loaded = self._topics is not None
+        if not loaded:
+            self._refresh()
+        return topic in self.topics()
+
+    def add(self, topic: str):
+        """
+        topic was just written, it exists from now on: a lint right after
+        /rag must not run without the new documents
+        """
+        with self._lock:
+            self._added[topic] = self._started
+            if self._topics is not None:
+                self._topics.add(topic)
+
+    def invalidate(self):
+        """
+        topics changed, refresh in the background as soon as possible
+        """
+        self._wakeup.set()
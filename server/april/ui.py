@@ -10,6 +10,8 @@ from streamlit_option_menu import option_menu
 #lint.log record all lint messages.
 logger = init_logger(__name__)
 
+DOCS_PER_PAGE = 20
+
 has_parse_se_logs = False
 try:
     import parse_se_logs
@@ -57,40 +59,63 @@ def rag():
         st.markdown(
             '<h4 style="color:black;">Here you can review the uploaded files, and each file could be split into multiple documents</h4>',
             unsafe_allow_html=True)
+        topic = st.text_input("Filter by topic", key="list-topic")
+        # cursors of the pages visited, the last one is shown
+        if st.session_state.get("list-topic-shown") != topic:
+            st.session_state["list-topic-shown"] = topic
+            st.session_state["list-cursors"] = [None]
+            st.session_state.pop("list-totals", None)
+        cursors = st.session_state["list-cursors"]
         try:
             rag = RagDocument()
-            for record in rag.list_docs():
-                st.markdown(
-                    f'<h3 style="color:black;">Document {record.id}</h3>',
-                    unsafe_allow_html=True)
+            # the totals are counted once per topic filter
+            page = rag.list_docs(topic or None,
+                                 cursors[-1],
+                                 DOCS_PER_PAGE,
+                                 totals="list-totals" not in st.session_state)
+            if "total_documents" in page:
+                st.session_state["list-totals"] = (page["total_documents"],
+                                                   page["total_chunks"])
+            if "list-totals" in st.session_state:
+                documents, chunks = st.session_state["list-totals"]
                 st.markdown(
-                    f'<span style="color:dimgrey">Document Id: {record.payload["id"]}</span>',
+                    f'<span style="color:dimgrey">{documents} documents, {chunks} chunks</span>',
                     unsafe_allow_html=True)
+            for doc in page["documents"]:
+                key = f'{doc["topic"]}/{doc["document_name"]}'
                 st.markdown(
-                    f'<span style="color:dimgrey">Document Name: {record.payload["meta"]["document_name"]}</span>',
+                    f'<h3 style="color:black;">Document {doc["document_name"]}</h3>',
                     unsafe_allow_html=True)
                 st.markdown(
-                    f'<span style="color:dimgrey">Topic: {record.payload["meta"]["topic"]}</span>',
+                    f'<span style="color:dimgrey">Topic: {doc["topic"]}</span>',
                     unsafe_allow_html=True)
                 col1, col2 = st.columns([0.2, 0.8])
                 with col1:
-                    # Add a preview button
-                    if st.button("Preview", key=f"preview-{record.id}"):
-                        st.markdown(f"```\
-                        {record.payload['content'][:500]}\
-                         ```")
+                    # the content is only read for the previewed document
+                    if st.button("Preview", key=f"preview-{key}"):
+                        preview = rag.get_preview(doc["topic"],
+                                                  doc["document_name"])
+                        st.markdown(f"```\n{preview}\n```")
                 with col2:
                     # Add a delete button
-                    if st.button("Delete", key=f"delete-{record.id}"):
+                    if st.button("Delete", key=f"delete-{key}"):
                         try:
-                            rag.delete_doc(
-                                record.payload["meta"]["topic"],
-                                record.payload["meta"]["document_name"])
+                            rag.delete_doc(doc["topic"], doc["document_name"])
+                            st.session_state.pop("list-totals", None)
                             st.success("Deleted the document successfully!")
                         except Exception as e:
                             st.error(
                                 f"Failed to delete the document, please check the log for details {e}"
                             )
+            col1, col2 = st.columns([0.2, 0.8])
+            with col1:
+                if len(cursors) > 1 and st.button("Previous"):
+                    cursors.pop()
+                    st.rerun()
+            with col2:
+                if page["next_cursor"] is not None and st.button("Next"):
+                    cursors.append(page["next_cursor"])
+                    st.rerun()
 
         except Exception as e:
             st.error(
@@ -0,0 +1,106 @@
+import re
+from dataclasses import dataclass, field
+from typing import List, Tuple
+
+_HUNK_RE = re.compile(r"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
+
+
+@dataclass
+class Hunk:
+    # 1 based, as in the @@ header
+    old_start: int
+    old_len: int
+    new_start: int
+    new_len: int
+    lines: List[str] = field(default_factory=list)
+
+
+def parse_hunks(diff: str) -> List[Hunk]:
+    """
+    parse the hunks of a unified diff of a single file.
+    file headers (diff --git, ---, +++, index ...) are skipped.
+    """
+    hunks: List[Hunk] = []
+    for line in diff.splitlines():
+        m = _HUNK_RE.match(line)
+        if m:
+            old_start, old_len, new_start, new_len = m.groups()
+            hunks.append(
+                Hunk(int(old_start), 1 if old_len is None else int(old_len),
+                     int(new_start), 1 if new_len is None else int(new_len)))
+            continue
+        if not hunks:
+            continue
+        if line.startswith((" ", "+", "-", "\\")) or line == "":
+            hunks[-1].lines.append(line)
+    return hunks
+
+
+def apply_hunks(base: str,
+                hunks: List[Hunk]) -> Tuple[List[str], List[Tuple[int, int]]]:
+    """
+    apply the hunks to base.
+    return the lines of the new file and the changed ranges of the new
+    file (0 based, end excluded). a pure deletion gives an empty range at
+    the position of the deleted lines.
+    """
+    old = base.splitlines()
+    new: List[str] = []
+    changed: List[Tuple[int, int]] = []
+    pos = 0
+    for hunk in hunks:
+        # a hunk of an empty side has start 0
+        start = max(hunk.old_start - 1, 0)
+        if hunk.old_len == 0:
+            start = hunk.old_start
+        if start < pos or start > len(old):
+            raise ValueError(f"hunk @@ -{hunk.old_start} does not apply")
+        new.extend(old[pos:start])
+        pos = start
+        region_start = None
+        for line in hunk.lines:
+            tag, text = line[:1], line[1:]
+            if tag == "\\":
+                # "\ No newline at end of file"
+                continue
+            if tag in (" ", ""):
+                if pos >= len(old) or old[pos] != text:
+                    raise ValueError(
+                        f"context mismatch at line {pos + 1} of base")
+                if region_start is not None:
+                    changed.append((region_start, len(new)))
+                    region_start = None
+                new.append(text)
+                pos += 1
+            elif tag == "-":
+                if pos >= len(old) or old[pos] != text:
+                    raise ValueError(
+                        f"removed line {pos + 1} does not match base")
+                if region_start is None:
+                    region_start = len(new)
+                pos += 1
+            elif tag == "+":
+                if region_start is None:
+                    region_start = len(new)
+                new.append(text)
+        if region_start is not None:
+            changed.append((region_start, len(new)))
+    new.extend(old[pos:])
+    return new, changed
+
+
+def expand_regions(regions: List[Tuple[int, int]], context: int,
+                   total: int) -> List[Tuple[int, int]]:
+    """
+    add context lines around each changed region and merge the regions
+    which overlap afterwards
+    """
+    merged: List[Tuple[int, int]] = []
+    for start, end in sorted(regions):
+        start = max(start - context, 0)
+        end = min(end + context, total)
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+        else:
+            merged.append((start, end))
+    return merged